@@ -0,0 +1,122 @@
+import ipaddress
+import threading
+import time
+from common import logger
+
+# Seconds that the subnets of an ALB are cached for. ALB subnets rarely change, so the Availability Zone map costs
+# one DescribeLoadBalancers and one DescribeSubnets call per ALB per container and hour
+AVAILABILITY_ZONE_MAP_TTL = 3600
+# Seconds that an Availability Zone map without Availability Zones is cached for. The ALB subnets could not be
+# read, so they are read again soon instead of turning the Availability Zone coverage off for an hour
+EMPTY_AVAILABILITY_ZONE_MAP_TTL = 60
+
+# Availability Zone map per ALB DNS name, reused across warm Lambda invocations. The A and AAAA sampling of a
+# dualstack ALB share it, so every ALB has its own lock and its subnets are read once
+_availability_zone_map_cache = {}
+_availability_zone_map_lock_per_alb = {}
+_availability_zone_map_cache_lock = threading.Lock()
+
+
+class AvailabilityZoneMap:
+    """
+    Maps the ALB node IPs to the Availability Zone of the ALB subnet that holds them. Every IP is resolved once
+    """
+
+    def __init__(self, subnet_list, loaded_at=0.0):
+        """
+        :param subnet_list: subnets of the ALB, as AwsServices.get_load_balancer_subnet_list returns them
+        :param loaded_at: time (time.monotonic) when the subnets were read
+        """
+        self.network_list = [
+            (ipaddress.ip_network(cidr_block), subnet["AvailabilityZone"])
+            for subnet in subnet_list
+            for cidr_block in subnet["CidrBlockList"]
+        ]
+        self.availability_zone_set = {subnet["AvailabilityZone"] for subnet in subnet_list}
+        self.loaded_at = loaded_at
+        self.availability_zone_per_ip = {}
+
+    def get_availability_zone_set(self, ip_version):
+        """
+        :param ip_version: 4 or 6
+        :return: a set of the Availability Zones whose ALB subnet has a CIDR block of the IP version
+        """
+        return {
+            availability_zone
+            for (network, availability_zone) in self.network_list
+            if network.version == ip_version
+        }
+
+    def get_availability_zone(self, ip):
+        """
+        :param ip: ALB node IP
+        :return: Availability Zone of the ALB subnet that holds the IP. None when no ALB subnet holds it
+        """
+        if ip not in self.availability_zone_per_ip:
+            ip_address = ipaddress.ip_address(ip)
+            self.availability_zone_per_ip[ip] = next(
+                (
+                    availability_zone
+                    for (network, availability_zone) in self.network_list
+                    if ip_address.version == network.version and ip_address in network
+                ),
+                None,
+            )
+        return self.availability_zone_per_ip[ip]
+
+    def get_ip_set_per_availability_zone(self, ip_set):
+        """
+        :param ip_set: a set of ALB node IPs
+        :return: dict of Availability Zone to a set of IPs. Every Availability Zone of the ALB is a key.
+        The IPs that no ALB subnet holds are under None
+        """
+        ip_set_per_availability_zone = {
+            availability_zone: set() for availability_zone in self.availability_zone_set
+        }
+        for ip in ip_set:
+            ip_set_per_availability_zone.setdefault(self.get_availability_zone(ip), set()).add(ip)
+        return ip_set_per_availability_zone
+
+
+def get_availability_zone_map(aws_service, alb_dns_name):
+    """
+    Get the Availability Zone map of the given ALB from the module-level cache. Read the ALB subnets on first use
+    and once the cached map is older than AVAILABILITY_ZONE_MAP_TTL, or EMPTY_AVAILABILITY_ZONE_MAP_TTL when the
+    subnets could not be read
+    :param aws_service: aws service object
+    :param alb_dns_name: DNS name of ALB
+    :return: AvailabilityZoneMap. It has no Availability Zone when the ALB subnets cannot be read
+    """
+    with _availability_zone_map_cache_lock:
+        availability_zone_map_lock = _availability_zone_map_lock_per_alb.setdefault(
+            alb_dns_name, threading.Lock()
+        )
+    with availability_zone_map_lock:
+        availability_zone_map = _availability_zone_map_cache.get(alb_dns_name)
+        if availability_zone_map is not None:
+            ttl = (
+                AVAILABILITY_ZONE_MAP_TTL
+                if availability_zone_map.availability_zone_set
+                else EMPTY_AVAILABILITY_ZONE_MAP_TTL
+            )
+        if (
+                availability_zone_map is None
+                or time.monotonic() - availability_zone_map.loaded_at >= ttl
+        ):
+            availability_zone_map = _availability_zone_map_cache[alb_dns_name] = AvailabilityZoneMap(
+                aws_service.get_load_balancer_subnet_list(alb_dns_name), time.monotonic()
+            )
+            logger.info(
+                f"Availability Zones of ALB ({alb_dns_name}): {sorted(availability_zone_map.availability_zone_set)}"
+            )
+    return availability_zone_map
+
+
+def get_cached_availability_zone_map(alb_dns_name):
+    """
+    Get the Availability Zone map of the given ALB from the module-level cache without reading the ALB subnets
+    :param alb_dns_name: DNS name of ALB
+    :return: AvailabilityZoneMap. None when the map of the ALB has not been read yet
+    """
+    with _availability_zone_map_cache_lock:
+        return _availability_zone_map_cache.get(alb_dns_name)
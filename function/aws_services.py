@@ -1,72 +1,299 @@
 import boto3
 from common import precondition, logger
-from botocore.exceptions import ClientError
-import json
+from metrics import MetricRecorder
+from state_codec import STATE_ENCODING_JSON, decode_state, encode_state
+from botocore.exceptions import BotoCoreError, ClientError, ParamValidationError
+import copy
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Max number of targets per RegisterTargets/DeregisterTargets call
+TARGET_CHUNK_SIZE = 20
+# Max number of RegisterTargets/DeregisterTargets calls in flight at the same time
+TARGET_MUTATION_MAX_WORKERS = 4
+# Max number of attempts of a throttled API call
+API_MAX_ATTEMPTS = 5
+# Base delay (in seconds) of the exponential backoff
+API_RETRY_BASE_DELAY = 0.2
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+}
+
+# boto3 clients are created on first use and reused across warm Lambda invocations.
+# Keyed by (service name, region)
+_client_cache = {}
+_client_cache_lock = threading.Lock()
+
+# In-container copy of the state objects, reused across warm Lambda invocations.
+# Keyed by (bucket, object key). Value: (ETag, content)
+_s3_object_cache = {}
+
+# ARN of every ALB that was found by its DNS name, reused across warm Lambda invocations. Keyed by
+# (region, DNS name)
+_load_balancer_arn_cache = {}
+
+# Conditional PutObject parameters (IfMatch, IfNoneMatch) that the botocore of the runtime rejected. Older botocore
+# versions do not know them, so the state is written unconditionally there
+_unsupported_put_parameter_set = set()
+
+
+def get_client(service_name, region):
+    """
+    Get a boto3 client from the module-level cache. Create it on first use
+    :param service_name: AWS service name. e.g. s3
+    :param region: AWS region
+    :return: boto3 client
+    """
+    with _client_cache_lock:
+        client = _client_cache.get((service_name, region))
+        if client is None:
+            client = _client_cache[(service_name, region)] = boto3.client(
+                service_name, region_name=region
+            )
+    return client
+
+
+class TargetGroupSnapshot:
+    """
+    Targets of a target group at one point in time, keyed by (IP, port, availability zone), with their
+    health state. Taken once per reconcile and shared by registration, deregistration and metrics
+    """
+
+    def __init__(self, tg_arn, target_health_description_list):
+        self.tg_arn = tg_arn
+        self.target_state = {}
+        for target_health_description in target_health_description_list:
+            target = target_health_description["Target"]
+            target_key = (
+                target["Id"],
+                target.get("Port"),
+                target.get("AvailabilityZone"),
+            )
+            self.target_state[target_key] = target_health_description["TargetHealth"]["State"]
+
+    def get_ip_set(self, state_set=None):
+        """
+        :param state_set: target health states to keep. e.g. {"draining"}. All of the targets when not given
+        :return: a set of target IPs
+        """
+        return {
+            ip
+            for (ip, _, _), state in self.target_state.items()
+            if state_set is None or state in state_set
+        }
+
+    @property
+    def ip_set(self):
+        """
+        A set of IPs of all of the targets, including the draining ones
+        """
+        return self.get_ip_set()
+
+    @property
+    def draining_ip_set(self):
+        """
+        A set of IPs of the targets that are being deregistered
+        """
+        return self.get_ip_set({"draining"})
+
+    @property
+    def registered_ip_set(self):
+        """
+        A set of IPs of the targets that are registered and not being deregistered
+        """
+        return self.ip_set - self.draining_ip_set
+
+    def get_ip_count_by_availability_zone(self, availability_zone_map=None):
+        """
+        :param availability_zone_map: AvailabilityZoneMap of the ALB. It gives the availability zone of the targets
+        that are registered without one or with "all" (SAME_VPC is false)
+        :return: mapping of availability zone and the count of IPs that are registered and not being deregistered.
+        Targets whose availability zone is not known are left out. e.g. {'us-east-1a': 2, 'us-east-1b': 1}
+        """
+        ip_count_by_availability_zone = {}
+        for (ip, _, availability_zone), state in self.target_state.items():
+            if state == "draining":
+                continue
+            if availability_zone in (None, "all"):
+                availability_zone = (
+                    availability_zone_map.get_availability_zone(ip) if availability_zone_map is not None else None
+                )
+            if availability_zone:
+                ip_count_by_availability_zone[availability_zone] = (
+                    ip_count_by_availability_zone.get(availability_zone, 0) + 1
+                )
+        return ip_count_by_availability_zone
+
+    def get_target_count_by_state(self):
+        """
+        :return: mapping of target health state and target count. e.g. {'healthy': 2, 'draining': 1}
+        """
+        target_count_by_state = {}
+        for state in self.target_state.values():
+            target_count_by_state[state] = target_count_by_state.get(state, 0) + 1
+        return target_count_by_state
 
 
 class AwsServices:
     """
-    Provides common methods to interact with AWS services (S3, CloudWatch, ELBv2)
+    Provides common methods to interact with AWS services (S3, CloudWatch, ELBv2, EC2)
     """
 
     def __init__(self, region, bucket):
         precondition(region, "region is required")
         precondition(bucket, "bucket is required")
 
-        self.s3 = boto3.resource("s3", region_name=region)
-        self.s3_client = boto3.client("s3", region_name=region)
-        self.cw = boto3.client("cloudwatch", region_name=region)
-        self.elbv2 = boto3.client("elbv2", region_name=region)
         self.region = region
         self.bucket = bucket
 
-    def publish_elb_ip_count_metric(self, ip_dict):
+    @classmethod
+    def from_config(cls, config):
         """
-        Add IPCount to CloudWatch metric for tracking ALB node count
-        :param ip_dict: IP meta data dict e.g.
-        {
-            'LoadBalancerName': 'internal-alb-internal-abc1234.us-east-1.elb.amazonaws.com',
-            'TimeStamp': '2021-05-17 23:31:12',
-            'IPList': ['172.16.2.13', '172.16.3.220'],
-            'IPCount': 2
-        }
+        :param config: Config. Its AWS_REGION and S3_BUCKET are used
+        :return: AwsServices
+        """
+        return cls(region=config.REGION, bucket=config.S3_BUCKET)
+
+    @property
+    def s3_client(self):
+        return get_client("s3", self.region)
+
+    @property
+    def cw(self):
+        return get_client("cloudwatch", self.region)
+
+    @property
+    def elbv2(self):
+        return get_client("elbv2", self.region)
+
+    @property
+    def ec2(self):
+        return get_client("ec2", self.region)
+
+    def publish_metric_data(self, namespace, metric_data_list):
+        """
+        Publish metric datums to CloudWatch in one call
+        :param namespace: CloudWatch namespace
+        :param metric_data_list: list of metric datums. e.g.
+        [{'MetricName': 'LoadBalancerIPCount', 'Dimensions': [{'Name': 'LoadBalancerName', 'Value': '...'}],
+        'Value': 2.0, 'Unit': 'Count'}]
+        :return: a boolean value indicating whether the datums were published
         """
         try:
-            self.cw.put_metric_data(
-                Namespace="AWS/ApplicationELB",
-                MetricData=[
-                    {
-                        "MetricName": "LoadBalancerIPCount",
-                        "Dimensions": [
-                            {
-                                "Name": "LoadBalancerName",
-                                "Value": ip_dict["LoadBalancerName"],
-                            },
-                        ],
-                        "Value": float(ip_dict["IPCount"]),
-                        "Unit": "Count",
-                    },
-                ],
-            )
+            self.cw.put_metric_data(Namespace=namespace, MetricData=metric_data_list)
         except ClientError as e:
             logger.exception(f"Failed to put data to CloudWatch metric. Error: {e}")
+            return False
+        logger.info(f"Published {len(metric_data_list)} metric datums to CloudWatch namespace - {namespace}")
+        return True
 
-    def write_content_to_s3(self, content, object_key):
+    def download_state_from_s3(self, object_key):
         """
-        Adds an object to a bucket
-        :param content: bytes or seekable file-like object
+        Download the state object from S3. The GET is conditional on the ETag of the in-container copy,
+        so the object body is only transferred and parsed when it has changed. Both JSON and binary state objects
+        are read
         :param object_key: S3 object key
+        :return: (state content, ETag). ({}, None) when the state object does not exist yet. ({}, ETag) when it
+        cannot be decoded, so that the next conditional write replaces the corrupt object
         """
+        (cached_etag, cached_content) = _s3_object_cache.get(
+            (self.bucket, object_key), (None, None)
+        )
+        request = {"Bucket": self.bucket, "Key": object_key}
+        if cached_etag:
+            request["IfNoneMatch"] = cached_etag
         try:
-            s3_object = self.s3.Object(self.bucket, object_key)
-            s3_object.put(Body=content, ServerSideEncryption="AES256")
-            logger.debug(
-                f"Successfully write content to - s3://{self.bucket}/{object_key}"
-            )
+            response = self.s3_client.get_object(**request)
         except ClientError as e:
-            logger.error(
-                f"Failed to write to s3://{self.bucket}/{object_key}. Error: {e}"
-            )
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 304:
+                logger.info(
+                    f"{object_key} is unchanged since the last download. Use the in-container copy"
+                )
+                return copy.deepcopy(cached_content), cached_etag
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                logger.info(f"{object_key} does not exist in S3 bucket - {self.bucket}")
+            else:
+                logger.warning(f"Failed to download {object_key}. Error: {e}")
+            _s3_object_cache.pop((self.bucket, object_key), None)
+            return {}, None
+
+        logger.info(f"Get {object_key} from S3 bucket - {self.bucket}")
+        try:
+            content = decode_state(response["Body"].read())
+            if not isinstance(content, dict):
+                raise ValueError(f"State is a {type(content).__name__}, not an object")
+        except (ValueError, BotoCoreError) as e:
+            logger.warning(f"Failed to decode {object_key}. Treat it as missing. Error: {e}")
+            _s3_object_cache.pop((self.bucket, object_key), None)
+            return {}, response["ETag"]
+        _s3_object_cache[(self.bucket, object_key)] = (
+            response["ETag"],
+            copy.deepcopy(content),
+        )
+        return content, response["ETag"]
+
+    def write_state_to_s3(self, content, object_key, etag, encoding=STATE_ENCODING_JSON):
+        """
+        Write the state object to S3. The PUT is conditional on the ETag that the state was loaded with,
+        so a concurrent invocation's write is never silently overwritten. It falls back to an unconditional PUT when
+        the botocore of the runtime does not support conditional writes
+        :param content: state content (dict)
+        :param object_key: S3 object key
+        :param etag: ETag of the state object that was loaded. None when the state object did not exist
+        :param encoding: state encoding. json or binary
+        :return: a boolean value indicating whether the state object was written
+        """
+        (body, content_type) = encode_state(content, encoding)
+        request = {
+            "Bucket": self.bucket,
+            "Key": object_key,
+            "Body": body,
+            "ContentType": content_type,
+            "ServerSideEncryption": "AES256",
+        }
+        (condition_parameter, condition_value) = ("IfMatch", etag) if etag else ("IfNoneMatch", "*")
+        if condition_parameter not in _unsupported_put_parameter_set:
+            request[condition_parameter] = condition_value
+        try:
+            try:
+                response = self.s3_client.put_object(**request)
+            except ParamValidationError as e:
+                if condition_parameter not in request:
+                    raise
+                logger.warning(
+                    f"botocore does not support {condition_parameter} on PutObject. Write the state unconditionally. "
+                    f"Error: {e}"
+                )
+                _unsupported_put_parameter_set.add(condition_parameter)
+                del request[condition_parameter]
+                response = self.s3_client.put_object(**request)
+        except BotoCoreError as e:
+            _s3_object_cache.pop((self.bucket, object_key), None)
+            logger.error(f"Failed to write to s3://{self.bucket}/{object_key}. Error: {e}")
+            return False
+        except ClientError as e:
+            _s3_object_cache.pop((self.bucket, object_key), None)
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+                logger.error(
+                    f"s3://{self.bucket}/{object_key} was changed by a concurrent invocation. Skip writing the state"
+                )
+            else:
+                logger.error(
+                    f"Failed to write to s3://{self.bucket}/{object_key}. Error: {e}"
+                )
+            return False
+
+        _s3_object_cache[(self.bucket, object_key)] = (
+            response["ETag"],
+            copy.deepcopy(content),
+        )
+        logger.debug(f"Successfully write content to - s3://{self.bucket}/{object_key}")
+        return True
 
     def download_elb_ip_from_s3(self, object_key):
         """
@@ -79,7 +306,7 @@ class AwsServices:
             response = self.s3_client.get_object(Bucket=self.bucket, Key=object_key)
             logger.info(f"Get {object_key} from S3 bucket - {self.bucket}")
             logger.debug(f"Get object from S3 response - {response}")
-            ip_from_previous_invocation = json.loads(response["Body"].read())
+            ip_from_previous_invocation = decode_state(response["Body"].read())
         except Exception as e:
             logger.warning(
                 f"Failed to download ELB IPs collected from the previous Lambda invocation. "
@@ -87,57 +314,220 @@ class AwsServices:
             )
         return ip_from_previous_invocation
 
-    def register_target(self, tg_arn, new_target_list):
+    def _call_with_retry(self, api_call, metric_recorder=None, **kwargs):
         """
-        Register given targets to the given target group
+        Call an AWS API and retry throttling errors with full-jitter exponential backoff
+        :param api_call: boto3 client method
+        :param metric_recorder: records the retry count
+        :param kwargs: API parameters
+        :return: API response
+        """
+        metric_recorder = metric_recorder or MetricRecorder({})
+        attempt = 1
+        while True:
+            try:
+                return api_call(**kwargs)
+            except ClientError as e:
+                if (
+                        e.response["Error"]["Code"] not in THROTTLING_ERROR_CODES
+                        or attempt >= API_MAX_ATTEMPTS
+                ):
+                    raise
+                delay = random.uniform(0, API_RETRY_BASE_DELAY * 2 ** attempt)
+                logger.warning(
+                    f"Attempt-{attempt}: API call is throttled. Retry in {delay:.2f}s. Error: {e}"
+                )
+                metric_recorder.add_count("ApiRetryCount")
+                time.sleep(delay)
+                attempt += 1
+
+    def _mutate_target_chunk(self, api_call, tg_arn, target_chunk, metric_recorder=None):
+        """
+        Register or deregister one chunk of targets. When the chunk fails for another reason than throttling,
+        every target of the chunk is retried alone, so one bad target does not fail the others. A chunk that is
+        still throttled after its retries fails as a whole and is retried by the next pass
+        :param api_call: elbv2 register_targets or deregister_targets
         :param tg_arn: ARN of target group
-        :param new_target_list: list of targets
+        :param target_chunk: list of targets
+        :param metric_recorder: records the retry count
+        :return: list of targets that succeeded
         """
-        logger.info(f"Register new_target_list:{new_target_list}")
-        is_registered = False
         try:
-            self.elbv2.register_targets(TargetGroupArn=tg_arn, Targets=new_target_list)
-            is_registered = True
+            self._call_with_retry(
+                api_call, metric_recorder, TargetGroupArn=tg_arn, Targets=target_chunk
+            )
+            return target_chunk
         except Exception as e:
             logger.exception(
-                f"Failed to register target to target group. "
-                f"Targets: {new_target_list}. Target group: {tg_arn}"
+                f"Failed to update target group. Targets: {target_chunk}. Target group: {tg_arn}. Error: {e}"
+            )
+            # Splitting a throttled chunk into single-target calls would only add to the throttling
+            is_throttled = (
+                    isinstance(e, ClientError) and e.response["Error"]["Code"] in THROTTLING_ERROR_CODES
+            )
+            if is_throttled or len(target_chunk) == 1:
+                return []
+        succeeded_target_list = []
+        for target in target_chunk:
+            succeeded_target_list += self._mutate_target_chunk(
+                api_call, tg_arn, [target], metric_recorder
             )
-        return is_registered
+        return succeeded_target_list
+
+    def _mutate_target(self, api_call, tg_arn, target_list, metric_recorder=None):
+        """
+        Register or deregister targets in chunks of TARGET_CHUNK_SIZE. The chunks run concurrently
+        :param api_call: elbv2 register_targets or deregister_targets
+        :param tg_arn: ARN of target group
+        :param target_list: list of targets
+        :param metric_recorder: records the retry count
+        :return: list of targets that succeeded
+        """
+        target_chunk_list = [
+            target_list[index: index + TARGET_CHUNK_SIZE]
+            for index in range(0, len(target_list), TARGET_CHUNK_SIZE)
+        ]
+        if not target_chunk_list:
+            return []
+        with ThreadPoolExecutor(
+                max_workers=min(TARGET_MUTATION_MAX_WORKERS, len(target_chunk_list))
+        ) as executor:
+            succeeded_target_chunk_list = executor.map(
+                lambda target_chunk: self._mutate_target_chunk(
+                    api_call, tg_arn, target_chunk, metric_recorder
+                ),
+                target_chunk_list,
+            )
+            return [target for target_chunk in succeeded_target_chunk_list for target in target_chunk]
+
+    def register_target(self, tg_arn, new_target_list, metric_recorder=None):
+        """
+        Register given targets to the given target group
+        :param tg_arn: ARN of target group
+        :param new_target_list: list of targets
+        :param metric_recorder: records the retry count
+        :return: list of targets that were registered
+        """
+        logger.info(f"Register new_target_list:{new_target_list}")
+        registered_target_list = self._mutate_target(
+            self.elbv2.register_targets, tg_arn, new_target_list, metric_recorder
+        )
+        logger.info(
+            f"Registered {len(registered_target_list)} of {len(new_target_list)} targets"
+        )
+        return registered_target_list
 
-    def deregister_target(self, tg_arn, new_target_list):
+    def deregister_target(self, tg_arn, new_target_list, metric_recorder=None):
         """
         Deregister given targets to the given target group
         :param tg_arn: ARN of target group
         :param new_target_list: list of targets
+        :param metric_recorder: records the retry count
+        :return: list of targets that were deregistered
         """
         logger.info(f"Deregistering targets: {new_target_list}")
-        try:
-            self.elbv2.deregister_targets(
-                TargetGroupArn=tg_arn, Targets=new_target_list
-            )
-        except ClientError as e:
-            logger.exception(
-                f"Failed to deregister target to target group. "
-                f"Targets: {new_target_list}. Target group: {tg_arn}"
-            )
+        deregistered_target_list = self._mutate_target(
+            self.elbv2.deregister_targets, tg_arn, new_target_list, metric_recorder
+        )
+        logger.info(
+            f"Deregistered {len(deregistered_target_list)} of {len(new_target_list)} targets"
+        )
+        return deregistered_target_list
 
-    def get_ip_target_list_by_target_group_arn(self, tg_arn):
+    def get_target_group_snapshot(self, tg_arn, metric_recorder=None):
         """
-        Get a list of IP targets that are registered with the given target group
+        Get the targets that are registered with the given target group and their health state.
+        DescribeTargetHealth returns every target of the target group in one response (it has no pagination).
+        Errors are raised, as an empty snapshot would deregister and re-register every target of the target group
         :param tg_arn: ARN of target group
-        :return: list of target IP
+        :param metric_recorder: records the retry count
+        :return: TargetGroupSnapshot
         """
-        registered_ip_list = []
-        try:
-            response = self.elbv2.describe_target_health(TargetGroupArn=tg_arn)
-            for target in response["TargetHealthDescriptions"]:
-                registered_ip_list.append(target["Target"]["Id"])
-        except ClientError:
-            logger.exception(f"Failed to get target list from target group - {tg_arn}")
-
+        response = self._call_with_retry(
+            self.elbv2.describe_target_health, metric_recorder, TargetGroupArn=tg_arn
+        )
+        target_group_snapshot = TargetGroupSnapshot(tg_arn, response["TargetHealthDescriptions"])
         logger.info(
-            f"ELB IPs that are currently registered with the target group: {registered_ip_list}. "
-            f"Total IP count: {len(registered_ip_list)}"
+            f"ELB IPs that are currently registered with the target group: {target_group_snapshot.ip_set}. "
+            f"Total IP count: {len(target_group_snapshot.ip_set)}. "
+            f"Target count by state: {target_group_snapshot.get_target_count_by_state()}"
         )
-        return registered_ip_list
+        return target_group_snapshot
+
+    def find_load_balancer(self, alb_dns_name):
+        """
+        Find the ALB by its DNS name, which is lower case while the ALB name may not be. The first lookup pages
+        through the load balancers of the region. The ARN of the ALB is cached, so later lookups describe it by ARN
+        :param alb_dns_name: DNS name of ALB
+        :return: load balancer description. None when no ALB has the DNS name
+        """
+        cache_key = (self.region, alb_dns_name.lower())
+        load_balancer_arn = _load_balancer_arn_cache.get(cache_key)
+        if load_balancer_arn:
+            try:
+                response = self._call_with_retry(
+                    self.elbv2.describe_load_balancers, LoadBalancerArns=[load_balancer_arn]
+                )
+                return response["LoadBalancers"][0]
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "LoadBalancerNotFound":
+                    raise
+                logger.info(f"ALB ({load_balancer_arn}) no longer exists. Find {alb_dns_name} again")
+                _load_balancer_arn_cache.pop(cache_key, None)
+
+        describe_kwargs = {}
+        while True:
+            response = self._call_with_retry(self.elbv2.describe_load_balancers, **describe_kwargs)
+            load_balancer = next(
+                (
+                    load_balancer
+                    for load_balancer in response["LoadBalancers"]
+                    if load_balancer["DNSName"].lower() == alb_dns_name.lower()
+                ),
+                None,
+            )
+            if load_balancer is not None:
+                _load_balancer_arn_cache[cache_key] = load_balancer["LoadBalancerArn"]
+                return load_balancer
+            if not response.get("NextMarker"):
+                return None
+            describe_kwargs["Marker"] = response["NextMarker"]
+
+    def get_load_balancer_subnet_list(self, alb_dns_name):
+        """
+        Get the subnets of the given ALB with their Availability Zone and CIDR blocks
+        :param alb_dns_name: DNS name of ALB
+        :return: list of subnets. Empty when the ALB or its subnets cannot be read. e.g.
+        [{"SubnetId": "subnet-1", "AvailabilityZone": "us-east-1a", "CidrBlockList": ["10.0.0.0/24", "2600:1f18::/64"]}]
+        """
+        try:
+            load_balancer = self.find_load_balancer(alb_dns_name)
+            if load_balancer is None:
+                logger.warning(f"ALB not found - {alb_dns_name}")
+                return []
+
+            response = self._call_with_retry(
+                self.ec2.describe_subnets,
+                SubnetIds=[
+                    availability_zone["SubnetId"] for availability_zone in load_balancer["AvailabilityZones"]
+                ],
+            )
+        except (ClientError, BotoCoreError):
+            # e.g. a VPC without an EC2 endpoint. The DNS sampling goes on without the Availability Zones
+            logger.exception(f"Failed to get the subnets of ALB - {alb_dns_name}")
+            return []
+
+        subnet_list = [
+            {
+                "SubnetId": subnet["SubnetId"],
+                "AvailabilityZone": subnet["AvailabilityZone"],
+                "CidrBlockList": [subnet["CidrBlock"]] + [
+                    ipv6_cidr_block_association["Ipv6CidrBlock"]
+                    for ipv6_cidr_block_association in subnet.get("Ipv6CidrBlockAssociationSet", [])
+                    if ipv6_cidr_block_association["Ipv6CidrBlockState"]["State"] == "associated"
+                ],
+            }
+            for subnet in response["Subnets"]
+        ]
+        logger.info(f"Subnets of ALB ({alb_dns_name}): {subnet_list}")
+        return subnet_list
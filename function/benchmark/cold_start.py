@@ -0,0 +1,95 @@
+"""
+Measure the cold start cost of the Lambda function: how long it takes to import the handler module,
+to build AwsServices and its boto3 clients, and to import the DNS stack on first lookup.
+Every run starts a fresh Python interpreter, like a new Lambda execution environment does.
+
+Usage (from the function directory):
+    python benchmark/cold_start.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FUNCTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuration of the benchmark. Nothing is sent to AWS
+BENCHMARK_ENV = {
+    "ALB_DNS_NAME": "internal-alb.us-east-1.elb.amazonaws.com",
+    "ALB_LISTENER": "443",
+    "NLB_TG_ARN": "arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/tg/0123456789abcdef",
+    "S3_BUCKET": "benchmark-bucket",
+    "MAX_LOOKUP_PER_INVOCATION": "50",
+    "INVOCATIONS_BEFORE_DEREGISTRATION": "3",
+    "CW_METRIC_FLAG_IP_COUNT": "true",
+    "AWS_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+}
+
+# Runs in the fresh interpreter and prints the timings (ms) as JSON
+MEASURE_SCRIPT = """
+import json
+import time
+
+timing = {}
+start = time.perf_counter()
+import populate_NLB_TG_with_ALB
+timing["handler_import_ms"] = (time.perf_counter() - start) * 1000
+
+from aws_services import AwsServices
+from constant import Config
+start = time.perf_counter()
+aws_service = AwsServices.from_config(Config.from_environment())
+timing["aws_services_init_ms"] = (time.perf_counter() - start) * 1000
+start = time.perf_counter()
+aws_service.s3_client, aws_service.cw, aws_service.elbv2
+timing["client_init_ms"] = (time.perf_counter() - start) * 1000
+
+start = time.perf_counter()
+import dns.resolver
+import dns_sampler
+timing["dns_import_ms"] = (time.perf_counter() - start) * 1000
+print(json.dumps(timing))
+"""
+
+
+def measure_once():
+    """
+    Measure one cold start in a fresh interpreter
+    :return: dict of timing name to milliseconds
+    """
+    env = dict(os.environ, PYTHONPATH=FUNCTION_DIR, **BENCHMARK_ENV)
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT],
+        cwd=FUNCTION_DIR,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10, help="number of cold starts to measure")
+    args = parser.parse_args()
+
+    # The first run warms the bytecode cache of the interpreter's own modules
+    measure_once()
+    timing_list = [measure_once() for _ in range(args.runs)]
+    print(f"Cold start over {args.runs} runs (ms)")
+    print(f"{'':<22}{'median':>10}{'min':>10}{'max':>10}")
+    for timing_name in timing_list[0]:
+        value_list = [timing[timing_name] for timing in timing_list]
+        print(
+            f"{timing_name:<22}{statistics.median(value_list):>10.1f}"
+            f"{min(value_list):>10.1f}{max(value_list):>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+"""
+Offline simulation of the Lambda function against scripted ALB scale-out and scale-in scenarios.
+A fake authoritative name server on localhost answers every DNS query with up to 8 IPs picked at random
+from the current ALB node population, like Route 53 does. S3, ELBv2 and CloudWatch are in-memory stand-ins.
+lambda_handler is invoked once per simulated minute and the target group is compared with the ALB node population.
+The simulation is deterministic for a given seed and sends no request to AWS.
+
+Usage (from the function directory):
+    python benchmark/simulate.py [--scenario scale_out] [--minutes 15] [--seed 1] [--stop-policy coverage]
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from unittest.mock import patch
+
+FUNCTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FUNCTION_DIR)
+
+SIMULATION_ALB_DNS_NAME = "internal-sim-alb-1234567890.us-east-1.elb.amazonaws.com"
+SIMULATION_ALB_ARN = "arn:aws:elasticloadbalancing:us-east-1:123456789012:loadbalancer/app/sim-alb/1234567890abcdef"
+SIMULATION_NLB_TG_ARN = "arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/sim-tg/0123456789abcdef"
+SIMULATION_REGION = "us-east-1"
+SIMULATION_BUCKET = "simulation-bucket"
+import dns.message  # noqa: E402
+import dns.rrset  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+
+import availability_zone  # noqa: E402
+import aws_services  # noqa: E402
+import convergence  # noqa: E402
+from constant import Config  # noqa: E402
+from populate_NLB_TG_with_ALB import reconcile_event  # noqa: E402
+
+# Max number of records in one Route 53 answer for an ELB
+MAX_RECORD_COUNT_PER_RESPONSE = 8
+# Simulated minutes that a deregistered target stays draining (deregistration delay)
+DRAINING_MINUTES = 5
+# Subnets of the ALB: (subnet ID, Availability Zone, CIDR block)
+SIMULATION_SUBNET_LIST = [
+    ("subnet-a", "us-east-1a", "10.0.0.0/24"),
+    ("subnet-b", "us-east-1b", "10.0.1.0/24"),
+    ("subnet-c", "us-east-1c", "10.0.2.0/24"),
+]
+# Epoch seconds of the first simulated minute
+SIMULATION_START_TIME = 1621294200
+STOP_POLICY_CLASS = {
+    "coverage": convergence.CoverageStopPolicy,
+    "stable": convergence.StableLookupStopPolicy,
+    "complete": convergence.CompleteResponseStopPolicy,
+}
+
+
+def get_node_ip_list(first_node_index, node_count):
+    """
+    :param first_node_index: index of the first ALB node
+    :param node_count: number of ALB nodes
+    :return: list of ALB node IPs. The same index always maps to the same IP. The nodes are spread round-robin
+    across the ALB subnets
+    """
+    return [
+        f"10.0.{node_index % len(SIMULATION_SUBNET_LIST)}.{node_index // len(SIMULATION_SUBNET_LIST) + 1}"
+        for node_index in range(first_node_index, first_node_index + node_count)
+    ]
+
+
+# Scenario name: (description, ALB node population per simulated minute)
+SCENARIOS = {
+    "steady": ("6 nodes", lambda minute: get_node_ip_list(0, 6)),
+    "scale_out": (
+        "4 nodes, 12 from minute 3",
+        lambda minute: get_node_ip_list(0, 4 if minute < 3 else 12),
+    ),
+    "scale_in": (
+        "12 nodes, 4 from minute 3",
+        lambda minute: get_node_ip_list(0, 12 if minute < 3 else 4),
+    ),
+    "node_replacement": (
+        "6 nodes, replaced one per minute from minute 3",
+        lambda minute: get_node_ip_list(min(max(minute - 2, 0), 6), 6),
+    ),
+    "large": ("40 nodes", lambda minute: get_node_ip_list(0, 40)),
+}
+
+
+def make_client_error(code, http_status_code):
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": code},
+            "ResponseMetadata": {"HTTPStatusCode": http_status_code},
+        },
+        "simulated_operation",
+    )
+
+
+class FakeAuthoritativeNameServer:
+    """
+    Answers A queries on a localhost UDP port with up to 8 IPs picked at random from the ALB node population
+    """
+
+    def __init__(self, domain_name, seed):
+        self.domain_name = domain_name
+        self.ip_population = []
+        self.random = random.Random(seed)
+        self.query_count = 0
+        self.lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                (query_wire, source) = self.socket.recvfrom(512)
+            except OSError:
+                return
+            response = dns.message.make_response(dns.message.from_wire(query_wire))
+            with self.lock:
+                self.query_count += 1
+                ip_list = self.random.sample(
+                    self.ip_population,
+                    min(MAX_RECORD_COUNT_PER_RESPONSE, len(self.ip_population)),
+                )
+            if ip_list:
+                response.answer.append(
+                    dns.rrset.from_text_list(self.domain_name + ".", 60, "IN", "A", ip_list)
+                )
+            try:
+                self.socket.sendto(response.to_wire(), source)
+            except OSError:
+                return
+
+    def close(self):
+        self.socket.close()
+
+
+class FakeS3Client:
+    """
+    In-memory S3 bucket with ETags and conditional GET and PUT
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.version = 0
+        self.api_call_count = Counter()
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        with self.lock:
+            self.api_call_count["GetObject"] += 1
+            if Key not in self.objects:
+                raise make_client_error("NoSuchKey", 404)
+            (etag, body) = self.objects[Key]
+            if IfNoneMatch == etag:
+                raise make_client_error("304", 304)
+            return {"ETag": etag, "Body": io.BytesIO(body)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        with self.lock:
+            self.api_call_count["PutObject"] += 1
+            current_etag = self.objects.get(Key, (None, None))[0]
+            if (IfMatch and IfMatch != current_etag) or (IfNoneMatch == "*" and current_etag):
+                raise make_client_error("PreconditionFailed", 412)
+            self.version += 1
+            etag = f'"{self.version}"'
+            self.objects[Key] = (etag, Body.encode() if isinstance(Body, str) else Body)
+            return {"ETag": etag}
+
+
+class FakeElbv2Client:
+    """
+    In-memory target groups. A new target is initial for one minute and then healthy, or unhealthy when its IP
+    is no longer an ALB node. A deregistered target drains for DRAINING_MINUTES
+    """
+
+    def __init__(self):
+        # Target group ARN: {(IP, port): [state, minute of the last state change]}
+        self.target_groups = {}
+        self.minute = 0
+        self.api_call_count = Counter()
+        self.lock = threading.Lock()
+
+    def tick(self, minute, ip_population):
+        with self.lock:
+            self.minute = minute
+            for target_state in self.target_groups.values():
+                for (target_key, (state, since_minute)) in list(target_state.items()):
+                    if state == "draining":
+                        if minute - since_minute >= DRAINING_MINUTES:
+                            del target_state[target_key]
+                    elif target_key[0] not in ip_population:
+                        target_state[target_key] = ["unhealthy", minute]
+                    elif state == "initial" and minute > since_minute:
+                        target_state[target_key] = ["healthy", minute]
+
+    def get_registered_ip_set(self, tg_arn):
+        with self.lock:
+            return {
+                ip
+                for ((ip, _), (state, _)) in self.target_groups.get(tg_arn, {}).items()
+                if state != "draining"
+            }
+
+    def describe_load_balancers(self, **kwargs):
+        with self.lock:
+            self.api_call_count["DescribeLoadBalancers"] += 1
+            return {
+                "LoadBalancers": [
+                    {
+                        "LoadBalancerArn": SIMULATION_ALB_ARN,
+                        "DNSName": SIMULATION_ALB_DNS_NAME,
+                        "AvailabilityZones": [
+                            {"ZoneName": zone_name, "SubnetId": subnet_id}
+                            for (subnet_id, zone_name, _) in SIMULATION_SUBNET_LIST
+                        ],
+                    }
+                ]
+            }
+
+    def describe_target_health(self, TargetGroupArn):
+        with self.lock:
+            self.api_call_count["DescribeTargetHealth"] += 1
+            return {
+                "TargetHealthDescriptions": [
+                    {"Target": {"Id": ip, "Port": port}, "TargetHealth": {"State": state}}
+                    for ((ip, port), (state, _)) in self.target_groups.get(TargetGroupArn, {}).items()
+                ]
+            }
+
+    def register_targets(self, TargetGroupArn, Targets):
+        with self.lock:
+            self.api_call_count["RegisterTargets"] += 1
+            target_state = self.target_groups.setdefault(TargetGroupArn, {})
+            for target in Targets:
+                target_key = (target["Id"], target["Port"])
+                if target_state.get(target_key, ["draining"])[0] == "draining":
+                    target_state[target_key] = ["initial", self.minute]
+
+    def deregister_targets(self, TargetGroupArn, Targets):
+        with self.lock:
+            self.api_call_count["DeregisterTargets"] += 1
+            target_state = self.target_groups.setdefault(TargetGroupArn, {})
+            for target in Targets:
+                target_key = (target["Id"], target["Port"])
+                if target_key in target_state:
+                    target_state[target_key] = ["draining", self.minute]
+
+
+class FakeEc2Client:
+    def __init__(self):
+        self.api_call_count = Counter()
+
+    def describe_subnets(self, SubnetIds):
+        self.api_call_count["DescribeSubnets"] += 1
+        return {
+            "Subnets": [
+                {"SubnetId": subnet_id, "AvailabilityZone": zone_name, "CidrBlock": cidr_block}
+                for (subnet_id, zone_name, cidr_block) in SIMULATION_SUBNET_LIST
+                if subnet_id in SubnetIds
+            ]
+        }
+
+
+class SimulatedClock:
+    """
+    Stand-in for the time module of the Lambda function. time() returns the epoch seconds of the simulated minute,
+    so the IP lifecycle ages one minute per invocation. Everything else is the real time module
+    """
+
+    def __init__(self):
+        self.minute = 0
+
+    def time(self):
+        return SIMULATION_START_TIME + self.minute * 60
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FakeCloudWatchClient:
+    def __init__(self):
+        self.api_call_count = Counter()
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.api_call_count["PutMetricData"] += 1
+
+
+def get_convergence_minute_count(population_per_minute, is_converged_per_minute):
+    """
+    :param population_per_minute: list of ALB node IP sets per minute
+    :param is_converged_per_minute: list of boolean values per minute
+    :return: number of invocations after the last population change until the target group converged for good.
+    None when it never did
+    """
+    last_change_minute = max(
+        [
+            minute
+            for minute in range(1, len(population_per_minute))
+            if population_per_minute[minute] != population_per_minute[minute - 1]
+        ],
+        default=0,
+    )
+    for minute in range(last_change_minute, len(is_converged_per_minute)):
+        if all(is_converged_per_minute[minute:]):
+            return minute - last_change_minute + 1
+    return None
+
+
+def run_scenario(
+        scenario_name,
+        minutes=15,
+        seed=1,
+        stop_policy="coverage",
+        max_lookup_per_invocation=50,
+        deregistration_confidence=0.01,
+        deregistration_delay=0,
+        state_encoding="json",
+):
+    """
+    Run one scenario
+    :param scenario_name: key of SCENARIOS
+    :param minutes: number of simulated minutes (one invocation per minute)
+    :param seed: seed of the fake name server
+    :param stop_policy: key of STOP_POLICY_CLASS. Decides when DNS sampling stops
+    :param max_lookup_per_invocation: MAX_LOOKUP_PER_INVOCATION
+    :param deregistration_confidence: DEREGISTRATION_CONFIDENCE
+    :param deregistration_delay: DEREGISTRATION_DELAY in seconds
+    :param state_encoding: STATE_ENCODING
+    :return: dict of the scenario result
+    """
+    (_, get_ip_population) = SCENARIOS[scenario_name]
+    name_server = FakeAuthoritativeNameServer(SIMULATION_ALB_DNS_NAME, seed)
+    s3_client = FakeS3Client()
+    elbv2_client = FakeElbv2Client()
+    cw_client = FakeCloudWatchClient()
+    ec2_client = FakeEc2Client()
+    clock = SimulatedClock()
+    config = Config({
+        "ALB_DNS_NAME": SIMULATION_ALB_DNS_NAME,
+        "ALB_LISTENER": 443,
+        "NLB_TG_ARN": SIMULATION_NLB_TG_ARN,
+        "S3_BUCKET": SIMULATION_BUCKET,
+        "AWS_REGION": SIMULATION_REGION,
+        "MAX_LOOKUP_PER_INVOCATION": max_lookup_per_invocation,
+        "DEREGISTRATION_CONFIDENCE": deregistration_confidence,
+        "DEREGISTRATION_DELAY": deregistration_delay,
+        "STATE_ENCODING": state_encoding,
+        "CW_METRIC_FLAG_IP_COUNT": False,
+    })
+    client_cache = {
+        ("s3", SIMULATION_REGION): s3_client,
+        ("elbv2", SIMULATION_REGION): elbv2_client,
+        ("cloudwatch", SIMULATION_REGION): cw_client,
+        ("ec2", SIMULATION_REGION): ec2_client,
+    }
+
+    population_per_minute = []
+    missing_ip_minute_count = 0
+    stale_ip_minute_count = 0
+    is_registered_per_minute = []
+    is_deregistered_per_minute = []
+    failed_invocation_count = 0
+    logger = logging.getLogger()
+    log_level = logger.level
+    logger.setLevel(logging.ERROR)
+    start_time = time.perf_counter()
+    try:
+        with patch.dict(
+                aws_services._client_cache, client_cache, clear=True
+        ), patch.dict(aws_services._s3_object_cache, clear=True), patch.dict(
+            aws_services._load_balancer_arn_cache, clear=True
+        ), patch.dict(
+            availability_zone._availability_zone_map_cache, clear=True
+        ), patch(
+            "common.get_elb_authoritative_name_server_ip_list", return_value=["127.0.0.1"]
+        ), patch(
+            "dns_sampler.DNS_PORT", name_server.port
+        ), patch(
+            "common.CoverageStopPolicy", STOP_POLICY_CLASS[stop_policy]
+        ), patch(
+            "populate_NLB_TG_with_ALB.time", clock
+        ):
+            for minute in range(minutes):
+                ip_population = set(get_ip_population(minute))
+                population_per_minute.append(ip_population)
+                clock.minute = minute
+                with name_server.lock:
+                    name_server.ip_population = sorted(ip_population)
+                elbv2_client.tick(minute, ip_population)
+                try:
+                    reconcile_event(config, {}, None)
+                except SystemExit:
+                    failed_invocation_count += 1
+                registered_ip_set = elbv2_client.get_registered_ip_set(SIMULATION_NLB_TG_ARN)
+                missing_ip_minute_count += len(ip_population - registered_ip_set)
+                stale_ip_minute_count += len(registered_ip_set - ip_population)
+                is_registered_per_minute.append(ip_population <= registered_ip_set)
+                is_deregistered_per_minute.append(registered_ip_set <= ip_population)
+    finally:
+        logger.setLevel(log_level)
+        name_server.close()
+
+    api_call_count = (
+            s3_client.api_call_count
+            + elbv2_client.api_call_count
+            + cw_client.api_call_count
+            + ec2_client.api_call_count
+    )
+    return {
+        "Scenario": scenario_name,
+        "RegistrationConvergenceMinutes": get_convergence_minute_count(
+            population_per_minute, is_registered_per_minute
+        ),
+        "DeregistrationConvergenceMinutes": get_convergence_minute_count(
+            population_per_minute, is_deregistered_per_minute
+        ),
+        "MissingIPMinutes": missing_ip_minute_count,
+        "StaleIPMinutes": stale_ip_minute_count,
+        "DnsQueryCount": name_server.query_count,
+        "ApiCallCount": dict(api_call_count),
+        "FailedInvocationCount": failed_invocation_count,
+        "WallTimeSeconds": round(time.perf_counter() - start_time, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="scenario to run. Can be given more than once. Default: every scenario")
+    parser.add_argument("--minutes", type=int, default=15, help="simulated minutes per scenario")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the fake name server")
+    parser.add_argument("--stop-policy", choices=sorted(STOP_POLICY_CLASS), default="coverage",
+                        help="DNS sampling stop policy")
+    parser.add_argument("--max-lookups", type=int, default=50, help="MAX_LOOKUP_PER_INVOCATION")
+    parser.add_argument("--deregistration-confidence", type=float, default=0.01,
+                        help="DEREGISTRATION_CONFIDENCE")
+    parser.add_argument("--deregistration-delay", type=int, default=0, help="DEREGISTRATION_DELAY in seconds. 0: the default")
+    parser.add_argument("--state-encoding", choices=["json", "binary"], default="json", help="STATE_ENCODING")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    result_list = [
+        run_scenario(
+            scenario_name,
+            minutes=args.minutes,
+            seed=args.seed,
+            stop_policy=args.stop_policy,
+            max_lookup_per_invocation=args.max_lookups,
+            deregistration_confidence=args.deregistration_confidence,
+            deregistration_delay=args.deregistration_delay,
+            state_encoding=args.state_encoding,
+        )
+        for scenario_name in args.scenario or SCENARIOS
+    ]
+    if args.json:
+        print(json.dumps(result_list, indent=2))
+        return
+    print(f"{'scenario':<18}{'reg min':>8}{'dereg min':>10}{'missing':>9}{'stale':>7}"
+          f"{'dns':>7}{'api':>6}{'failed':>8}{'wall s':>8}")
+    for result in result_list:
+        print(
+            f"{result['Scenario']:<18}"
+            f"{str(result['RegistrationConvergenceMinutes']):>8}"
+            f"{str(result['DeregistrationConvergenceMinutes']):>10}"
+            f"{result['MissingIPMinutes']:>9}{result['StaleIPMinutes']:>7}"
+            f"{result['DnsQueryCount']:>7}{sum(result['ApiCallCount'].values()):>6}"
+            f"{result['FailedInvocationCount']:>8}{result['WallTimeSeconds']:>8}"
+        )
+    print("reg/dereg min: invocations after the last ALB change until every node is registered / every stale IP is "
+          "deregistered. missing/stale: IP-minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Command line entry point of the reconciler. It runs the same reconcile engine as the Lambda function outside of
+Lambda. e.g. as a long-lived daemon or a container sidecar
+
+run: run one reconcile pass of every mapping, like a scheduled invocation of the Lambda function
+daemon: run a reconcile pass every --interval seconds until SIGTERM or SIGINT. The AWS clients, the DNS samplers
+and their sockets are kept between the passes
+plan: print the reconcile plan (the IPs to register and deregister, the pending counts and the DNS sampling
+statistics) of the configured mappings as JSON. Nothing is registered, deregistered, uploaded to S3 or published
+to CloudWatch
+
+The configuration is read from the same environment variables as the Lambda function, then from the JSON object
+of --config (keyed by the environment variable names) and then from every --set NAME=VALUE. A later one wins. e.g.
+
+    AWS_REGION=us-east-1 S3_BUCKET=my-bucket MAX_LOOKUP_PER_INVOCATION=50 CW_METRIC_FLAG_IP_COUNT=false \\
+    ALB_DNS_NAME=internal-my-alb-1234567890.us-east-1.elb.amazonaws.com ALB_LISTENER=443 NLB_TG_ARN=arn:... \\
+    python cli.py plan
+
+    python cli.py daemon --config reconciler.json --set RECONCILE_LOOP_INTERVAL=30
+"""
+import argparse
+import json
+import math
+import os
+import signal
+import sys
+import threading
+import time
+
+from constant import CONFIG_VARIABLE_LIST, Config
+
+# Seconds between two reconcile passes of the daemon when RECONCILE_LOOP_INTERVAL is not configured
+DEFAULT_DAEMON_INTERVAL = 60
+
+
+def positive_int(value):
+    """
+    argparse type of a positive number of seconds
+    :param value: argument value
+    :return: int
+    """
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def load_config(args):
+    """
+    Build the configuration from the environment variables, the configuration file and the --set flags
+    :param args: parsed arguments
+    :return: Config
+    """
+    value_per_variable = {
+        variable: os.environ[variable]
+        for (_, variable, _, _) in CONFIG_VARIABLE_LIST
+        if variable in os.environ
+    }
+    if args.config:
+        with open(args.config) as config_file:
+            file_value_per_variable = json.load(config_file)
+        if not isinstance(file_value_per_variable, dict):
+            raise ValueError(f"{args.config} is required to be a JSON object")
+        # TARGET_MAPPINGS may be written as a JSON list in the file
+        if not isinstance(file_value_per_variable.get("TARGET_MAPPINGS", ""), str):
+            file_value_per_variable["TARGET_MAPPINGS"] = json.dumps(file_value_per_variable["TARGET_MAPPINGS"])
+        value_per_variable.update(file_value_per_variable)
+    for assignment in args.set:
+        (variable, separator, value) = assignment.partition("=")
+        if not separator:
+            raise ValueError(f"--set is required to be NAME=VALUE: {assignment}")
+        value_per_variable[variable] = value
+    return Config(value_per_variable)
+
+
+def run_command(args, config):
+    """
+    Run one reconcile pass of every mapping
+    :param args: parsed arguments
+    :param config: Config
+    :return: exit status. 1 when an ALB has no IP in the DNS or a mapping failed to reconcile
+    """
+    from populate_NLB_TG_with_ALB import reconcile_event
+
+    event = {"AlbDnsName": args.alb_dns_name} if args.alb_dns_name else {}
+    try:
+        reconcile_event(config, event, None)
+    except SystemExit as e:
+        return e.code
+    return 0
+
+
+def daemon_command(args, config):
+    """
+    Run a reconcile pass every interval until SIGTERM or SIGINT
+    :param args: parsed arguments
+    :param config: Config
+    :return: exit status. 1 when a pass failed
+    """
+    from aws_services import AwsServices
+    from populate_NLB_TG_with_ALB import (
+        run_reconcile_passes,
+        validate_environment_variable,
+    )
+
+    if args.interval is not None:
+        config.RECONCILE_LOOP_INTERVAL = args.interval
+    elif not config.RECONCILE_LOOP_INTERVAL:
+        config.RECONCILE_LOOP_INTERVAL = DEFAULT_DAEMON_INTERVAL
+    if config.RECONCILE_LOOP_INTERVAL <= 0:
+        args.parser.error(
+            f"RECONCILE_LOOP_INTERVAL is required to be a positive number: {config.RECONCILE_LOOP_INTERVAL}"
+        )
+    reconcile_target_list = validate_environment_variable(config)
+    aws_service = AwsServices.from_config(config)
+
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: stop_event.set())
+    # RECONCILE_LOOP_DURATION bounds the daemon as well. e.g. to restart it periodically
+    loop_deadline = math.inf
+    if config.RECONCILE_LOOP_DURATION:
+        loop_deadline = time.monotonic() + config.RECONCILE_LOOP_DURATION
+    is_failed = run_reconcile_passes(config, aws_service, reconcile_target_list, set(), loop_deadline, stop_event)
+    return 1 if is_failed else 0
+
+
+def plan_command(args, config):
+    """
+    Run a dry run of the reconciler and print its plan
+    :param args: parsed arguments
+    :param config: Config
+    :return: exit status. 1 when an ALB has no IP in the DNS or a mapping failed to plan
+    """
+    from populate_NLB_TG_with_ALB import reconcile_event
+
+    event = {"DryRun": True}
+    if args.alb_dns_name:
+        event["AlbDnsName"] = args.alb_dns_name
+    result = reconcile_event(config, event, None)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return 1 if result["IsFailed"] else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument(
+        "--config", help="JSON file of the configuration, keyed by the environment variable names"
+    )
+    config_parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="set one configuration value. e.g. --set MAX_LOOKUP_PER_INVOCATION=50",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", parents=[config_parser], help="run one reconcile pass")
+    run_parser.add_argument("--alb-dns-name", help="only reconcile the mappings of this ALB. Default: every mapping")
+    run_parser.set_defaults(handler=run_command, parser=run_parser)
+    daemon_parser = subparsers.add_parser(
+        "daemon", parents=[config_parser], help="run a reconcile pass every interval until stopped"
+    )
+    daemon_parser.add_argument(
+        "--interval",
+        type=positive_int,
+        help=f"seconds between the start of two passes. Default: RECONCILE_LOOP_INTERVAL, or "
+        f"{DEFAULT_DAEMON_INTERVAL}",
+    )
+    daemon_parser.set_defaults(handler=daemon_command, parser=daemon_parser)
+    plan_parser = subparsers.add_parser(
+        "plan", parents=[config_parser], help="print the reconcile plan without changing anything"
+    )
+    plan_parser.add_argument("--alb-dns-name", help="only plan the mappings of this ALB. Default: every mapping")
+    plan_parser.set_defaults(handler=plan_command, parser=plan_parser)
+    args = parser.parse_args(argv)
+    try:
+        return args.handler(args, load_config(args))
+    except ValueError as e:
+        # An invalid configuration is a usage error (exit status 2), not a traceback
+        args.parser.error(str(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
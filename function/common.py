@@ -1,12 +1,35 @@
+import ipaddress
 import logging
-import dns.resolver
-from collections import defaultdict
-from constant import LambdaEnv
+import threading
+import time
+from convergence import CoverageStopPolicy
+from metrics import MetricRecorder
 
 # Timeout on one NS
 DNS_RESOLVER_TIMEOUT = 1
 # Timeout through out all of the NS
 DNS_RESOLVER_LIFETIME = 10
+# Max number of DNS lookups in flight at the same time (one burst)
+DNS_SAMPLING_BURST_SIZE = 8
+# Wall-clock budget (in seconds) for sampling ELB IPs from DNS per invocation
+DNS_SAMPLING_TIME_BUDGET = 30
+# Max number of answers kept by the default resolver cache
+DNS_RESOLVER_CACHE_SIZE = 1000
+# DNS record type of the ALB node IPs per IP version. A dualstack ALB has both
+RECORD_TYPE_PER_IP_VERSION = {4: "A", 6: "AAAA"}
+IP_VERSION_PER_RECORD_TYPE = {
+    record_type: ip_version for (ip_version, record_type) in RECORD_TYPE_PER_IP_VERSION.items()
+}
+# Description of the network interfaces of an ALB node. e.g. ELB app/my-alb/50dc6c495c0c9188
+ALB_ENI_DESCRIPTION_PREFIX = "ELB app/"
+# DNS name prefix of an internal ALB. e.g. internal-my-alb-1234567890.us-east-1.elb.amazonaws.com
+INTERNAL_ALB_DNS_NAME_PREFIX = "internal-"
+
+# Resolvers are reused across warm Lambda invocations. Keyed by name server IP (None for the default resolver)
+_resolver_pool = {}
+_resolver_pool_lock = threading.Lock()
+# DNS samplers are not thread-safe. Each thread keeps its own
+_thread_local = threading.local()
 
 logger = logging.getLogger()
 if logger.handlers:
@@ -26,6 +49,33 @@ def precondition(pre_condition, error_message):
         raise ValueError(error_message)
 
 
+def get_resolver(nameserver=None):
+    """
+    Get a resolver from the module-level pool, so that it is reused across warm Lambda invocations.
+    The default resolver caches answers (e.g. the ELB authoritative name servers and their IPs) for their TTL.
+    Resolvers bound to a given name server do not cache, so that every lookup samples the name server again.
+    :param nameserver: DNS name server IP address. The default resolver from /etc/resolv.conf is used when not given
+    :return: dns resolver
+    """
+    # dnspython is imported on first use to keep it out of the cold start when no lookup is needed
+    import dns.resolver
+
+    with _resolver_pool_lock:
+        resolver = _resolver_pool.get(nameserver)
+        if resolver is None:
+            if nameserver:
+                resolver = dns.resolver.Resolver(configure=False)
+                resolver.nameservers = [nameserver]
+            else:
+                resolver = dns.resolver.Resolver()
+                resolver.cache = dns.resolver.LRUCache(DNS_RESOLVER_CACHE_SIZE)
+            resolver.rotate = True
+            resolver.timeout = DNS_RESOLVER_TIMEOUT
+            resolver.lifetime = DNS_RESOLVER_LIFETIME
+            _resolver_pool[nameserver] = resolver
+    return resolver
+
+
 def dns_lookup(domain_name, record_type, dns_servers=[]):
     """
     Get dns lookup results
@@ -35,13 +85,11 @@ def dns_lookup(domain_name, record_type, dns_servers=[]):
     :return: list of dns lookup results
     """
     lookup_result_list = []
-    my_resolver = dns.resolver.Resolver()
-    my_resolver.rotate = True
 
     # When no specific DNS name server is given
     if not dns_servers:
         logger.info("No given DNS server")
-        lookup_answers = my_resolver.query(domain_name, record_type)
+        lookup_answers = get_resolver().query(domain_name, record_type)
         lookup_result_list = [str(answer) for answer in lookup_answers]
         return lookup_result_list
 
@@ -49,8 +97,7 @@ def dns_lookup(domain_name, record_type, dns_servers=[]):
     for nameserver in dns_servers.copy():
         try:
             logger.info(f"Given DNS server: {dns_servers}")
-            my_resolver.nameservers = [nameserver]
-            lookup_answers = my_resolver.query(domain_name, record_type)
+            lookup_answers = get_resolver(nameserver).query(domain_name, record_type)
             lookup_result_list = [str(answer) for answer in lookup_answers]
             return lookup_result_list
         except Exception as e:
@@ -62,30 +109,147 @@ def dns_lookup(domain_name, record_type, dns_servers=[]):
             continue
 
 
-def dns_lookup_with_retry(domain_name, record_type, total_retry_count, dns_servers=[]):
+def get_dns_sampler(domain_name, record_type):
+    """
+    Get the DNS sampler (prebuilt query and bound UDP sockets) of the current thread for the given domain name.
+    It is reused across warm Lambda invocations
+    :param domain_name: DNS name
+    :param record_type: DNS record type
+    :return: DNS sampler
+    """
+    from dns_sampler import DnsSampler
+
+    dns_samplers = getattr(_thread_local, "dns_samplers", None)
+    if dns_samplers is None:
+        dns_samplers = _thread_local.dns_samplers = {}
+    dns_sampler = dns_samplers.get((domain_name, record_type))
+    if dns_sampler is None:
+        dns_sampler = dns_samplers[(domain_name, record_type)] = DnsSampler(
+            domain_name, record_type
+        )
+    return dns_sampler
+
+
+def dns_lookup_with_retry(
+        domain_name,
+        record_type,
+        total_retry_count,
+        dns_servers=[],
+        stop_policy=None,
+        metric_recorder=None,
+):
     """
     Get dns lookup results with retry
     :param domain_name:
     :param record_type:
     :param total_retry_count:
     :param dns_servers:
+    :param stop_policy: decides when to stop further DNS lookup. Default: CoverageStopPolicy
+    :param metric_recorder: records the DNS lookup count and the IP count per lookup
     :return:
     """
+    stop_policy = stop_policy or CoverageStopPolicy()
+    metric_recorder = metric_recorder or MetricRecorder({})
     dns_lookup_result_set = set()
     attempt = 1
     while attempt <= total_retry_count:
-        lookup_result_per_attempt = dns_lookup(domain_name, record_type, dns_servers)
+        lookup_result_per_attempt = dns_lookup(domain_name, record_type, dns_servers) or []
         dns_lookup_result_set = set(lookup_result_per_attempt) | dns_lookup_result_set
+        stop_policy.add_sample(lookup_result_per_attempt)
+        metric_recorder.add_count("DnsLookupCount")
+        metric_recorder.put_metric("DnsLookupIPCount", len(set(lookup_result_per_attempt)))
         logger.info(
             f"Attempt-{attempt}: DNS lookup IP count: {len(dns_lookup_result_set)}. "
             f"DNS lookup result: {dns_lookup_result_set}"
         )
-        if len(lookup_result_per_attempt) < 8:
+        if stop_policy.should_stop():
+            logger.info(f"{stop_policy.stop_reason}. Stop further DNS lookup...")
+            break
+        attempt += 1
+    metric_recorder.put_metric("DnsSamplingConfidence", stop_policy.confidence, "None")
+    return dns_lookup_result_set
+
+
+def dns_lookup_concurrently(
+        domain_name,
+        record_type,
+        total_lookup_count,
+        dns_servers,
+        time_budget=DNS_SAMPLING_TIME_BUDGET,
+        stop_policy=None,
+        metric_recorder=None,
+):
+    """
+    Get the union of dns lookup results by sampling the given DNS name servers in parallel.
+    Lookups are pipelined in bursts: each burst sends up to DNS_SAMPLING_BURST_SIZE queries at once over one
+    UDP socket, spread round-robin across the name servers, and takes about one round trip.
+    Sampling stops when one of the following happens:
+    1. total_lookup_count lookups have been sent
+    2. The stop policy decides that enough of the IPs have been seen
+    3. time_budget (in seconds) is used up
+    :param domain_name: DNS name
+    :param record_type: DNS record type
+    :param total_lookup_count: max number of DNS lookups
+    :param dns_servers: list of DNS server IP addresses
+    :param time_budget: wall-clock budget in seconds
+    :param stop_policy: decides when to stop further DNS lookup. Default: CoverageStopPolicy
+    :param metric_recorder: records the DNS lookup counts and the IP count per lookup
+    :return: a set of dns lookup results
+    """
+    stop_policy = stop_policy or CoverageStopPolicy()
+    metric_recorder = metric_recorder or MetricRecorder({})
+    dns_lookup_result_set = set()
+    deadline = time.monotonic() + time_budget
+    dns_sampler = get_dns_sampler(domain_name, record_type)
+    sent_lookup_count = 0
+    completed_lookup_count = 0
+    timeout_lookup_count = 0
+
+    while sent_lookup_count < total_lookup_count:
+        remaining_time = deadline - time.monotonic()
+        if remaining_time <= 0:
             logger.info(
-                "There are less than 8 IPs in the DNS response. Stop further DNS lookup..."
+                f"DNS sampling time budget ({time_budget}s) is used up. Stop further DNS lookup..."
             )
             break
-        attempt += 1
+        burst_nameserver_list = [
+            dns_servers[lookup_index % len(dns_servers)]
+            for lookup_index in range(
+                sent_lookup_count,
+                min(sent_lookup_count + DNS_SAMPLING_BURST_SIZE, total_lookup_count),
+            )
+        ]
+        sent_lookup_count += len(burst_nameserver_list)
+
+        is_converged = False
+        for (nameserver, lookup_result_per_attempt) in dns_sampler.burst(
+                burst_nameserver_list, min(DNS_RESOLVER_TIMEOUT, remaining_time)
+        ):
+            completed_lookup_count += 1
+            dns_lookup_result_set |= set(lookup_result_per_attempt)
+            stop_policy.add_sample(lookup_result_per_attempt, nameserver)
+            metric_recorder.put_metric("DnsLookupIPCount", len(set(lookup_result_per_attempt)))
+            logger.info(
+                f"Attempt-{completed_lookup_count} ({nameserver}): DNS lookup IP count: {len(dns_lookup_result_set)}. "
+                f"DNS lookup result: {dns_lookup_result_set}"
+            )
+            if stop_policy.should_stop():
+                logger.info(f"{stop_policy.stop_reason}. Stop further DNS lookup...")
+                is_converged = True
+                break
+        timeout_lookup_count += dns_sampler.burst_timeout_count
+        if is_converged:
+            break
+
+    logger.info(
+        f"DNS sampling confidence: {stop_policy.confidence:.3f}. "
+        f"Estimated unseen IP count: {stop_policy.estimated_unseen_ip_count:.2f}"
+    )
+    metric_recorder.add_count("DnsLookupCount", completed_lookup_count)
+    # Queries that got no valid response before the deadline of their burst. The queries that are abandoned once
+    # the sampling converged are not timeouts
+    metric_recorder.add_count("DnsLookupTimeoutCount", timeout_lookup_count)
+    metric_recorder.put_metric("DnsSamplingConfidence", stop_policy.confidence, "None")
     return dns_lookup_result_set
 
 
@@ -106,165 +270,133 @@ def get_elb_authoritative_name_server_ip_list(elb_dns_name):
     return authoritative_server_ip_list
 
 
-def get_elb_ip_from_dns(elb_dns_name, record_type, total_retry_count):
+def get_elb_ip_from_dns(
+        elb_dns_name,
+        record_type,
+        total_retry_count,
+        stop_policy=None,
+        metric_recorder=None,
+        availability_zone_map=None,
+        dns_observation=None,
+):
     """
     Get ELB node IP through DNS lookup
     :param elb_dns_name: DNS name of ELB
     :param record_type: DNS record type. e.g. A or AAAA
     :param total_retry_count: Total DNS lookup count
+    :param stop_policy: decides when to stop further DNS lookup. Default: CoverageStopPolicy
+    :param metric_recorder: records the DNS lookup counts and the IP count per lookup
+    :param availability_zone_map: AvailabilityZoneMap of the ELB. When given, sampling goes on until every
+    Availability Zone of the ELB has at least one IP seen (or the lookups or the time budget are used up)
+    :param dns_observation: DnsObservation that collects the sampling confidence and the name server of every IP
     :return: a set of ELB node IP addresses
     """
+    stop_policy = stop_policy or CoverageStopPolicy()
+    metric_recorder = metric_recorder or MetricRecorder({})
+    if availability_zone_map is not None:
+        availability_zone_set = availability_zone_map.get_availability_zone_set(
+            IP_VERSION_PER_RECORD_TYPE[record_type]
+        )
+        if availability_zone_set:
+            stop_policy.require_availability_zone_coverage(
+                availability_zone_set, availability_zone_map.get_availability_zone
+            )
+
     # Get ELB authoritative name server IP addresses
     authoritative_server_ip_list = get_elb_authoritative_name_server_ip_list(
         elb_dns_name
     )
 
-    # Get ELB IP through DNS lookup
-    elb_ip_set = dns_lookup_with_retry(
-        elb_dns_name, record_type, total_retry_count, authoritative_server_ip_list
-    )
-    return elb_ip_set
-
-
-def get_pending_registration_ip_set(
-        ip_from_dns_set, ip_from_target_group_set
-):
-    """
-    # Get a set of IPs that are pending for registration:
-    # Pending registration IPs that meet all the following conditions:
-    # 1. IPs that are currently in the DNS
-    # 2. Those IPs must have not been registered yet
-    :param ip_from_target_group_set: a set of IPs that are currently registered with a target group
-    :param ip_from_dns_set: a set of IPs that are in the DNS
-    """
-
-    pending_registration_ip_set = ip_from_dns_set - ip_from_target_group_set
-    return pending_registration_ip_set
-
-
-def get_invocation_count_per_pending_deregistration_ip(
-        ip_from_dns_set,
-        ip_from_target_group_set,
-        active_ip_set_from_previous_invocation,
-        pending_ip_dict_from_previous_invocation,
-):
-    """
-    Get a mapping of pending deregistration IP and the count of Lambda invocations that this IP has been detected
-    :param ip_from_dns_set: a set of IPs that are in the DNS
-    :param ip_from_target_group_set: a set of IPs that are currently registered with a target group
-    :param active_ip_set_from_previous_invocation:  a set of active IPs from the previous invocation
-    :param pending_ip_dict_from_previous_invocation:  a dict of pending IPs and their invocation count from the previous invocation
-    :return: mapping of pending deregistration IPs and the Lambda invocations count that the IPs have been detected. e.g.
-    {'172.16.2.245': 1, '172.16.3.178': 1}
-    """
-    # Raw pending registration IPs are the ones that: (Without considering INVOCATIONS_BEFORE_DEREGISTRATION)
-    # 1. In the active IP list from the previous invocation but no longer in the DNS
-    # 2. Currently registered but no longer in the DNS
-
-    pending_ip_from_previous_invocation_set = (
-        set(pending_ip_dict_from_previous_invocation.keys())
-        if pending_ip_dict_from_previous_invocation
-        else set()
-    )
-
-    # IPs that are in the active list from the previous invocation while not present in the DNS
-    ip_in_previous_active_ip_not_in_dns = (
-            active_ip_set_from_previous_invocation - ip_from_dns_set
-    )
-    logger.info(
-        f"IPs are previously active but no longer in the DNS: {ip_in_previous_active_ip_not_in_dns}"
-    )
-
-    # IPs that are currently registered but not in the DNS
-    ip_in_target_group_not_in_dns = ip_from_target_group_set - ip_from_dns_set
-    logger.info(
-        f"IPs are currently in the target group but no longer in the DNS: {ip_in_target_group_not_in_dns}"
-    )
-
-    # We keep tracking for how many invocations a pending deregistration IP has been detected.
-    # The deregistration API is only called when the pending IPs's invocation count is higher than INVOCATIONS_BEFORE_DEREGISTRATION
-    invocation_count_per_pending_deregistration_ip = defaultdict(int)
-    pending_ip_from_current_invocation_set = (
-            ip_in_previous_active_ip_not_in_dns | ip_in_target_group_not_in_dns
-    )
-    logger.info(
-        f"Pending deregistration IPs from current invocation (without considering INVOCATIONS_BEFORE_DEREGISTRATION) - "
-        f"{pending_ip_from_current_invocation_set}"
-    )
-
-    if pending_ip_from_previous_invocation_set:
-        new_pending_ip_set = (
-                pending_ip_from_current_invocation_set
-                - pending_ip_from_previous_invocation_set
-        )
-        logger.info(
-            f"IPs that are detected as pending deregistration for the first time - {new_pending_ip_set}"
-        )
-        existing_pending_ip_set = (
-                pending_ip_from_current_invocation_set - new_pending_ip_set
-        )
-        logger.info(
-            f"IPs that have already been detected as pending deregistration from previous invocation - {existing_pending_ip_set}"
+    # When no authoritative name server is found, fall back to sequential lookups through the default resolver
+    if not authoritative_server_ip_list:
+        logger.warning(
+            "No authoritative name server IP found. Fall back to the default DNS resolver"
         )
-        invalid_pending_ip_set = (
-                pending_ip_from_previous_invocation_set
-                - pending_ip_from_current_invocation_set
+        elb_ip_set = dns_lookup_with_retry(
+            elb_dns_name,
+            record_type,
+            total_retry_count,
+            stop_policy=stop_policy,
+            metric_recorder=metric_recorder,
         )
-        logger.info(
-            f"IPs that were detected as pending deregistration but no longer considered as pending - {invalid_pending_ip_set}"
+    else:
+        # Get ELB IP through DNS lookups that run in parallel across the authoritative name servers
+        elb_ip_set = dns_lookup_concurrently(
+            elb_dns_name,
+            record_type,
+            total_retry_count,
+            authoritative_server_ip_list,
+            stop_policy=stop_policy,
+            metric_recorder=metric_recorder,
         )
 
-        # Set the new pending IP invocation count to 1
-        for new_pending_ip in new_pending_ip_set:
-            invocation_count_per_pending_deregistration_ip[new_pending_ip] = 1
-
-        # Increase the invocation count for the IPs that are already in the previous pending IP list
-        for existing_pending_ip in existing_pending_ip_set:
-            invocation_count_per_pending_deregistration_ip[existing_pending_ip] = (
-                    pending_ip_dict_from_previous_invocation[existing_pending_ip] + 1
+    if stop_policy.required_availability_zone_set:
+        unseen_availability_zone_set = stop_policy.unseen_availability_zone_set
+        metric_recorder.put_metric("UnseenAvailabilityZoneCount", len(unseen_availability_zone_set))
+        if unseen_availability_zone_set:
+            logger.warning(
+                f"No IP of ELB ({elb_dns_name}) seen in Availability Zones: {sorted(unseen_availability_zone_set)}"
             )
-
-        return invocation_count_per_pending_deregistration_ip
-
-    logger.info("No pending deregistration IP found from the previous invocations")
-    for pending_ip in pending_ip_from_current_invocation_set:
-        invocation_count_per_pending_deregistration_ip[pending_ip] = 1
-
-    return invocation_count_per_pending_deregistration_ip
-
-
-def get_pending_deregistration_ip_set(
-        invocation_count_per_pending_deregistration_ip, invocation_before_deregistration
-):
-    """
-    Get a set of IPs that are pending deregistration
-    :param invocation_before_deregistration: invocation count that has to be reached first before calling deregistration API
-    :param invocation_count_per_pending_deregistration_ip: mapping of pending deregistration IPs and the Lambda invocations count that the IPs have been detected. e.g.
-    {'172.16.2.245': 1, '172.16.3.178': 1}
-    :return: a set of IPs that are pending deregistration. e.g. {'1.1.1.1', '2.2.2.2'}
-    """
-    pending_deregistration_ip_set = set()
-    for ip, invocation_count in invocation_count_per_pending_deregistration_ip.items():
-        if invocation_count >= invocation_before_deregistration:
-            pending_deregistration_ip_set.add(ip)
-    logger.info(
-        f"Pending deregistration IPs for the current invocation - {pending_deregistration_ip_set}"
-    )
-    return pending_deregistration_ip_set
+    if dns_observation is not None:
+        dns_observation.add_sampling(stop_policy)
+    return elb_ip_set
 
 
-def get_elb_ip_target_from_ip_list(ip_list, elb_listener):
+def get_elb_ip_target_from_ip_list(ip_list, elb_listener, same_vpc=True):
     """
     Get a list of targets for registration or deregistration
     :param ip_list: list of IP
     :param elb_listener: ELB listener port (str)
+    :param same_vpc: False when the ALB is in another VPC than the NLB (SAME_VPC)
     :return: a list of targets required by registration/deregistration API
     """
     target_list = []
     for ip in ip_list:
-        if LambdaEnv.SAME_VPC:
+        if same_vpc:
             target = {"Id": ip, "Port": elb_listener}
         else:
             target = {"Id": ip, "Port": elb_listener, "AvailabilityZone": "all"}
         target_list.append(target)
     return target_list
+
+
+def get_ip_set_per_version(ip_list):
+    """
+    Parse IP addresses and group them by IP version. Every address is kept in the canonical text form of
+    ipaddress (e.g. 2600:1f18::a for 2600:1F18:0:0::000A), so that addresses from the DNS, the target group and
+    the state compare equal. Invalid addresses are dropped
+    :param ip_list: list of IP addresses
+    :return: dict of IP version (4 and 6) to a set of IP addresses. e.g. {4: {'1.1.1.1'}, 6: {'2600:1f18::a'}}
+    """
+    ip_set_per_version = {ip_version: set() for ip_version in RECORD_TYPE_PER_IP_VERSION}
+    for ip in ip_list:
+        try:
+            ip_address = ipaddress.ip_address(ip)
+        except ValueError:
+            logger.warning(f"Invalid IP address - {ip}. Skip it")
+            continue
+        ip_set_per_version[ip_address.version].add(str(ip_address))
+    return ip_set_per_version
+
+
+def get_alb_name_from_dns_name(alb_dns_name):
+    """
+    Get the ALB name from its DNS name. e.g. internal-my-alb-1234567890.us-east-1.elb.amazonaws.com -> my-alb
+    :param alb_dns_name: DNS name of ALB
+    :return: ALB name
+    """
+    host_label = alb_dns_name.split(".")[0].lower()
+    if host_label.startswith(INTERNAL_ALB_DNS_NAME_PREFIX):
+        host_label = host_label[len(INTERNAL_ALB_DNS_NAME_PREFIX):]
+    return host_label.rsplit("-", 1)[0]
+
+
+def get_alb_name_from_eni_description(eni_description):
+    """
+    Get the ALB name from the description of one of its network interfaces. e.g. ELB app/my-alb/50dc6c495c0c9188
+    :param eni_description: network interface description
+    :return: ALB name. None when the network interface does not belong to an ALB
+    """
+    if not eni_description or not eni_description.startswith(ALB_ENI_DESCRIPTION_PREFIX):
+        return None
+    return eni_description[len(ALB_ENI_DESCRIPTION_PREFIX):].split("/")[0].lower()
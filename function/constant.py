@@ -1,27 +1,162 @@
 import os
-from datetime import datetime
 
+# IP version of the targets of an NLB target group per IP address type
+IP_VERSION_PER_ADDRESS_TYPE = {"ipv4": 4, "ipv6": 6}
 
-class LambdaEnv:
+
+def parse_bool(value):
+    """
+    :param value: bool, or a string. "true" in any case is True
+    :return: bool
+    """
+    return value if isinstance(value, bool) else str(value).lower() == "true"
+
+
+def parse_lower(value):
+    """
+    :param value: string
+    :return: the string in lower case
+    """
+    return str(value).lower()
+
+
+# Every setting of the reconciler: (attribute, environment variable, parser, default). The environment variable
+# names are also the keys of a configuration file of the command line entry point
+CONFIG_VARIABLE_LIST = [
+    # The primary ALB to NLB target group mapping. Optional when TARGET_MAPPINGS is given
+    ("ALB_DNS_NAME", "ALB_DNS_NAME", str, ""),
+    ("ALB_LISTENER", "ALB_LISTENER", int, 0),
+    ("NLB_TG_ARN", "NLB_TG_ARN", str, ""),
+    # Additional ALB to NLB target group mappings (JSON list) reconciled by the same function. e.g.
+    # [{"AlbDnsName": "internal-alb-1.us-east-1.elb.amazonaws.com", "AlbListener": 443, "NlbTgArn": "arn:..."}]
+    ("TARGET_MAPPINGS", "TARGET_MAPPINGS", str, "[]"),
+    # IP address type of the primary NLB target group: ipv4, or ipv6 for a dualstack ALB. An additional mapping
+    # sets it with "IpAddressType"
+    ("IP_ADDRESS_TYPE", "IP_ADDRESS_TYPE", parse_lower, "ipv4"),
+    ("S3_BUCKET", "S3_BUCKET", str, ""),
+    ("MAX_LOOKUP_PER_INVOCATION", "MAX_LOOKUP_PER_INVOCATION", int, 0),
+    # Sets the default DEREGISTRATION_DELAY: (INVOCATIONS_BEFORE_DEREGISTRATION - 1) one-minute schedule intervals
+    ("INVOCATIONS_BEFORE_DEREGISTRATION", "INVOCATIONS_BEFORE_DEREGISTRATION", int, 3),
+    # A registered IP that is missing from the DNS is deregistered once the confidence that it is still in the DNS
+    # falls below DEREGISTRATION_CONFIDENCE and it has been missing for DEREGISTRATION_DELAY seconds or more. The
+    # delay keeps passes that run seconds apart from deregistering an IP after a few quick misses. 0: the default
+    ("DEREGISTRATION_CONFIDENCE", "DEREGISTRATION_CONFIDENCE", float, 0.01),
+    ("DEREGISTRATION_DELAY", "DEREGISTRATION_DELAY", int, 0),
+    ("CW_METRIC_FLAG_IP_COUNT", "CW_METRIC_FLAG_IP_COUNT", parse_bool, False),
+    # Emit the step durations and counters as CloudWatch Embedded Metric Format log lines
+    ("CW_METRIC_FLAG_STEP_METRICS", "CW_METRIC_FLAG_STEP_METRICS", parse_bool, False),
+    ("SAME_VPC", "SAME_VPC", parse_bool, True),
+    ("REGION", "AWS_REGION", str, ""),
+    # Loop mode. Seconds between reconcile passes within one invocation (0: one pass) and max loop seconds
+    # (0: until the invocation is near its timeout)
+    ("RECONCILE_LOOP_INTERVAL", "RECONCILE_LOOP_INTERVAL", int, 0),
+    ("RECONCILE_LOOP_DURATION", "RECONCILE_LOOP_DURATION", int, 0),
+    # Encoding of the state object: json, or binary (packed IP addresses behind a version header). Both are read
+    ("STATE_ENCODING", "STATE_ENCODING", parse_lower, "json"),
+]
+
+
+class Config:
     """
-    Constant extracted from Lambda environment variables
+    Configuration of the reconciler. The Lambda function reads it from its environment variables on every
+    invocation and the command line entry point (cli.py) also from a configuration file and flags. It is passed
+    explicitly to the reconcile engine, so one process can run more than one configuration. Building it is cheap
+    and never raises: a value that cannot be parsed keeps its default and is reported by
+    validate_environment_variable
     """
 
-    ALB_DNS_NAME = os.environ["ALB_DNS_NAME"]
-    ALB_LISTENER = int(os.environ["ALB_LISTENER"])
-    S3_BUCKET = os.environ["S3_BUCKET"]
-    NLB_TG_ARN = os.environ["NLB_TG_ARN"]
-    MAX_LOOKUP_PER_INVOCATION = int(os.environ["MAX_LOOKUP_PER_INVOCATION"])
-    INVOCATIONS_BEFORE_DEREGISTRATION = int(
-        os.environ["INVOCATIONS_BEFORE_DEREGISTRATION"]
-    )
-    CW_METRIC_FLAG_IP_COUNT = (
-        True if os.environ["CW_METRIC_FLAG_IP_COUNT"].lower() == "true" else False
-    )
-    SAME_VPC = True if os.getenv('SAME_VPC', "true").lower() == "true" else False
-    REGION = os.environ["AWS_REGION"]
+    STATE_FILENAME = "state.json"
+    # Legacy state objects. Only read when the state object does not exist yet
     ACTIVE_FILENAME = "active_ip.json"
     PENDING_DEREGISTRATION_FILENAME = "pending_ip.json"
-    ACTIVE_IP_LIST_KEY = f"{ALB_DNS_NAME}/{ACTIVE_FILENAME}"
-    PENDING_IP_LIST_KEY = f"{ALB_DNS_NAME}/{PENDING_DEREGISTRATION_FILENAME}"
-    TIME = datetime.strftime((datetime.utcnow()), "%Y-%m-%d %H:%M:%S")
+    STATE_VERSION = 3
+
+    def __init__(self, value_per_variable):
+        """
+        :param value_per_variable: dict of environment variable name to its value. A missing variable gets its
+        default. e.g. {"ALB_DNS_NAME": "internal-alb-1.us-east-1.elb.amazonaws.com", "ALB_LISTENER": "443"}
+        """
+        self.value_per_variable = dict(value_per_variable)
+        self.error_list = []
+        for (attribute, variable, parse, default) in CONFIG_VARIABLE_LIST:
+            value = default
+            if value_per_variable.get(variable) is not None:
+                try:
+                    value = parse(value_per_variable[variable])
+                except (ValueError, TypeError):
+                    self.error_list.append(f"{variable} is invalid: {value_per_variable[variable]}")
+            setattr(self, attribute, value)
+        # The mappings to reconcile. Set once the configuration is validated
+        self.reconcile_target_list = None
+
+    @classmethod
+    def from_environment(cls, environ=None):
+        """
+        :param environ: environment variables. Default: os.environ
+        :return: Config
+        """
+        environ = os.environ if environ is None else environ
+        return cls({variable: environ.get(variable) for (_, variable, _, _) in CONFIG_VARIABLE_LIST})
+
+
+class ReconcileTarget:
+    """
+    One ALB to NLB target group mapping that is reconciled by the Lambda function
+    """
+
+    def __init__(
+            self,
+            alb_dns_name,
+            alb_listener,
+            nlb_tg_arn,
+            state_key_prefix,
+            is_primary=False,
+            ip_address_type="ipv4",
+            config=None,
+            previous_state_key_prefix=None,
+    ):
+        """
+        :param alb_dns_name: DNS name of the ALB
+        :param alb_listener: ALB listener port
+        :param nlb_tg_arn: ARN of the NLB target group
+        :param state_key_prefix: prefix of the state object key
+        :param is_primary: True for the mapping of ALB_DNS_NAME, which has the legacy state objects
+        :param ip_address_type: ipv4 or ipv6
+        :param config: Config that the mapping is reconciled with. Default: the default configuration
+        :param previous_state_key_prefix: prefix of the state object key that an earlier version kept the state of
+        the mapping under. It is read when the state object does not exist yet
+        """
+        self.alb_dns_name = alb_dns_name
+        self.alb_listener = alb_listener
+        self.nlb_tg_arn = nlb_tg_arn
+        self.ip_address_type = ip_address_type
+        self.config = config if config is not None else Config({})
+        # None when the IP address type is invalid
+        self.ip_version = IP_VERSION_PER_ADDRESS_TYPE.get(ip_address_type)
+        # An IPv6 target group keeps its own state object, so that it never picks up the IPv4 state of its ALB
+        self.state_key = self._get_state_key(state_key_prefix)
+        self.previous_state_key = (
+            self._get_state_key(previous_state_key_prefix) if previous_state_key_prefix else None
+        )
+        # Only the primary IPv4 mapping has legacy state objects
+        is_legacy = is_primary and self.ip_version == 4
+        self.active_ip_list_key = (
+            f"{alb_dns_name}/{Config.ACTIVE_FILENAME}" if is_legacy else None
+        )
+        self.pending_ip_list_key = (
+            f"{alb_dns_name}/{Config.PENDING_DEREGISTRATION_FILENAME}" if is_legacy else None
+        )
+
+    def _get_state_key(self, state_key_prefix):
+        """
+        :param state_key_prefix: prefix of the state object key
+        :return: state object key
+        """
+        if self.ip_version == 6:
+            return f"{state_key_prefix}/{self.ip_address_type}/{Config.STATE_FILENAME}"
+        return f"{state_key_prefix}/{Config.STATE_FILENAME}"
+
+    def __repr__(self):
+        if self.ip_version == 4:
+            return f"{self.alb_dns_name}:{self.alb_listener} -> {self.nlb_tg_arn}"
+        return f"{self.alb_dns_name}:{self.alb_listener} ({self.ip_address_type}) -> {self.nlb_tg_arn}"
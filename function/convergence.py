@@ -0,0 +1,179 @@
+from collections import Counter
+
+# Route 53 returns at most 8 records per ELB DNS response. A response with fewer records holds all of them
+MAX_RECORD_COUNT_PER_RESPONSE = 8
+# Stop once fewer than this many ELB IPs are estimated to be unseen
+DEFAULT_UNSEEN_IP_THRESHOLD = 0.05
+# Never trust the estimate before this many lookups
+DEFAULT_MIN_LOOKUP_COUNT = 5
+# Stop once this many lookups in a row have not found any new IP
+DEFAULT_STABLE_LOOKUP_COUNT = 10
+
+
+class StopPolicy:
+    """
+    Decides when DNS sampling has seen enough of the ELB node IPs to stop.
+    It keeps the sampling history (in how many responses each IP showed up) and estimates the hidden IP
+    population from it with the incidence-based Chao2 estimator. Subclasses decide when to stop.
+    """
+
+    def __init__(self):
+        self.lookup_count = 0
+        self.ip_incidence_count = Counter()
+        # Authoritative name server of the first response that held each IP
+        self.nameserver_per_ip = {}
+        self.stable_lookup_count = 0
+        self.is_complete_response_seen = False
+        self.stop_reason = None
+        self.required_availability_zone_set = set()
+        self.get_availability_zone = None
+
+    def require_availability_zone_coverage(self, availability_zone_set, get_availability_zone):
+        """
+        Do not stop before every given Availability Zone has at least one IP seen, unless a response holds all of
+        the ELB IPs. The nodes of an Availability Zone that are missed in a short sampling window would leave the
+        NLB without a local target in that zone
+        :param availability_zone_set: Availability Zones of the ELB
+        :param get_availability_zone: function that returns the Availability Zone of an IP
+        """
+        self.required_availability_zone_set = set(availability_zone_set)
+        self.get_availability_zone = get_availability_zone
+
+    def add_sample(self, ip_list, nameserver=None):
+        """
+        Record the IPs of one DNS response
+        :param ip_list: list of IPs in the DNS response
+        :param nameserver: name server that sent the response. None when it came through the default resolver
+        """
+        ip_set = set(ip_list)
+        for ip in ip_set:
+            self.nameserver_per_ip.setdefault(ip, nameserver)
+        self.stable_lookup_count = (
+            self.stable_lookup_count + 1
+            if ip_set <= self.ip_incidence_count.keys()
+            else 0
+        )
+        self.lookup_count += 1
+        self.ip_incidence_count.update(ip_set)
+        if ip_set and len(ip_set) < MAX_RECORD_COUNT_PER_RESPONSE:
+            self.is_complete_response_seen = True
+
+    def _get_singleton_and_doubleton_count(self):
+        """
+        :return: count of IPs seen in exactly one response and count of IPs seen in exactly two responses
+        """
+        incidence_count_list = list(self.ip_incidence_count.values())
+        return incidence_count_list.count(1), incidence_count_list.count(2)
+
+    @property
+    def unseen_availability_zone_set(self):
+        """
+        Required Availability Zones that no IP has been seen in yet
+        """
+        if not self.required_availability_zone_set:
+            return set()
+        return self.required_availability_zone_set - {
+            self.get_availability_zone(ip) for ip in self.ip_incidence_count
+        }
+
+    @property
+    def estimated_unseen_ip_count(self):
+        """
+        Estimated count of ELB IPs that have not shown up in any response yet (Chao2)
+        """
+        if self.is_complete_response_seen:
+            return 0.0
+        if self.lookup_count < 2:
+            return float("inf")
+        (singleton_count, doubleton_count) = self._get_singleton_and_doubleton_count()
+        sample_correction = (self.lookup_count - 1) / self.lookup_count
+        if doubleton_count:
+            return sample_correction * singleton_count ** 2 / (2 * doubleton_count)
+        return sample_correction * singleton_count * max(singleton_count - 1, 0) / 2
+
+    @property
+    def confidence(self):
+        """
+        Estimated probability that the next response holds no unseen IP (sample coverage). Between 0 and 1
+        """
+        if self.is_complete_response_seen:
+            return 1.0
+        incidence_total = sum(self.ip_incidence_count.values())
+        if self.lookup_count < 2 or not incidence_total:
+            return 0.0
+        (singleton_count, doubleton_count) = self._get_singleton_and_doubleton_count()
+        if not singleton_count:
+            return 1.0
+        weighted_singleton_count = (self.lookup_count - 1) * singleton_count
+        return 1.0 - singleton_count / incidence_total * (
+                weighted_singleton_count / (weighted_singleton_count + 2 * doubleton_count)
+        )
+
+    def should_stop(self):
+        """
+        :return: True when sampling should stop. stop_reason tells why
+        """
+        raise NotImplementedError
+
+
+class CompleteResponseStopPolicy(StopPolicy):
+    """
+    Stop only when a response holds all of the ELB IPs (fewer than 8 records)
+    """
+
+    def should_stop(self):
+        if self.is_complete_response_seen:
+            self.stop_reason = f"There are less than {MAX_RECORD_COUNT_PER_RESPONSE} IPs in the DNS response"
+            return True
+        return False
+
+
+class StableLookupStopPolicy(CompleteResponseStopPolicy):
+    """
+    Stop when a response holds all of the ELB IPs or when a number of lookups in a row have not found any new IP
+    (and every required Availability Zone has an IP seen)
+    """
+
+    def __init__(self, stable_lookup_count=DEFAULT_STABLE_LOOKUP_COUNT):
+        super().__init__()
+        self.max_stable_lookup_count = stable_lookup_count
+
+    def should_stop(self):
+        if super().should_stop():
+            return True
+        if self.stable_lookup_count >= self.max_stable_lookup_count and not self.unseen_availability_zone_set:
+            self.stop_reason = f"No new IP found in the last {self.stable_lookup_count} DNS lookups"
+            return True
+        return False
+
+
+class CoverageStopPolicy(CompleteResponseStopPolicy):
+    """
+    Stop when a response holds all of the ELB IPs or when the estimated count of unseen ELB IPs falls below
+    a threshold (and every required Availability Zone has an IP seen). Large ELBs get more samples and small
+    ELBs fewer.
+    """
+
+    def __init__(
+            self,
+            unseen_ip_threshold=DEFAULT_UNSEEN_IP_THRESHOLD,
+            min_lookup_count=DEFAULT_MIN_LOOKUP_COUNT,
+    ):
+        super().__init__()
+        self.unseen_ip_threshold = unseen_ip_threshold
+        self.min_lookup_count = min_lookup_count
+
+    def should_stop(self):
+        if super().should_stop():
+            return True
+        if (
+                self.lookup_count >= self.min_lookup_count
+                and self.estimated_unseen_ip_count < self.unseen_ip_threshold
+                and not self.unseen_availability_zone_set
+        ):
+            self.stop_reason = (
+                f"Estimated unseen IP count ({self.estimated_unseen_ip_count:.2f}) is below "
+                f"{self.unseen_ip_threshold} after {self.lookup_count} DNS lookups"
+            )
+            return True
+        return False
@@ -0,0 +1,183 @@
+import random
+import select
+import socket
+import struct
+import time
+import dns.exception
+import dns.flags
+import dns.inet
+import dns.message
+import dns.query
+import dns.rcode
+import dns.rdatatype
+
+DNS_PORT = 53
+# Max size of a UDP DNS response without EDNS
+DNS_UDP_MAX_SIZE = 512
+# Size of the DNS message header (ID, flags and the four section counts)
+DNS_HEADER_LENGTH = 12
+# Record types whose rdata is a packed IP address, and their address family and rdata length
+ADDRESS_RDATA_FORMAT = {
+    dns.rdatatype.A: (socket.AF_INET, 4),
+    dns.rdatatype.AAAA: (socket.AF_INET6, 16),
+}
+
+
+def skip_wire_name(wire, offset):
+    """
+    Skip over a (possibly compressed) domain name in a DNS message
+    :param wire: DNS message in wire format
+    :param offset: offset of the first label of the name
+    :return: offset of the first byte after the name
+    """
+    while True:
+        label_length = wire[offset]
+        if label_length == 0:
+            return offset + 1
+        # A compression pointer always ends the name
+        if label_length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += label_length + 1
+
+
+def parse_answer_address_list(wire, query_id, rdtype):
+    """
+    Parse the IP addresses from the answer section of a DNS response. The other sections are not parsed
+    :param wire: DNS response in wire format
+    :param query_id: expected DNS message ID
+    :param rdtype: record type of the query. e.g. dns.rdatatype.A
+    :return: list of IP addresses in the answer section
+    """
+    if len(wire) < DNS_HEADER_LENGTH:
+        raise dns.query.BadResponse("DNS response is shorter than a DNS header")
+    (response_id, flags, question_count, answer_count) = struct.unpack_from(
+        "!HHHH", wire
+    )
+    if response_id != query_id or not flags & dns.flags.QR:
+        raise dns.query.BadResponse("DNS response does not match the query")
+    rcode = dns.rcode.from_flags(flags, 0)
+    if rcode != dns.rcode.NOERROR:
+        raise dns.exception.DNSException(
+            f"DNS response error: {dns.rcode.to_text(rcode)}"
+        )
+
+    try:
+        offset = DNS_HEADER_LENGTH
+        for _ in range(question_count):
+            # Question name followed by type and class
+            offset = skip_wire_name(wire, offset) + 4
+
+        (address_family, address_length) = ADDRESS_RDATA_FORMAT[rdtype]
+        address_list = []
+        for _ in range(answer_count):
+            offset = skip_wire_name(wire, offset)
+            (answer_rdtype, _, _, rdata_length) = struct.unpack_from(
+                "!HHIH", wire, offset
+            )
+            offset += 10
+            if offset + rdata_length > len(wire):
+                raise IndexError("rdata is out of range")
+            if answer_rdtype == rdtype and rdata_length == address_length:
+                address_list.append(
+                    dns.inet.inet_ntop(address_family, wire[offset: offset + rdata_length])
+                )
+            offset += rdata_length
+    except (IndexError, struct.error):
+        raise dns.query.BadResponse("DNS response is truncated or malformed")
+    return address_list
+
+
+class DnsSampler:
+    """
+    Samples the A or AAAA records of a domain name straight from its authoritative name servers.
+    The query is built once and only its 16-bit ID is swapped per send. One UDP socket per address family
+    is bound once and reused for every send, and only the answer section of a response is parsed.
+    A sampler is not thread-safe. Use one sampler per thread.
+    """
+
+    def __init__(self, domain_name, record_type="A", port=None):
+        """
+        :param domain_name: DNS name
+        :param record_type: DNS record type. e.g. A or AAAA
+        :param port: DNS name server port. Default: DNS_PORT
+        """
+        self.domain_name = domain_name
+        self.port = port or DNS_PORT
+        self.rdtype = dns.rdatatype.from_text(record_type)
+        query = dns.message.make_query(domain_name, self.rdtype)
+        # Authoritative name servers do not recurse
+        query.flags &= ~dns.flags.RD
+        self.query_wire = bytearray(query.to_wire())
+        self.sockets = {}
+        # Queries of the last burst that got no valid response before its deadline
+        self.burst_timeout_count = 0
+
+    def _get_socket(self, nameserver):
+        """
+        Get the UDP socket for the address family of the given name server. Create and bind it on first use
+        :param nameserver: DNS name server IP address
+        :return: UDP socket
+        """
+        address_family = dns.inet.af_for_address(nameserver)
+        udp_socket = self.sockets.get(address_family)
+        if udp_socket is None:
+            udp_socket = socket.socket(address_family, socket.SOCK_DGRAM)
+            udp_socket.bind(("::", 0) if address_family == socket.AF_INET6 else ("", 0))
+            self.sockets[address_family] = udp_socket
+        return udp_socket
+
+    def burst(self, nameserver_list, timeout, port=None):
+        """
+        Send one query per entry of the given name server list at once, each with a distinct ID, over the bound
+        UDP sockets. Responses are matched by (ID, source) as they arrive, so the whole burst takes about one
+        round trip. Queries that get no valid response before the shared deadline are dropped and counted in
+        burst_timeout_count. Queries that are still outstanding when the caller stops iterating are not counted.
+        :param nameserver_list: list of DNS name server IP addresses. A name server can be listed more than once
+        :param timeout: seconds to wait for all of the responses
+        :param port: DNS name server port. Default: the port of the sampler
+        :return: an iterator of (name server, list of IP addresses in the answer section)
+        """
+        port = port or self.port
+        self.burst_timeout_count = 0
+        outstanding_query_set = set()
+        for (query_id, nameserver) in zip(
+                random.sample(range(65536), len(nameserver_list)), nameserver_list
+        ):
+            struct.pack_into("!H", self.query_wire, 0, query_id)
+            self._get_socket(nameserver).sendto(self.query_wire, (nameserver, port))
+            outstanding_query_set.add((query_id, nameserver))
+
+        expiration = time.monotonic() + timeout
+        udp_socket_list = list(self.sockets.values())
+        while outstanding_query_set:
+            remaining_time = expiration - time.monotonic()
+            if remaining_time <= 0:
+                self.burst_timeout_count = len(outstanding_query_set)
+                return
+            (readable_socket_list, _, _) = select.select(
+                udp_socket_list, [], [], remaining_time
+            )
+            for udp_socket in readable_socket_list:
+                (wire, source) = udp_socket.recvfrom(DNS_UDP_MAX_SIZE)
+                if len(wire) < 2:
+                    continue
+                query_key = (struct.unpack_from("!H", wire)[0], source[0])
+                # Skip late responses to earlier bursts and datagrams from anyone else
+                if query_key not in outstanding_query_set:
+                    continue
+                outstanding_query_set.remove(query_key)
+                try:
+                    address_list = parse_answer_address_list(
+                        wire, query_key[0], self.rdtype
+                    )
+                except dns.exception.DNSException:
+                    continue
+                yield query_key[1], address_list
+
+    def close(self):
+        """
+        Close the UDP sockets
+        """
+        for udp_socket in self.sockets.values():
+            udp_socket.close()
+        self.sockets = {}
@@ -0,0 +1,200 @@
+import calendar
+import time
+from common import logger
+
+# Lifecycle states of an ALB node IP in one NLB target group
+# In the DNS and not registered yet (or its registration failed)
+DISCOVERED = "discovered"
+# In the DNS and registered
+REGISTERED = "registered"
+# Registered, but no longer in the DNS since MissingSince
+MISSING = "missing"
+# Deregistered. The target group drains its connections
+DRAINING = "draining"
+# Gone from the target group. Kept for DEREGISTERED_RETENTION seconds for troubleshooting
+DEREGISTERED = "deregistered"
+LIFECYCLE_STATE_LIST = [DISCOVERED, REGISTERED, MISSING, DRAINING, DEREGISTERED]
+# Seconds that a deregistered IP is kept in the state
+DEREGISTERED_RETENTION = 3600
+# Format of the TimeStamp of the active IPs in the state
+STATE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def get_lifecycle_state(is_in_dns, is_registered, is_draining, previous_lifecycle_state):
+    """
+    :param is_in_dns: whether the IP is in the DNS
+    :param is_registered: whether the IP is registered with the target group and not draining
+    :param is_draining: whether the IP is draining in the target group
+    :param previous_lifecycle_state: lifecycle state of the IP before the update. None for a new IP
+    :return: lifecycle state of the IP. None when the IP is not tracked anymore
+    """
+    if is_draining:
+        return DRAINING
+    if is_registered:
+        return REGISTERED if is_in_dns else MISSING
+    if is_in_dns:
+        return DISCOVERED
+    # An IP that left the target group. An IP that was never registered is not tracked anymore
+    if previous_lifecycle_state in (REGISTERED, MISSING, DRAINING, DEREGISTERED):
+        return DEREGISTERED
+    return None
+
+
+class IpLifecycleTable:
+    """
+    Lifecycle of every ALB node IP of one mapping, with the time (epoch seconds) of its last state change,
+    when it was first seen and since when it is missing from the DNS. It is updated incrementally: only the IPs
+    that entered or left the DNS or the target group since the previous update change state
+    """
+
+    def __init__(self, entry_per_ip=None):
+        """
+        :param entry_per_ip: dict of IP to its entry.
+        e.g. {"1.1.1.1": {"State": "registered", "Since": 1621294272, "FirstSeen": 1621294212, "MissingSince": None}}
+        """
+        self.entry_per_ip = entry_per_ip or {}
+
+    @classmethod
+    def from_state(cls, state, now):
+        """
+        Load the lifecycle from the state of the previous invocation. A state of version 1 (active IP list and
+        pending deregistration invocation counts) is migrated: the active IPs are registered as of its TimeStamp
+        and the pending IPs start missing now. The next update corrects them from the target group
+        :param state: state from the previous invocation
+        :param now: current time (epoch seconds)
+        :return: IpLifecycleTable
+        """
+        if "Targets" in state:
+            return cls({ip: dict(entry) for (ip, entry) in state["Targets"].items()})
+
+        active_ip_dict = state.get("ActiveIP") or {}
+        try:
+            active_time = calendar.timegm(
+                time.strptime(active_ip_dict.get("TimeStamp", ""), STATE_TIMESTAMP_FORMAT)
+            )
+        except ValueError:
+            active_time = now
+        entry_per_ip = {
+            ip: {"State": REGISTERED, "Since": active_time, "FirstSeen": active_time, "MissingSince": None}
+            for ip in active_ip_dict.get("IPList", [])
+        }
+        for ip in state.get("PendingDeregistrationIP") or {}:
+            entry_per_ip[ip] = {
+                "State": MISSING,
+                "Since": now,
+                "FirstSeen": entry_per_ip.get(ip, {}).get("FirstSeen", now),
+                "MissingSince": now,
+            }
+        if entry_per_ip:
+            logger.info(f"Migrated the active and pending IPs of a version 1 state: {entry_per_ip}")
+        return cls(entry_per_ip)
+
+    def get_ip_set(self, *lifecycle_states):
+        """
+        :param lifecycle_states: lifecycle states to keep. e.g. MISSING
+        :return: a set of IPs in the given lifecycle states
+        """
+        return {ip for (ip, entry) in self.entry_per_ip.items() if entry["State"] in lifecycle_states}
+
+    def update(self, ip_from_dns_set, registered_ip_set, draining_ip_set, now):
+        """
+        Update the lifecycle from the IPs in the DNS and the targets of the target group
+        :param ip_from_dns_set: a set of IPs that are in the DNS
+        :param registered_ip_set: a set of IPs that are registered with the target group and not draining
+        :param draining_ip_set: a set of IPs that are draining in the target group
+        :param now: current time (epoch seconds)
+        :return: a set of IPs whose lifecycle state changed
+        """
+        # The DNS and target group view of the previous update, as told by the lifecycle states
+        previous_ip_in_dns_set = {
+            ip for (ip, entry) in self.entry_per_ip.items()
+            if entry["MissingSince"] is None and entry["State"] != DEREGISTERED
+        }
+        previous_registered_ip_set = self.get_ip_set(REGISTERED, MISSING)
+        previous_draining_ip_set = self.get_ip_set(DRAINING)
+        # Only the IPs that entered or left the DNS or the target group can change state
+        delta_ip_set = (
+                (ip_from_dns_set ^ previous_ip_in_dns_set)
+                | (registered_ip_set ^ previous_registered_ip_set)
+                | (draining_ip_set ^ previous_draining_ip_set)
+        )
+        changed_ip_set = set()
+        for ip in delta_ip_set:
+            entry = self.entry_per_ip.get(ip)
+            previous_lifecycle_state = entry["State"] if entry else None
+            lifecycle_state = get_lifecycle_state(
+                ip in ip_from_dns_set,
+                ip in registered_ip_set,
+                ip in draining_ip_set,
+                previous_lifecycle_state,
+            )
+            if lifecycle_state is None:
+                self.entry_per_ip.pop(ip, None)
+                changed_ip_set.add(ip)
+                continue
+            if entry is None:
+                entry = self.entry_per_ip[ip] = {
+                    "State": lifecycle_state, "Since": now, "FirstSeen": now, "MissingSince": None
+                }
+            if ip in ip_from_dns_set:
+                entry["MissingSince"] = None
+            elif entry["MissingSince"] is None:
+                entry["MissingSince"] = now
+            if lifecycle_state != previous_lifecycle_state:
+                entry["State"] = lifecycle_state
+                entry["Since"] = now
+                changed_ip_set.add(ip)
+        logger.info(
+            f"IPs that entered or left the DNS or the target group: {delta_ip_set}. "
+            f"IPs that changed lifecycle state: {changed_ip_set}"
+        )
+        return changed_ip_set
+
+    def get_pending_deregistration_ip_set(self, now, deregistration_delay):
+        """
+        :param now: current time (epoch seconds)
+        :param deregistration_delay: seconds that a registered IP has to be missing from the DNS for
+        :return: a set of registered IPs that have been missing from the DNS for deregistration_delay seconds
+        """
+        return {
+            ip for (ip, entry) in self.entry_per_ip.items()
+            if entry["State"] == MISSING and now - entry["MissingSince"] >= deregistration_delay
+        }
+
+    def set_lifecycle_state(self, ip_set, lifecycle_state, now):
+        """
+        Move the given IPs to a lifecycle state. e.g. REGISTERED once their registration succeeded
+        :param ip_set: a set of tracked IPs
+        :param lifecycle_state: lifecycle state
+        :param now: current time (epoch seconds)
+        """
+        for ip in ip_set:
+            entry = self.entry_per_ip[ip]
+            if entry["State"] != lifecycle_state:
+                entry["State"] = lifecycle_state
+                entry["Since"] = now
+
+    def prune(self, now, retention=DEREGISTERED_RETENTION):
+        """
+        Stop tracking the IPs that were deregistered more than retention seconds ago
+        :param now: current time (epoch seconds)
+        :param retention: seconds that a deregistered IP is kept
+        """
+        for ip in self.get_ip_set(DEREGISTERED):
+            if now - self.entry_per_ip[ip]["Since"] >= retention:
+                del self.entry_per_ip[ip]
+
+    def get_ip_count_per_lifecycle_state(self):
+        """
+        :return: dict of lifecycle state to the number of IPs in it
+        """
+        ip_count_per_lifecycle_state = dict.fromkeys(LIFECYCLE_STATE_LIST, 0)
+        for entry in self.entry_per_ip.values():
+            ip_count_per_lifecycle_state[entry["State"]] += 1
+        return ip_count_per_lifecycle_state
+
+    def to_state(self):
+        """
+        :return: the lifecycle as the Targets of the state
+        """
+        return {ip: dict(entry) for (ip, entry) in self.entry_per_ip.items()}
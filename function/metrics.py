@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# CloudWatch namespace of the metrics of the Lambda function. Both the EMF log lines and the buffered metrics use it
+METRIC_NAMESPACE = "NLBTargetGroupToALB"
+# Max number of values of one metric in one EMF log line
+EMF_MAX_VALUE_COUNT = 100
+# Max number of datums per PutMetricData call
+PUT_METRIC_DATA_MAX_DATUM_COUNT = 1000
+
+
+class MetricRecorder:
+    """
+    Collects the step durations and counters of one unit of work (e.g. the DNS sampling of one ALB or the reconcile
+    of one mapping) and emits them as one CloudWatch Embedded Metric Format log line. CloudWatch Logs extracts
+    the metrics from the log line, so no PutMetricData call is needed. Thread-safe.
+    """
+
+    def __init__(self, dimensions):
+        """
+        :param dimensions: dict of dimension name to value. e.g. {"LoadBalancerName": "internal-alb..."}
+        """
+        self.dimensions = dimensions
+        self.metric_values = defaultdict(list)
+        self.metric_units = {}
+        self.lock = threading.Lock()
+
+    def put_metric(self, metric_name, value, unit="Count"):
+        """
+        Record one value of a metric. A metric can have more than one value
+        :param metric_name: metric name
+        :param value: metric value
+        :param unit: CloudWatch metric unit
+        """
+        with self.lock:
+            self.metric_values[metric_name].append(value)
+            self.metric_units[metric_name] = unit
+
+    def add_count(self, metric_name, count=1):
+        """
+        Add to a counter. A counter has one value
+        :param metric_name: metric name
+        :param count: count to add
+        """
+        with self.lock:
+            metric_value_list = self.metric_values[metric_name]
+            if metric_value_list:
+                metric_value_list[0] += count
+            else:
+                metric_value_list.append(count)
+            self.metric_units[metric_name] = "Count"
+
+    @contextmanager
+    def time_step(self, step_name):
+        """
+        Record the duration of the wrapped code as the {step_name}Duration metric in milliseconds
+        :param step_name: step name. e.g. DnsSampling
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put_metric(
+                f"{step_name}Duration",
+                (time.perf_counter() - start_time) * 1000,
+                "Milliseconds",
+            )
+
+    def get_value_sum(self, metric_name):
+        """
+        :param metric_name: metric name
+        :return: sum of the recorded values of the metric. 0 when it was not recorded
+        """
+        with self.lock:
+            return sum(self.metric_values.get(metric_name, []))
+
+    def to_emf(self):
+        """
+        :return: the recorded metrics as an EMF log event (dict)
+        """
+        with self.lock:
+            emf_log_event = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRIC_NAMESPACE,
+                            "Dimensions": [list(self.dimensions)],
+                            "Metrics": [
+                                {"Name": metric_name, "Unit": self.metric_units[metric_name]}
+                                for metric_name in self.metric_values
+                            ],
+                        }
+                    ],
+                },
+            }
+            emf_log_event.update(self.dimensions)
+            for metric_name, metric_value_list in self.metric_values.items():
+                emf_log_event[metric_name] = (
+                    metric_value_list[0]
+                    if len(metric_value_list) == 1
+                    else metric_value_list[-EMF_MAX_VALUE_COUNT:]
+                )
+            return emf_log_event
+
+    def flush(self):
+        """
+        Write the recorded metrics to stdout as one EMF log line and reset them. Nothing is written when no
+        metric was recorded
+        """
+        if not self.metric_values:
+            return
+        # EMF log lines must be plain JSON, so they bypass the logger and its format
+        print(json.dumps(self.to_emf()), flush=True)
+        with self.lock:
+            self.metric_values.clear()
+            self.metric_units.clear()
+
+
+class MetricBuffer:
+    """
+    Collects CloudWatch metric datums during a reconcile pass and publishes them with as few PutMetricData calls
+    as possible at the end of the pass, so that publishing adds no API call to the steps. Thread-safe.
+    """
+
+    def __init__(self, namespace=METRIC_NAMESPACE):
+        self.namespace = namespace
+        self.metric_data_list = []
+        # (metric name, dimensions) of the datums that are put once per flush
+        self.unique_metric_key_set = set()
+        self.lock = threading.Lock()
+
+    def put(self, metric_name, value, dimensions, unit="Count", is_unique=False):
+        """
+        Add one datum
+        :param metric_name: metric name
+        :param value: metric value
+        :param dimensions: dict of dimension name to value
+        :param unit: CloudWatch metric unit
+        :param is_unique: keep only the first datum of the metric and dimensions until the next flush. e.g. a metric
+        of an ALB that every mapping of the ALB puts
+        """
+        metric_data = {
+            "MetricName": metric_name,
+            "Dimensions": [
+                {"Name": name, "Value": dimension_value}
+                for name, dimension_value in dimensions.items()
+            ],
+            "Timestamp": datetime.now(timezone.utc),
+            "Value": float(value),
+            "Unit": unit,
+        }
+        with self.lock:
+            if is_unique:
+                unique_metric_key = (metric_name, tuple(sorted(dimensions.items())))
+                if unique_metric_key in self.unique_metric_key_set:
+                    return
+                self.unique_metric_key_set.add(unique_metric_key)
+            self.metric_data_list.append(metric_data)
+
+    def flush(self, aws_service):
+        """
+        Publish the collected datums in batches of PUT_METRIC_DATA_MAX_DATUM_COUNT and reset the buffer
+        :param aws_service: aws service object
+        :return: number of datums that were published
+        """
+        with self.lock:
+            (metric_data_list, self.metric_data_list) = (self.metric_data_list, [])
+            self.unique_metric_key_set = set()
+        published_datum_count = 0
+        for index in range(0, len(metric_data_list), PUT_METRIC_DATA_MAX_DATUM_COUNT):
+            metric_data_chunk = metric_data_list[index: index + PUT_METRIC_DATA_MAX_DATUM_COUNT]
+            if aws_service.publish_metric_data(self.namespace, metric_data_chunk):
+                published_datum_count += len(metric_data_chunk)
+        return published_datum_count
@@ -0,0 +1,170 @@
+import math
+
+# Number of recent invocations whose DNS hits are kept per IP (one bit each)
+OBSERVATION_HISTORY_LENGTH = 16
+OBSERVATION_HISTORY_MASK = (1 << OBSERVATION_HISTORY_LENGTH) - 1
+# Weight of an invocation relative to the next more recent one in the detection rate
+OBSERVATION_HISTORY_DECAY = 0.8
+# A single DNS sampling can always miss an IP, so the detection rate of an IP never gets above this
+MAX_DETECTION_RATE = 0.95
+# Detection rate of an IP without history. e.g. an IP that was missing when the state was migrated
+DEFAULT_DETECTION_RATE = 0.5
+# Seconds between two updates of the LastSeen time and the name server of an IP that keeps being seen. A coarser
+# LastSeen keeps the state of a steady ALB unchanged between most invocations, so it is not uploaded
+LAST_SEEN_RESOLUTION = 300
+# Number of decimals of the presence confidence in the state
+CONFIDENCE_DECIMALS = 4
+
+
+class DnsObservation:
+    """
+    Collects what the DNS sampling of one ALB saw: how confident the sampling is that it saw every IP, which
+    authoritative name server returned each IP and the sampling statistics
+    """
+
+    def __init__(self, sampling_confidence=0.0):
+        """
+        :param sampling_confidence: 1.0 when the sampling saw every IP (e.g. a response held all of them).
+        0.0 when it tells nothing about the IPs that it did not see
+        """
+        self.sampling_confidence = sampling_confidence
+        self.nameserver_per_ip = {}
+        self.lookup_count = 0
+        self.estimated_unseen_ip_count = None
+        self.stop_reason = None
+
+    def add_sampling(self, stop_policy):
+        """
+        :param stop_policy: stop policy of the DNS sampling, once the sampling stopped
+        """
+        self.sampling_confidence = stop_policy.confidence
+        self.nameserver_per_ip.update(stop_policy.nameserver_per_ip)
+        self.lookup_count = stop_policy.lookup_count
+        self.estimated_unseen_ip_count = stop_policy.estimated_unseen_ip_count
+        self.stop_reason = stop_policy.stop_reason
+
+    def get_sampling_statistics(self):
+        """
+        :return: dict of the sampling statistics. The estimated unseen IP count is None when it cannot be estimated
+        """
+        estimated_unseen_ip_count = self.estimated_unseen_ip_count
+        if estimated_unseen_ip_count is not None and math.isinf(estimated_unseen_ip_count):
+            estimated_unseen_ip_count = None
+        return {
+            "LookupCount": self.lookup_count,
+            "SamplingConfidence": round(self.sampling_confidence, 3),
+            "EstimatedUnseenIPCount": (
+                round(estimated_unseen_ip_count, 2) if estimated_unseen_ip_count is not None else None
+            ),
+            "StopReason": self.stop_reason,
+        }
+
+
+def get_detection_rate(entry):
+    """
+    Decay-weighted share of the invocations that saw the IP while it was in the DNS, i.e. without the current run
+    of misses. Recent invocations weigh more
+    :param entry: observation entry of the IP
+    :return: estimated probability that an invocation sees the IP when it is in the DNS
+    """
+    (history, run_count) = (entry["History"], entry["RunCount"])
+    miss_streak = 0
+    while miss_streak < run_count and not history >> miss_streak & 1:
+        miss_streak += 1
+    weighted_hit_count = 0.0
+    weight_total = 0.0
+    for run_index in range(miss_streak, run_count):
+        weight = OBSERVATION_HISTORY_DECAY ** (run_index - miss_streak)
+        weighted_hit_count += weight * (history >> run_index & 1)
+        weight_total += weight
+    if not weight_total:
+        return DEFAULT_DETECTION_RATE
+    return min(weighted_hit_count / weight_total, MAX_DETECTION_RATE)
+
+
+class IpObservationIndex:
+    """
+    Rolling DNS observations of every ALB node IP of one mapping, kept across invocations: when the IP was last
+    seen and by which authoritative name server, in which of the recent invocations it was seen, and the
+    confidence that it is still in the DNS. The confidence is 1.0 when the latest invocation saw the IP. Every
+    invocation that misses it multiplies it by the probability of that miss if the IP were still in the DNS:
+    1 - (detection rate of the IP) * (sampling confidence of the invocation). An IP that every invocation used to
+    see loses its confidence after one or two confident misses, while an IP that is rarely returned or a sampling
+    that saw little lose it slowly
+    """
+
+    def __init__(self, entry_per_ip=None):
+        """
+        :param entry_per_ip: dict of IP to its entry.
+        e.g. {"1.1.1.1": {"LastSeen": 1621294272, "History": 7, "RunCount": 3, "Confidence": 1.0,
+        "NameServer": "205.251.192.1"}}
+        """
+        self.entry_per_ip = entry_per_ip or {}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        :param state: state from the previous invocation. A state without observations starts an empty index
+        :return: IpObservationIndex
+        """
+        return cls({ip: dict(entry) for (ip, entry) in (state.get("Observations") or {}).items()})
+
+    def update(self, ip_seen_set, dns_observation, now, tracked_ip_set=frozenset()):
+        """
+        Record one invocation
+        :param ip_seen_set: a set of IPs that the invocation saw (in the DNS or in the triggering event)
+        :param dns_observation: DnsObservation of the DNS sampling of the invocation
+        :param now: current time (epoch seconds)
+        :param tracked_ip_set: a set of IPs to observe even when they have no observation yet. e.g. the registered
+        IPs of a state that was written before the observations were kept
+        """
+        for ip in (ip_seen_set | tracked_ip_set) - self.entry_per_ip.keys():
+            self.entry_per_ip[ip] = {
+                "LastSeen": 0, "History": 0, "RunCount": 0, "Confidence": 1.0, "NameServer": None
+            }
+        for ip in ip_seen_set:
+            entry = self.entry_per_ip[ip]
+            entry["History"] = (entry["History"] << 1 | 1) & OBSERVATION_HISTORY_MASK
+            entry["RunCount"] = min(entry["RunCount"] + 1, OBSERVATION_HISTORY_LENGTH)
+            entry["Confidence"] = 1.0
+            if now - entry["LastSeen"] >= LAST_SEEN_RESOLUTION:
+                entry["LastSeen"] = now
+                entry["NameServer"] = dns_observation.nameserver_per_ip.get(ip, entry["NameServer"])
+
+        for (ip, entry) in self.entry_per_ip.items():
+            if ip in ip_seen_set:
+                continue
+            miss_probability = 1 - get_detection_rate(entry) * dns_observation.sampling_confidence
+            entry["History"] = entry["History"] << 1 & OBSERVATION_HISTORY_MASK
+            entry["RunCount"] = min(entry["RunCount"] + 1, OBSERVATION_HISTORY_LENGTH)
+            entry["Confidence"] = round(entry["Confidence"] * miss_probability, CONFIDENCE_DECIMALS)
+
+    def get_confidence(self, ip):
+        """
+        :param ip: ALB node IP
+        :return: confidence that the IP is still in the DNS. 1.0 for an IP without observation
+        """
+        entry = self.entry_per_ip.get(ip)
+        return entry["Confidence"] if entry else 1.0
+
+    def get_low_confidence_ip_set(self, ip_set, confidence_threshold):
+        """
+        :param ip_set: a set of IPs
+        :param confidence_threshold: confidence below which an IP is considered gone from the DNS
+        :return: the IPs of the given set whose confidence is below the threshold
+        """
+        return {ip for ip in ip_set if self.get_confidence(ip) < confidence_threshold}
+
+    def retain(self, ip_set):
+        """
+        Stop observing the IPs that are not in the given set. e.g. the IPs that were deregistered
+        :param ip_set: a set of IPs to keep observing
+        """
+        for ip in set(self.entry_per_ip) - ip_set:
+            del self.entry_per_ip[ip]
+
+    def to_state(self):
+        """
+        :return: the observations as the Observations of the state
+        """
+        return {ip: dict(entry) for (ip, entry) in self.entry_per_ip.items()}
@@ -1,15 +1,25 @@
+from constant import Config, ReconcileTarget
 import json
-from constant import LambdaEnv
 import sys
+import threading
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from aws_services import AwsServices
+from metrics import MetricBuffer, MetricRecorder
+from availability_zone import get_availability_zone_map, get_cached_availability_zone_map
+from lifecycle import IpLifecycleTable, DISCOVERED, DRAINING, MISSING, REGISTERED, STATE_TIMESTAMP_FORMAT
+from observation import DnsObservation, IpObservationIndex
+from state_codec import STATE_ENCODING_BINARY, STATE_ENCODING_JSON
 from common import (
     logger,
     precondition,
     get_elb_ip_from_dns,
-    get_pending_registration_ip_set,
-    get_invocation_count_per_pending_deregistration_ip,
-    get_pending_deregistration_ip_set,
     get_elb_ip_target_from_ip_list,
+    get_alb_name_from_dns_name,
+    get_alb_name_from_eni_description,
+    get_ip_set_per_version,
+    RECORD_TYPE_PER_IP_VERSION,
 )
 
 """
@@ -24,115 +34,480 @@ and deregistration cautiously.
 Configure these environment variables in your Lambda environment (CloudFormation Inputs)
 1. ALB_DNS_NAME - The full DNS name of the internal Application Load Balancer
 2. ALB_LISTENER - The traffic listener port of the internal Application Load Balancer
-3. S3_BUCKET - Bucket to track changes between Lambda invocations
+3. S3_BUCKET - Bucket to track changes between Lambda invocations (one state object per mapping)
 4. NLB_TG_ARN - The ARN of the Network Load Balancer's target group
 5. MAX_LOOKUP_PER_INVOCATION - The max times of DNS look per invocation
-6. INVOCATIONS_BEFORE_DEREGISTRATION  - Then number of required Invocations before a IP is deregistered
-7. CW_METRIC_FLAG_IP_COUNT - The controller flag that enables CloudWatch metric of IP count
+6. INVOCATIONS_BEFORE_DEREGISTRATION  - Then number of required Invocations before a IP is deregistered. Sets the
+   default DEREGISTRATION_DELAY for a one-minute schedule
+7. CW_METRIC_FLAG_IP_COUNT - The controller flag that enables CloudWatch metrics of IP count and the controller
+   metrics (namespace NLBTargetGroupToALB). They are published in batches at the end of every reconcile pass
+8. TARGET_MAPPINGS - (Optional) JSON list of additional ALB to NLB target group mappings. e.g.
+   [{"AlbDnsName": "internal-alb-1.us-east-1.elb.amazonaws.com", "AlbListener": 443, "NlbTgArn": "arn:..."}]
+   All of the mappings are reconciled concurrently by one invocation
+9. RECONCILE_LOOP_INTERVAL - (Optional) Loop mode. Seconds between the start of two reconcile passes within one
+   invocation. Default: 0 (one pass per invocation)
+10. RECONCILE_LOOP_DURATION - (Optional) Max seconds that the loop mode runs for. Keep it below the schedule
+    interval. Default: 0 (until the invocation is near its timeout)
+11. CW_METRIC_FLAG_STEP_METRICS - (Optional) The controller flag that emits the duration of every step and the DNS
+    and API counters as CloudWatch Embedded Metric Format log lines (namespace NLBTargetGroupToALB). Default: false
+12. IP_ADDRESS_TYPE - (Optional) IP address type of the primary NLB target group: ipv4 (A records) or ipv6
+    (AAAA records of a dualstack ALB). Additional mappings set it with "IpAddressType". Default: ipv4
+    An ALB with both IPv4 and IPv6 target groups has its A and AAAA records sampled concurrently
+13. STATE_ENCODING - (Optional) Encoding of the state objects: json, or binary (packed IP addresses and invocation
+    counts behind a version header). Objects of either encoding are read. Default: json
+14. DEREGISTRATION_DELAY - (Optional) Min seconds that a registered IP has to be missing from the DNS for before it
+    is deregistered, however confident the DNS sampling is. It keeps the loop mode and the event-triggered
+    invocations, which run seconds apart, from deregistering an IP after a few quick misses.
+    Default: 0 (derived from INVOCATIONS_BEFORE_DEREGISTRATION for a one-minute schedule)
+15. DEREGISTRATION_CONFIDENCE - (Optional) Confidence (between 0 and 1) that a missing IP is still in the DNS below
+    which it is deregistered. Lower values deregister later. Default: 0.01
+    Every IP goes through a lifecycle (discovered, registered, missing, draining, deregistered) that is kept in the
+    state object with timestamps, next to its DNS observations: when it was last seen and by which authoritative
+    name server, in which of the recent invocations it was seen and the confidence that it is still in the DNS.
+    An IP that every invocation used to see is deregistered after few confident misses. An IP that the DNS rarely
+    returns is kept longer
+The environment variables are read on every invocation into a Config that is passed to the reconcile engine. Every
+mapping is reconciled with the Config that it came from, so cli.py can run the engine with its own configuration
+
+The function runs on a schedule and can also be triggered by an ALB change, which reconciles the mappings
+of that ALB right away:
+1. The creation of an ALB node network interface, from the EC2 API calls that EventBridge receives through
+   CloudTrail. The IP of the new network interface is registered without waiting for it to show up in the DNS
+2. A manual trigger. e.g. {"AlbDnsName": "internal-my-alb-1234567890.us-east-1.elb.amazonaws.com"}
+A dry run ({"DryRun": true}, optionally with "AlbDnsName") runs Step 1 to Step 5 only and returns the reconcile
+plan of every mapping: the IPs to register and deregister, the pending counts and the DNS sampling statistics.
+Nothing is registered, deregistered, uploaded to S3 or published to CloudWatch. cli.py runs it locally
 """
 
+# Max number of reads (DNS sampling, target health, state) or reconciles that run at the same time
+RECONCILE_MAX_WORKERS = 10
+# Reads of one mapping that run at the same time: the DNS sampling of its ALB, its target health and its state
+RECONCILE_READ_COUNT_PER_TARGET = 3
+# Time (in seconds) left before the Lambda timeout when the loop mode stops starting passes
+RECONCILE_LOOP_TIMEOUT_MARGIN = 10
+# Seconds between two scheduled invocations that INVOCATIONS_BEFORE_DEREGISTRATION is counted in
+DEFAULT_SCHEDULE_INTERVAL = 60
+
+# Validated configuration of the latest invocation, reused across warm Lambda invocations. Key: "Config"
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+
+def get_reconcile_target_list(config):
+    """
+    Get the ALB to NLB target group mappings to reconcile: the primary mapping (ALB_DNS_NAME, ALB_LISTENER and
+    NLB_TG_ARN) followed by the additional mappings from TARGET_MAPPINGS. An additional mapping keeps its state
+    object per ALB listener and target group, so several target groups can be mapped to one ALB listener
+    :param config: Config
+    :return: list of ReconcileTarget
+    """
+    reconcile_target_list = []
+    if config.ALB_DNS_NAME:
+        reconcile_target_list.append(
+            ReconcileTarget(
+                config.ALB_DNS_NAME,
+                config.ALB_LISTENER,
+                config.NLB_TG_ARN,
+                state_key_prefix=config.ALB_DNS_NAME,
+                is_primary=True,
+                ip_address_type=config.IP_ADDRESS_TYPE,
+                config=config,
+            )
+        )
+    for target_mapping in json.loads(config.TARGET_MAPPINGS):
+        listener_key_prefix = f"{target_mapping['AlbDnsName']}/{target_mapping['AlbListener']}"
+        # e.g. targetgroup/my-target-group/0123456789abcdef
+        target_group_resource = target_mapping["NlbTgArn"].split(":")[-1]
+        reconcile_target_list.append(
+            ReconcileTarget(
+                target_mapping["AlbDnsName"],
+                int(target_mapping["AlbListener"]),
+                target_mapping["NlbTgArn"],
+                state_key_prefix=f"{listener_key_prefix}/{target_group_resource}",
+                ip_address_type=target_mapping.get("IpAddressType", "ipv4").lower(),
+                config=config,
+                previous_state_key_prefix=listener_key_prefix,
+            )
+        )
+    return reconcile_target_list
+
 
-def validate_environment_variable():
+def validate_environment_variable(config):
     """
-    # Validating the environment variables
+    # Validating the environment variables. A configuration is validated once: its mappings are kept with it
+    :param config: Config
+    :return: list of ReconcileTarget of the configuration
     """
+    if config.reconcile_target_list is not None:
+        return config.reconcile_target_list
+
+    error_message = f"Configuration is invalid: {'; '.join(config.error_list)}"
+    precondition(not config.error_list, error_message)
+
+    error_message = "S3_BUCKET and AWS_REGION are required"
+    precondition(config.S3_BUCKET and config.REGION, error_message)
+
     error_message = "MAX_LOOKUP_PER_INVOCATION is required to be a positive number"
-    precondition(LambdaEnv.MAX_LOOKUP_PER_INVOCATION > 0, error_message)
+    precondition(config.MAX_LOOKUP_PER_INVOCATION > 0, error_message)
 
     error_message = (
         "INVOCATIONS_BEFORE_DEREGISTRATION is required to be a positive number"
     )
-    precondition(LambdaEnv.INVOCATIONS_BEFORE_DEREGISTRATION > 0, error_message)
+    precondition(config.INVOCATIONS_BEFORE_DEREGISTRATION > 0, error_message)
+
+    error_message = "STATE_ENCODING is required to be json or binary"
+    precondition(
+        config.STATE_ENCODING in (STATE_ENCODING_JSON, STATE_ENCODING_BINARY), error_message
+    )
 
+    error_message = "DEREGISTRATION_DELAY is required to be a non-negative number"
+    precondition(config.DEREGISTRATION_DELAY >= 0, error_message)
 
-def get_ip_from_dns():
+    error_message = "DEREGISTRATION_CONFIDENCE is required to be a number between 0 and 1"
+    precondition(0 < config.DEREGISTRATION_CONFIDENCE <= 1, error_message)
+
+    error_message = "RECONCILE_LOOP_INTERVAL and RECONCILE_LOOP_DURATION are required to be non-negative numbers"
+    precondition(
+        config.RECONCILE_LOOP_INTERVAL >= 0 and config.RECONCILE_LOOP_DURATION >= 0,
+        error_message,
+    )
+
+    try:
+        reconcile_target_list = get_reconcile_target_list(config)
+    except (ValueError, KeyError, TypeError) as e:
+        reconcile_target_list = []
+        precondition(False, f"TARGET_MAPPINGS is invalid. Error: {e}")
+
+    error_message = "ALB_DNS_NAME or TARGET_MAPPINGS is required"
+    precondition(reconcile_target_list, error_message)
+
+    for reconcile_target in reconcile_target_list:
+        error_message = f"ALB listener is required to be a positive number - {reconcile_target}"
+        precondition(reconcile_target.alb_listener > 0, error_message)
+        error_message = f"NLB target group ARN is required - {reconcile_target}"
+        precondition(reconcile_target.nlb_tg_arn, error_message)
+        error_message = f"IP address type is required to be ipv4 or ipv6 - {reconcile_target}"
+        precondition(reconcile_target.ip_version, error_message)
+
+    error_message = "ALB to NLB target group mappings are required to be unique"
+    precondition(
+        len({target.state_key for target in reconcile_target_list}) == len(reconcile_target_list),
+        error_message,
+    )
+    config.reconcile_target_list = reconcile_target_list
+    return reconcile_target_list
+
+
+def get_triggered_reconcile_target_list(event, reconcile_target_list):
     """
-    Get ALB node IP address through DNS lookup. Exit if no IP found in the DNS
-    :return: a set of ELB node IP addresses
+    Get the mappings that the event asks to reconcile. Every mapping is reconciled for the scheduled event.
+    An ALB change event reconciles the mappings of that ALB, or every mapping when it matches no configured ALB
+    :param event: Lambda event
+    :param reconcile_target_list: list of every configured ReconcileTarget
+    :return: list of ReconcileTarget to reconcile and a set of ALB node IPs from the event
     """
-    ip_from_dns_set = get_elb_ip_from_dns(
-        LambdaEnv.ALB_DNS_NAME, "A", LambdaEnv.MAX_LOOKUP_PER_INVOCATION
-    )
+    event = event or {}
+    ip_from_event_set = set()
+    if event.get("AlbDnsName"):
+        logger.info(f"Triggered manually for ALB - {event['AlbDnsName']}")
+        alb_name = get_alb_name_from_dns_name(event["AlbDnsName"])
+    elif event.get("source") == "aws.ec2":
+        detail = event.get("detail") or {}
+        network_interface = (detail.get("responseElements") or {}).get("networkInterface") or {}
+        eni_description = (
+            (detail.get("requestParameters") or {}).get("description")
+            or network_interface.get("description")
+        )
+        logger.info(
+            f"Triggered by {detail.get('eventName')} of network interface - {eni_description}"
+        )
+        alb_name = get_alb_name_from_eni_description(eni_description)
+        if network_interface.get("privateIpAddress"):
+            ip_from_event_set.add(network_interface["privateIpAddress"])
+        # The network interface of a dualstack ALB node also has an IPv6 address
+        for ipv6_address in (network_interface.get("ipv6AddressesSet") or {}).get("items") or []:
+            if ipv6_address.get("ipv6Address"):
+                ip_from_event_set.add(ipv6_address["ipv6Address"])
+    else:
+        return reconcile_target_list, ip_from_event_set
+
+    triggered_reconcile_target_list = [
+        reconcile_target
+        for reconcile_target in reconcile_target_list
+        if get_alb_name_from_dns_name(reconcile_target.alb_dns_name) == alb_name
+    ]
+    if not triggered_reconcile_target_list:
+        logger.warning(
+            f"No configured ALB matches the event (ALB name: {alb_name}). Reconcile every mapping"
+        )
+        return reconcile_target_list, set()
     logger.info(
-        f"ELB IPs from DNS lookup: {ip_from_dns_set}. Total IP count: {len(ip_from_dns_set)}"
+        f"Mappings to reconcile: {triggered_reconcile_target_list}. ALB node IPs from the event: {ip_from_event_set}"
     )
+    return triggered_reconcile_target_list, ip_from_event_set
 
-    # Check if there is ALB no IP in the DNS. If so, exit from the current Lambda invocation
-    try:
-        error_message = (
-            f"No IP found from DNS for ALB - {LambdaEnv.ALB_DNS_NAME}. "
-            f"The Lambda function will not proceed with making changes to the NLB target group - {LambdaEnv.NLB_TG_ARN}"
+
+def get_ip_from_dns(
+        config,
+        alb_dns_name,
+        metric_buffer=None,
+        ip_version=4,
+        aws_service=None,
+        dns_observation=None,
+        is_dry_run=False,
+):
+    """
+    Get ALB node IP address through DNS lookup
+    :param config: Config
+    :param alb_dns_name: DNS name of ALB
+    :param metric_buffer: collects the DNS lookup count and the convergence time of the ALB
+    :param ip_version: 4 to look up the A records or 6 to look up the AAAA records of a dualstack ALB
+    :param aws_service: aws service object. When given, the sampling goes on until every Availability Zone of the
+    ALB has at least one node seen
+    :param dns_observation: DnsObservation that collects the sampling confidence and the name server of every IP
+    :param is_dry_run: do not emit the step metrics
+    :return: a set of ELB node IP addresses. Empty when no IP found in the DNS
+    """
+    metric_buffer = metric_buffer or MetricBuffer()
+    record_type = RECORD_TYPE_PER_IP_VERSION[ip_version]
+    # The IPv4 metrics keep their dimensions. The IPv6 ones are told apart by the record type
+    dimensions = {"LoadBalancerName": alb_dns_name}
+    if ip_version == 6:
+        dimensions["RecordType"] = record_type
+    metric_recorder = MetricRecorder(dict(dimensions))
+    availability_zone_map = (
+        get_availability_zone_map(aws_service, alb_dns_name) if aws_service is not None else None
+    )
+    with metric_recorder.time_step("DnsSampling"):
+        ip_from_dns_set = get_ip_set_per_version(
+            get_elb_ip_from_dns(
+                alb_dns_name,
+                record_type,
+                config.MAX_LOOKUP_PER_INVOCATION,
+                metric_recorder=metric_recorder,
+                availability_zone_map=availability_zone_map,
+                dns_observation=dns_observation,
+            )
+        )[ip_version]
+    metric_recorder.put_metric("DnsIPCount", len(ip_from_dns_set))
+    metric_buffer.put("DnsLookupCount", metric_recorder.get_value_sum("DnsLookupCount"), dimensions)
+    metric_buffer.put(
+        "DnsConvergenceTime",
+        metric_recorder.get_value_sum("DnsSamplingDuration"),
+        dimensions,
+        "Milliseconds",
+    )
+    publish_step_metrics(config, metric_recorder, is_dry_run)
+    logger.info(
+        f"ELB IPs from DNS lookup ({alb_dns_name} {record_type}): {ip_from_dns_set}. "
+        f"Total IP count: {len(ip_from_dns_set)}"
+    )
+    if availability_zone_map is not None and availability_zone_map.availability_zone_set:
+        logger.info(
+            f"ELB IPs from DNS lookup per Availability Zone: "
+            f"{availability_zone_map.get_ip_set_per_availability_zone(ip_from_dns_set)}"
         )
-        precondition(ip_from_dns_set, error_message)
-        return ip_from_dns_set
-    except ValueError:
-        sys.exit(1)
+    if not ip_from_dns_set:
+        logger.error(
+            f"No IP found from DNS for ALB - {alb_dns_name} ({record_type}). "
+            f"The Lambda function will not proceed with making changes to its NLB target groups"
+        )
+    return ip_from_dns_set
 
 
-def update_elb_ip_count_metric(aws_service, active_ip_from_dns_meta_data):
+def publish_step_metrics(config, metric_recorder, is_dry_run=False):
     """
-    Publish ELB IP node count CloudWatch Metric
-    :param aws_service: aws service object
+    Emit the step durations and counters as a CloudWatch Embedded Metric Format log line. A dry run emits none, as
+    its metrics would land in the series of the real reconciles
+    :param config: Config
+    :param metric_recorder: metric recorder of one ALB or one mapping
+    :param is_dry_run: True for a dry run
+    """
+    if config.CW_METRIC_FLAG_STEP_METRICS and not is_dry_run:
+        metric_recorder.flush()
+
+
+def update_elb_ip_count_metric(metric_buffer, active_ip_from_dns_meta_data):
+    """
+    Add the ELB IP node count to the metric buffer. The mappings of one ALB add it once per reconcile pass
+    :param metric_buffer: metric buffer of the reconcile pass
     :param active_ip_from_dns_meta_data: meta data of active IPs that are currently in DNS
     :return:
     """
-    if not LambdaEnv.CW_METRIC_FLAG_IP_COUNT:
+    metric_buffer.put(
+        "LoadBalancerIPCount",
+        active_ip_from_dns_meta_data["IPCount"],
+        {"LoadBalancerName": active_ip_from_dns_meta_data["LoadBalancerName"]},
+        is_unique=True,
+    )
+
+
+def publish_metrics(config, aws_service, metric_buffer):
+    """
+    Publish the metrics that were collected by a reconcile pass to CloudWatch in batched calls
+    :param config: Config
+    :param aws_service: aws service object
+    :param metric_buffer: metric buffer of the reconcile pass
+    """
+    if not config.CW_METRIC_FLAG_IP_COUNT:
         logger.info(
             "CW_METRIC_FLAG_IP_COUNT is set to False. Skip publish CloudWatch metric..."
         )
         return
     logger.info(
-        "CW_METRIC_FLAG_IP_COUNT is set to True. Publishing ELB node IP count metric"
+        "CW_METRIC_FLAG_IP_COUNT is set to True. Publishing ELB node IP count and controller metrics"
     )
-    aws_service.publish_elb_ip_count_metric(active_ip_from_dns_meta_data)
+    metric_buffer.flush(aws_service)
 
 
-def get_ip_from_previous_invocation(aws_service):
+def get_deregistration_delay(config):
     """
-    Get active and pending IP from S3. The IPs were collected from the previous invocation
+    :param config: Config
+    :return: seconds that a registered IP has to be missing from the DNS for before it is deregistered
+    """
+    if config.DEREGISTRATION_DELAY:
+        return config.DEREGISTRATION_DELAY
+    # An IP used to be deregistered by the INVOCATIONS_BEFORE_DEREGISTRATION-th invocation that missed it
+    return (config.INVOCATIONS_BEFORE_DEREGISTRATION - 1) * DEFAULT_SCHEDULE_INTERVAL
+
+
+def get_state_from_previous_invocation(aws_service, reconcile_target):
+    """
+    Get the S3 state object that the previous invocation left. Fall back to the state object under the previous
+    state key and then to the legacy active and pending IP objects when the state object does not exist yet
     :param aws_service: aws service object
-    :return:
+    :param reconcile_target: ALB to NLB target group mapping
+    :return: state and the ETag of the state object. e.g.
+    ({"Version": 3, "ActiveIP": {...}, "Targets": {...}, "Observations": {...}}, '"etag"')
     """
-    active_ip_dict_from_previous_invocation = aws_service.download_elb_ip_from_s3(
-        LambdaEnv.ACTIVE_IP_LIST_KEY
-    )
-    pending_ip_dict_from_previous_invocation = aws_service.download_elb_ip_from_s3(
-        LambdaEnv.PENDING_IP_LIST_KEY
-    )
-    logger.info(
-        f"Active IPs from previous invocation: {active_ip_dict_from_previous_invocation}"
-    )
-    logger.info(
-        f"Pending IPs from previous invocation: {pending_ip_dict_from_previous_invocation}"
-    )
-    active_ip_set_from_previous_invocation = set(
-        active_ip_dict_from_previous_invocation.get("IPList", [])
-    )
-    return (
-        active_ip_dict_from_previous_invocation,
-        pending_ip_dict_from_previous_invocation,
-        active_ip_set_from_previous_invocation,
+    state, state_etag = aws_service.download_state_from_s3(reconcile_target.state_key)
+    if not state and reconcile_target.previous_state_key:
+        logger.info(f"No state object found. Read the state object of {reconcile_target.previous_state_key}")
+        # The state is written to the state key of the mapping, so the ETag of the previous one is not kept
+        (state, _) = aws_service.download_state_from_s3(reconcile_target.previous_state_key)
+    if not state and reconcile_target.active_ip_list_key:
+        logger.info("No state object found. Read the legacy active and pending IP objects")
+        state = {
+            "ActiveIP": aws_service.download_elb_ip_from_s3(reconcile_target.active_ip_list_key),
+            "PendingDeregistrationIP": aws_service.download_elb_ip_from_s3(
+                reconcile_target.pending_ip_list_key
+            ),
+        }
+    logger.info(f"State from previous invocation: {state}")
+    return state, state_etag
+
+
+def build_state(active_ip_dict, ip_lifecycle_table, ip_observation_index):
+    """
+    Build the state object that is kept in S3 between invocations
+    :param active_ip_dict: meta data of active IPs
+    :param ip_lifecycle_table: lifecycle of every IP of the mapping
+    :param ip_observation_index: DNS observations of every IP of the mapping
+    :return: state object
+    """
+    return {
+        "Version": Config.STATE_VERSION,
+        "ActiveIP": active_ip_dict,
+        "Targets": ip_lifecycle_table.to_state(),
+        "Observations": ip_observation_index.to_state(),
+    }
+
+
+def save_state(
+        aws_service, reconcile_target, state, state_from_previous_invocation, state_etag
+):
+    """
+    Upload the state to S3 only when it differs from the state loaded from the previous invocation
+    :param aws_service: aws service object
+    :param reconcile_target: ALB to NLB target group mapping
+    :param state: state from the current invocation
+    :param state_from_previous_invocation: state loaded from the previous invocation
+    :param state_etag: ETag of the state object loaded from the previous invocation. None when it did not exist
+    :return: a boolean value indicating whether the state was uploaded
+    """
+    if state_etag and state == state_from_previous_invocation:
+        logger.info("State is unchanged since the previous invocation. Skip uploading state to S3")
+        return False
+    return aws_service.write_state_to_s3(
+        state, reconcile_target.state_key, state_etag, reconcile_target.config.STATE_ENCODING
     )
 
 
+def get_reconcile_plan(
+        reconcile_target,
+        ip_from_dns_set,
+        target_group_snapshot,
+        pending_registration_ip_set,
+        pending_deregistration_ip_set,
+        confidence_per_missing_ip,
+        dns_observation,
+):
+    """
+    Get the machine-readable diff that Step 6 applies to the target group
+    :param reconcile_target: ALB to NLB target group mapping
+    :param ip_from_dns_set: a set of ALB node IPs from the DNS (Step 1)
+    :param target_group_snapshot: TargetGroupSnapshot of the NLB target group (Step 2)
+    :param pending_registration_ip_set: a set of IPs that are pending registration
+    :param pending_deregistration_ip_set: a set of IPs that are pending deregistration
+    :param confidence_per_missing_ip: dict of missing IP to the confidence that it is still in the DNS
+    :param dns_observation: DnsObservation of the DNS sampling (Step 1)
+    :return: reconcile plan (dict)
+    """
+    return {
+        "AlbDnsName": reconcile_target.alb_dns_name,
+        "AlbListener": reconcile_target.alb_listener,
+        "NlbTgArn": reconcile_target.nlb_tg_arn,
+        "IpAddressType": reconcile_target.ip_address_type,
+        "ToRegister": sorted(pending_registration_ip_set),
+        "ToDeregister": sorted(pending_deregistration_ip_set),
+        "PendingRegistrationCount": len(pending_registration_ip_set),
+        "PendingDeregistrationCount": len(pending_deregistration_ip_set),
+        "MissingIPConfidence": confidence_per_missing_ip,
+        "DnsIPCount": len(ip_from_dns_set),
+        "TargetGroupIPCount": len(target_group_snapshot.registered_ip_set),
+        "DrainingIPCount": len(target_group_snapshot.draining_ip_set),
+        "DnsSampling": dns_observation.get_sampling_statistics(),
+    }
+
+
 def update_target_group(
-        pending_registration_ip_set, pending_deregistration_ip_set, aws_service
+        pending_registration_ip_set,
+        pending_deregistration_ip_set,
+        aws_service,
+        reconcile_target,
+        metric_recorder=None,
 ):
     """
-    Update target group by registering new active IPs and deregistering pending IPs whose invocation count
-    is higher than INVOCATIONS_BEFORE_DEREGISTRATION
+    Update target group by registering new active IPs and deregistering the missing IPs that are unlikely to be
+    in the DNS anymore
     :param pending_registration_ip_set: a set of IPs that are pending registration
     :param pending_deregistration_ip_set: a set of IPs that are pending deregistration
     :param aws_service: aws_service object
-    :return: a boolean value indicating whether registration API actually succeeded (default: False)
+    :param reconcile_target: ALB to NLB target group mapping
+    :param metric_recorder: records the durations of registration and deregistration and the target counts
+    :return: a set of IPs that were actually registered and a set of IPs that were actually deregistered
+    (default: empty sets)
     """
-    is_registered = False
+    metric_recorder = metric_recorder or MetricRecorder({})
+    registered_ip_set = set()
+    deregistered_ip_set = set()
     if pending_registration_ip_set:
         pending_registration_ip_target_list = get_elb_ip_target_from_ip_list(
-            list(pending_registration_ip_set), LambdaEnv.ALB_LISTENER
+            list(pending_registration_ip_set),
+            reconcile_target.alb_listener,
+            reconcile_target.config.SAME_VPC,
         )
-        is_registered = aws_service.register_target(
-            LambdaEnv.NLB_TG_ARN, pending_registration_ip_target_list
+        with metric_recorder.time_step("RegisterTargets"):
+            registered_target_list = aws_service.register_target(
+                reconcile_target.nlb_tg_arn,
+                pending_registration_ip_target_list,
+                metric_recorder,
+            )
+        registered_ip_set = {target["Id"] for target in registered_target_list}
+        metric_recorder.add_count("RegisteredTargetCount", len(registered_target_list))
+        metric_recorder.add_count(
+            "FailedRegistrationCount",
+            len(pending_registration_ip_target_list) - len(registered_target_list),
         )
 
     if not pending_registration_ip_set:
@@ -143,50 +518,192 @@ def update_target_group(
     # Deregister target
     if pending_deregistration_ip_set:
         pending_deregistration_ip_target_list = get_elb_ip_target_from_ip_list(
-            list(pending_deregistration_ip_set), LambdaEnv.ALB_LISTENER
-        )
-        aws_service.deregister_target(
-            LambdaEnv.NLB_TG_ARN, pending_deregistration_ip_target_list
+            list(pending_deregistration_ip_set),
+            reconcile_target.alb_listener,
+            reconcile_target.config.SAME_VPC,
         )
+        with metric_recorder.time_step("DeregisterTargets"):
+            deregistered_target_list = aws_service.deregister_target(
+                reconcile_target.nlb_tg_arn,
+                pending_deregistration_ip_target_list,
+                metric_recorder,
+            )
+        deregistered_ip_set = {target["Id"] for target in deregistered_target_list}
+        metric_recorder.add_count("DeregisteredTargetCount", len(deregistered_target_list))
 
     if not pending_deregistration_ip_set:
         logger.info(
             "No pending deregistration IP found. Skipping ELB target deregistration..."
         )
-    return is_registered
+    return registered_ip_set, deregistered_ip_set
 
 
-def lambda_handler(event, context):
+def get_reconcile_metric_recorder(reconcile_target):
     """
-    Main Lambda handler
-    This is invoked when Lambda is called
+    :param reconcile_target: ALB to NLB target group mapping
+    :return: a metric recorder for the step durations and counters of the mapping
     """
+    return MetricRecorder(
+        {
+            "LoadBalancerName": reconcile_target.alb_dns_name,
+            "TargetGroup": reconcile_target.nlb_tg_arn.split(":")[-1],
+        }
+    )
 
-    # Initialize AWS service clients
-    aws_service = AwsServices(region=LambdaEnv.REGION, bucket=LambdaEnv.S3_BUCKET)
 
-    # Validate environment variables
-    validate_environment_variable()
+def load_target_group_snapshot(aws_service, reconcile_target, metric_recorder):
+    """
+    Step 2 of reconcile. Get the targets that are currently registered with the NLB target group
+    :param aws_service: aws service object
+    :param reconcile_target: ALB to NLB target group mapping
+    :param metric_recorder: records the duration of the step
+    :return: TargetGroupSnapshot
+    """
+    logger.info(f"\n>>>>Step-2: Get IPs from target group ({reconcile_target.nlb_tg_arn})<<<<")
+    with metric_recorder.time_step("DescribeTargetHealth"):
+        return aws_service.get_target_group_snapshot(
+            reconcile_target.nlb_tg_arn, metric_recorder
+        )
 
-    # ---- Step 1 -----
-    # Get IP from DNS
-    logger.info("\n>>>>Step-1: Get IPs from DNS<<<<")
-    ip_from_dns_set = get_ip_from_dns()
 
-    # ---- Step 2 -----
-    # Get IP that are currently registered with the NLB target group and update CloudWatch metric
-    logger.info("\n>>>>Step-2: Get IPs from target group<<<<")
-    ip_from_target_group_set = set(
-        aws_service.get_ip_target_list_by_target_group_arn(LambdaEnv.NLB_TG_ARN)
+def load_previous_invocation(aws_service, reconcile_target, metric_recorder):
+    """
+    Step 3 of reconcile. Get the state (active IPs and the lifecycle of every IP) from the previous invocation
+    :param aws_service: aws service object
+    :param reconcile_target: ALB to NLB target group mapping
+    :param metric_recorder: records the duration of the step
+    :return: state and the ETag of the state object
+    """
+    logger.info(
+        f"\n>>>>Step-3: Get the IP lifecycle from S3 (previous invocation) ({reconcile_target.state_key})<<<<"
+    )
+    with metric_recorder.time_step("StateLoad"):
+        return get_state_from_previous_invocation(aws_service, reconcile_target)
+
+
+def reconcile(
+        aws_service,
+        reconcile_target,
+        ip_from_dns_set,
+        target_group_snapshot,
+        previous_invocation,
+        metric_buffer=None,
+        metric_recorder=None,
+        dns_observation=None,
+        is_dry_run=False,
+):
+    """
+    Reconcile one NLB target group with the IPs of its ALB (Step 4 to Step 7) from what was read in Step 1 to Step 3
+    :param aws_service: aws service object
+    :param reconcile_target: ALB to NLB target group mapping
+    :param ip_from_dns_set: a set of ALB node IPs from the DNS (Step 1)
+    :param target_group_snapshot: TargetGroupSnapshot of the NLB target group (Step 2)
+    :param previous_invocation: state and its ETag from the previous invocation (Step 3)
+    :param metric_buffer: collects the CloudWatch metrics of the mapping
+    :param metric_recorder: records the step durations and counters of the mapping
+    :param dns_observation: DnsObservation of the DNS sampling (Step 1). Default: the IPs from the DNS are all of
+    the ALB node IPs
+    :param is_dry_run: stop after Step 5. Nothing is registered, deregistered or uploaded to S3
+    :return: reconcile plan of the mapping
+    """
+    logger.info(f"Reconciling {reconcile_target}")
+    metric_recorder = metric_recorder or get_reconcile_metric_recorder(reconcile_target)
+    try:
+        return reconcile_steps(
+            aws_service,
+            reconcile_target,
+            ip_from_dns_set,
+            target_group_snapshot,
+            previous_invocation,
+            metric_recorder,
+            metric_buffer or MetricBuffer(),
+            dns_observation or DnsObservation(sampling_confidence=1.0),
+            is_dry_run,
+        )
+    finally:
+        publish_step_metrics(reconcile_target.config, metric_recorder, is_dry_run)
+
+
+def reconcile_when_loaded(
+        aws_service,
+        reconcile_target,
+        ip_from_dns_set,
+        target_group_snapshot_future,
+        previous_invocation_future,
+        metric_buffer,
+        metric_recorder,
+        dns_observation,
+        is_dry_run=False,
+):
+    """
+    Wait for Step 2 and Step 3 of a mapping, then reconcile it
+    :param aws_service: aws service object
+    :param reconcile_target: ALB to NLB target group mapping
+    :param ip_from_dns_set: a set of ALB node IPs from the DNS (Step 1)
+    :param target_group_snapshot_future: future of load_target_group_snapshot
+    :param previous_invocation_future: future of load_previous_invocation
+    :param metric_buffer: collects the CloudWatch metrics of the mapping
+    :param metric_recorder: records the step durations and counters of the mapping
+    :param dns_observation: DnsObservation of the DNS sampling (Step 1)
+    :param is_dry_run: stop after Step 5
+    :return: reconcile plan of the mapping
+    """
+    try:
+        target_group_snapshot = target_group_snapshot_future.result()
+        previous_invocation = previous_invocation_future.result()
+    except Exception:
+        publish_step_metrics(reconcile_target.config, metric_recorder, is_dry_run)
+        raise
+    return reconcile(
+        aws_service,
+        reconcile_target,
+        ip_from_dns_set,
+        target_group_snapshot,
+        previous_invocation,
+        metric_buffer,
+        metric_recorder,
+        dns_observation,
+        is_dry_run,
     )
+
+
+def reconcile_steps(
+        aws_service,
+        reconcile_target,
+        ip_from_dns_set,
+        target_group_snapshot,
+        previous_invocation,
+        metric_recorder,
+        metric_buffer,
+        dns_observation,
+        is_dry_run=False,
+):
+    """
+    Step 4 to Step 7 of reconcile. The duration of every step is recorded
+    :param aws_service: aws service object
+    :param reconcile_target: ALB to NLB target group mapping
+    :param ip_from_dns_set: a set of ALB node IPs from the DNS (Step 1)
+    :param target_group_snapshot: TargetGroupSnapshot of the NLB target group (Step 2)
+    :param previous_invocation: state and its ETag from the previous invocation (Step 3)
+    :param metric_recorder: records the step durations and counters of the mapping
+    :param metric_buffer: collects the CloudWatch metrics of the mapping
+    :param dns_observation: DnsObservation of the DNS sampling (Step 1)
+    :param is_dry_run: stop after Step 5. Nothing is registered, deregistered or uploaded to S3
+    :return: reconcile plan of the mapping
+    """
+    # Draining targets are on their way out. They are neither registered again nor deregistered again
+    ip_from_target_group_set = target_group_snapshot.registered_ip_set
+    draining_ip_set = target_group_snapshot.draining_ip_set
     logger.info(
-        f"ELB IPs from target group ({LambdaEnv.NLB_TG_ARN}): {ip_from_target_group_set}. "
-        f"Total IP count: {len(ip_from_target_group_set)}"
+        f"ELB IPs from target group ({reconcile_target.nlb_tg_arn}): {ip_from_target_group_set}. "
+        f"Total IP count: {len(ip_from_target_group_set)}. Draining IPs: {draining_ip_set}"
     )
 
+    config = reconcile_target.config
+    now = int(time.time())
     active_ip_from_dns_meta_data = {
-        "LoadBalancerName": LambdaEnv.ALB_DNS_NAME,
-        "TimeStamp": LambdaEnv.TIME,
+        "LoadBalancerName": reconcile_target.alb_dns_name,
+        "TimeStamp": datetime.fromtimestamp(now, timezone.utc).strftime(STATE_TIMESTAMP_FORMAT),
         "IPList": list(ip_from_dns_set),
         "IPCount": len(ip_from_dns_set),
     }
@@ -194,70 +711,440 @@ def lambda_handler(event, context):
         f"Meta data of active IPs in DNS from the current invocation: {active_ip_from_dns_meta_data}"
     )
 
-    # Update ELB IP count metric if CW_METRIC_FLAG_IP_COUNT is set to True
-    update_elb_ip_count_metric(aws_service, active_ip_from_dns_meta_data)
+    # Add the ELB IP count metric. It is published at the end of the pass if CW_METRIC_FLAG_IP_COUNT is set to True
+    update_elb_ip_count_metric(metric_buffer, active_ip_from_dns_meta_data)
 
-    # ---- Step 3 -----
-    # Get the active and pending ALB IPs that were collected from the previous invocation
-    logger.info(
-        "\n>>>>Step-3: Get active and pending IPs from S3 (previous invocation)<<<<"
-    )
-    (
-        active_ip_dict_from_previous_invocation,
-        pending_ip_dict_from_previous_invocation,
-        active_ip_set_from_previous_invocation,
-    ) = get_ip_from_previous_invocation(aws_service)
+    (state_from_previous_invocation, state_etag) = previous_invocation
+    active_ip_dict_from_previous_invocation = state_from_previous_invocation.get("ActiveIP", {})
+    ip_lifecycle_table = IpLifecycleTable.from_state(state_from_previous_invocation, now)
+    ip_observation_index = IpObservationIndex.from_state(state_from_previous_invocation)
+    diff_start_time = time.perf_counter()
 
     # ---- Step 4 -----
-    # Get IPs that are pending for registration
-    logger.info("\n>>>>Step-4: Get IPs that are pending for registration<<<<")
-    pending_registration_ip_set = get_pending_registration_ip_set(
-        ip_from_dns_set,
-        ip_from_target_group_set
+    # Update the IP lifecycle from what entered or left the DNS and the target group. The IPs that are in the DNS
+    # and not registered are pending registration. Draining targets are neither registered nor deregistered again
+    logger.info("\n>>>>Step-4: Update the IP lifecycle and get IPs that are pending for registration<<<<")
+    ip_lifecycle_table.update(ip_from_dns_set, ip_from_target_group_set, draining_ip_set, now)
+    ip_observation_index.update(
+        ip_from_dns_set, dns_observation, now, ip_lifecycle_table.get_ip_set(REGISTERED, MISSING)
     )
+    pending_registration_ip_set = ip_lifecycle_table.get_ip_set(DISCOVERED)
     logger.info(
         f"Pending registration IPs for the current invocation - {pending_registration_ip_set}"
     )
 
     # ---- Step 5 -----
-    # Get IPs that are pending for deregistration and their invocation count
-    logger.info("\n>>>>Step-5: Get IPs that are pending for deregistration and their invocation count<<<<")
-    invocation_count_per_pending_deregistration_ip = get_invocation_count_per_pending_deregistration_ip(
-        ip_from_dns_set,
-        ip_from_target_group_set,
-        active_ip_set_from_previous_invocation,
-        pending_ip_dict_from_previous_invocation,
+    # Get the missing IPs that are unlikely to be in the DNS anymore
+    logger.info("\n>>>>Step-5: Get IPs that are pending for deregistration<<<<")
+    pending_deregistration_ip_set = ip_observation_index.get_low_confidence_ip_set(
+        ip_lifecycle_table.get_pending_deregistration_ip_set(now, get_deregistration_delay(config)),
+        config.DEREGISTRATION_CONFIDENCE,
+    )
+    confidence_per_missing_ip = {
+        ip: ip_observation_index.get_confidence(ip) for ip in ip_lifecycle_table.get_ip_set(MISSING)
+    }
+    logger.info(
+        f"IPs missing from the DNS (confidence that they are still in the DNS): {confidence_per_missing_ip}. "
+        f"Pending deregistration IPs (missing for {get_deregistration_delay(config)}s or more and confidence "
+        f"below {config.DEREGISTRATION_CONFIDENCE}) for the current invocation - {pending_deregistration_ip_set}"
     )
-    pending_deregistration_ip_set = get_pending_deregistration_ip_set(
-        invocation_count_per_pending_deregistration_ip,
-        LambdaEnv.INVOCATIONS_BEFORE_DEREGISTRATION,
+
+    metric_recorder.put_metric(
+        "DiffDuration", (time.perf_counter() - diff_start_time) * 1000, "Milliseconds"
+    )
+    metric_recorder.put_metric("PendingRegistrationCount", len(pending_registration_ip_set))
+    metric_recorder.put_metric("PendingDeregistrationCount", len(pending_deregistration_ip_set))
+    reconcile_plan = get_reconcile_plan(
+        reconcile_target,
+        ip_from_dns_set,
+        target_group_snapshot,
+        pending_registration_ip_set,
+        pending_deregistration_ip_set,
+        confidence_per_missing_ip,
+        dns_observation,
     )
+    if is_dry_run:
+        logger.info(f"Dry run. Skip Step 6 and Step 7. Reconcile plan: {json.dumps(reconcile_plan)}")
+        return reconcile_plan
 
     # ---- Step 6 -----
     # Update IP targets in the NLB target group (registration and deregistration)
     logger.info("\n>>>>Step-6: Update IP targets in the NLB target group (registration and deregistration)<<<<")
-    logger.info(f"SAME VPC is set to: {LambdaEnv.SAME_VPC}")
-    is_registered = update_target_group(
-        pending_registration_ip_set, pending_deregistration_ip_set, aws_service
+    logger.info(f"SAME VPC is set to: {config.SAME_VPC}")
+    (registered_ip_set, deregistered_ip_set) = update_target_group(
+        pending_registration_ip_set,
+        pending_deregistration_ip_set,
+        aws_service,
+        reconcile_target,
+        metric_recorder,
     )
+    # The IPs that failed to register stay discovered, so the next invocation retries them
+    ip_lifecycle_table.set_lifecycle_state(registered_ip_set, REGISTERED, now)
+    ip_lifecycle_table.set_lifecycle_state(deregistered_ip_set, DRAINING, now)
+    ip_lifecycle_table.prune(now)
+    # Only the IPs that can still be registered or deregistered are observed
+    ip_observation_index.retain(ip_lifecycle_table.get_ip_set(DISCOVERED, REGISTERED, MISSING))
 
     # ---- Step 7 -----
-    # Upload the active and pending IP from the current invocation to S3
-    logger.info("\n>>>>Step-7: Upload the active and pending IP from the current invocation to S3<<<<")
-    # Only upload the current active IP to S3 when registration API succeeded
-    # The next invocation will skip the IPs that have already been registered
-    if is_registered:
-        logger.info(f"Upload active IP to S3: {active_ip_from_dns_meta_data}")
-        aws_service.write_content_to_s3(
-            json.dumps(active_ip_from_dns_meta_data), LambdaEnv.ACTIVE_IP_LIST_KEY
+    # Upload the active IPs and the IP lifecycle from the current invocation to S3
+    logger.info("\n>>>>Step-7: Upload the active IPs and the IP lifecycle from the current invocation to S3<<<<")
+    # Only replace the active IP when registration API succeeded for at least one IP
+    if registered_ip_set:
+        failed_registration_ip_set = pending_registration_ip_set - registered_ip_set
+        active_ip_set = ip_from_dns_set - failed_registration_ip_set
+        active_ip_dict = dict(
+            active_ip_from_dns_meta_data,
+            IPList=list(active_ip_set),
+            IPCount=len(active_ip_set),
+        )
+        logger.info(
+            f"Upload active IP to S3: {active_ip_dict}. IPs failed to register: {failed_registration_ip_set}"
         )
     else:
-        logger.info(f"No IPs were registered. Skip uploading active IP to S3: {active_ip_from_dns_meta_data}")
+        logger.info(f"No IPs were registered. Keep the active IP from the previous invocation: "
+                    f"{active_ip_dict_from_previous_invocation}")
+        active_ip_dict = active_ip_dict_from_previous_invocation
 
-    logger.info(
-        f"Upload pending deregistration IP to S3: {invocation_count_per_pending_deregistration_ip}"
+    ip_count_per_lifecycle_state = ip_lifecycle_table.get_ip_count_per_lifecycle_state()
+    logger.info(f"Upload IP lifecycle to S3. IP count per lifecycle state: {ip_count_per_lifecycle_state}")
+    with metric_recorder.time_step("StateSave"):
+        is_state_uploaded = save_state(
+            aws_service,
+            reconcile_target,
+            build_state(active_ip_dict, ip_lifecycle_table, ip_observation_index),
+            state_from_previous_invocation,
+            state_etag,
+        )
+    metric_recorder.add_count("StateUploadCount", int(bool(is_state_uploaded)))
+
+    dimensions = {
+        "LoadBalancerName": reconcile_target.alb_dns_name,
+        "TargetGroup": reconcile_target.nlb_tg_arn.split(":")[-1],
+    }
+    metric_buffer.put("TargetGroupIPCount", len(ip_from_target_group_set), dimensions)
+    # The targets of another VPC are registered with the Availability Zone "all". They are counted in the
+    # Availability Zone of their ALB subnet, from the map that the DNS sampling of the pass read
+    ip_count_by_availability_zone = target_group_snapshot.get_ip_count_by_availability_zone(
+        get_cached_availability_zone_map(reconcile_target.alb_dns_name)
+    )
+    for (availability_zone, ip_count) in ip_count_by_availability_zone.items():
+        metric_buffer.put(
+            "TargetGroupIPCount",
+            ip_count,
+            dict(dimensions, AvailabilityZone=availability_zone),
+        )
+    metric_buffer.put("RegisteredIPCount", len(registered_ip_set), dimensions)
+    metric_buffer.put(
+        "PendingDeregistrationIPCount",
+        ip_count_per_lifecycle_state[MISSING],
+        dimensions,
+    )
+    return reconcile_plan
+
+
+def reconcile_pass(
+        executor,
+        aws_service,
+        reconcile_target_list,
+        ip_from_event_set,
+        metric_buffer,
+        is_dry_run=False,
+        reconcile_plan_list=None,
+):
+    """
+    Run one reconcile pass over the given mappings (Step 1 to Step 7)
+    :param executor: thread pool that runs the reads of Step 1 to Step 3 and reconciles the mappings
+    :param aws_service: aws service object
+    :param reconcile_target_list: list of ReconcileTarget to reconcile
+    :param ip_from_event_set: a set of ALB node IPs from the event. They are added to the IPs from the DNS
+    :param metric_buffer: collects the CloudWatch metrics of the pass
+    :param is_dry_run: stop every mapping after Step 5. Nothing is registered, deregistered or uploaded to S3
+    :param reconcile_plan_list: collects the reconcile plan of every mapping that was reconciled
+    :return: a boolean value indicating whether an ALB has no IP in the DNS or a mapping failed to reconcile
+    """
+    # ---- Step 1 to Step 3 -----
+    # The reads do not depend on each other, so the DNS sampling of every ALB, the target health of every target
+    # group and the state of every mapping are read concurrently. A pass takes about as long as its slowest read
+    # and not the sum of them
+    logger.info("\n>>>>Step-1: Get IPs from DNS<<<<")
+    # Every ALB is sampled once per IP version, even when it is mapped to more than one target group. The A and
+    # AAAA records of a dualstack ALB are sampled at the same time
+    # An ALB is sampled with the configuration of its first mapping
+    config_per_alb = {}
+    for reconcile_target in reconcile_target_list:
+        config_per_alb.setdefault(
+            (reconcile_target.alb_dns_name, reconcile_target.ip_version), reconcile_target.config
+        )
+    dns_observation_per_alb = {alb_key: DnsObservation() for alb_key in config_per_alb}
+    ip_from_dns_future_per_alb = {
+        (alb_dns_name, ip_version): executor.submit(
+            get_ip_from_dns,
+            config,
+            alb_dns_name,
+            metric_buffer,
+            ip_version,
+            aws_service,
+            dns_observation_per_alb[(alb_dns_name, ip_version)],
+            is_dry_run,
+        )
+        for ((alb_dns_name, ip_version), config) in config_per_alb.items()
+    }
+    metric_recorder_per_target = {
+        reconcile_target: get_reconcile_metric_recorder(reconcile_target)
+        for reconcile_target in reconcile_target_list
+    }
+    target_group_snapshot_future_per_target = {
+        reconcile_target: executor.submit(
+            load_target_group_snapshot, aws_service, reconcile_target, metric_recorder
+        )
+        for (reconcile_target, metric_recorder) in metric_recorder_per_target.items()
+    }
+    previous_invocation_future_per_target = {
+        reconcile_target: executor.submit(
+            load_previous_invocation, aws_service, reconcile_target, metric_recorder
+        )
+        for (reconcile_target, metric_recorder) in metric_recorder_per_target.items()
+    }
+    # The IPs of new ALB nodes from the event are added, as they show up in the DNS only later
+    ip_from_event_set_per_version = get_ip_set_per_version(ip_from_event_set)
+    # A failed DNS sampling of one ALB (e.g. its name servers cannot be resolved) skips the mappings of that ALB
+    # and fails the pass. The mappings of the other ALBs are reconciled
+    ip_from_dns_set_per_alb = {}
+    for ((alb_dns_name, ip_version), ip_from_dns_future) in ip_from_dns_future_per_alb.items():
+        try:
+            ip_from_dns_set_per_alb[(alb_dns_name, ip_version)] = (
+                    ip_from_dns_future.result() | ip_from_event_set_per_version[ip_version]
+            )
+        except Exception as e:
+            logger.exception(f"Failed to get IPs from DNS for ALB - {alb_dns_name} (IPv{ip_version}). Error: {e}")
+            ip_from_dns_set_per_alb[(alb_dns_name, ip_version)] = set()
+
+    # ---- Step 4 to Step 7 -----
+    # Reconcile the target groups whose ALB has IPs in the DNS. The reconcile of a mapping waits for its own
+    # reads only. They were submitted first, so they are already running and the wait cannot deadlock the pool
+    reconcile_future_per_target = {}
+    for reconcile_target in reconcile_target_list:
+        metric_recorder = metric_recorder_per_target[reconcile_target]
+        alb_key = (reconcile_target.alb_dns_name, reconcile_target.ip_version)
+        if not ip_from_dns_set_per_alb[alb_key]:
+            publish_step_metrics(reconcile_target.config, metric_recorder, is_dry_run)
+            continue
+        reconcile_future_per_target[reconcile_target] = executor.submit(
+            reconcile_when_loaded,
+            aws_service,
+            reconcile_target,
+            ip_from_dns_set_per_alb[alb_key],
+            target_group_snapshot_future_per_target[reconcile_target],
+            previous_invocation_future_per_target[reconcile_target],
+            metric_buffer,
+            metric_recorder,
+            dns_observation_per_alb[alb_key],
+            is_dry_run,
+        )
+    is_failed = not all(ip_from_dns_set_per_alb.values())
+    for reconcile_target, reconcile_future in reconcile_future_per_target.items():
+        try:
+            reconcile_plan = reconcile_future.result()
+            if reconcile_plan_list is not None:
+                reconcile_plan_list.append(reconcile_plan)
+        except Exception as e:
+            logger.exception(f"Failed to reconcile {reconcile_target}. Error: {e}")
+            is_failed = True
+    return is_failed
+
+
+def get_reconcile_loop_deadline(config, context):
+    """
+    Get the time (time.monotonic) after which the loop mode starts no more passes
+    :param config: Config
+    :param context: Lambda context
+    :return: loop deadline. None when the loop mode is off
+    """
+    if not config.RECONCILE_LOOP_INTERVAL or context is None:
+        return None
+    loop_duration = (
+            context.get_remaining_time_in_millis() / 1000 - RECONCILE_LOOP_TIMEOUT_MARGIN
+    )
+    if config.RECONCILE_LOOP_DURATION:
+        loop_duration = min(loop_duration, config.RECONCILE_LOOP_DURATION)
+    return time.monotonic() + loop_duration
+
+
+def get_max_worker_count(reconcile_target_list):
+    """
+    :param reconcile_target_list: list of ReconcileTarget to reconcile
+    :return: size of the thread pool of the reconcile passes
+    """
+    return min(
+        RECONCILE_MAX_WORKERS,
+        RECONCILE_READ_COUNT_PER_TARGET * len(reconcile_target_list),
     )
-    aws_service.write_content_to_s3(
-        json.dumps(invocation_count_per_pending_deregistration_ip),
-        LambdaEnv.PENDING_IP_LIST_KEY,
+
+
+def plan(aws_service, reconcile_target_list, ip_from_event_set):
+    """
+    Dry run. Run Step 1 to Step 5 of one reconcile pass without registering, deregistering, uploading the state or
+    publishing metrics
+    :param aws_service: aws service object
+    :param reconcile_target_list: list of ReconcileTarget to plan
+    :param ip_from_event_set: a set of ALB node IPs from the event
+    :return: dict of the reconcile plan of every mapping. e.g.
+    {"DryRun": True, "IsFailed": False, "Plans": [{"AlbDnsName": "...", "ToRegister": ["10.0.0.1"], ...}]}
+    """
+    reconcile_plan_list = []
+    with ThreadPoolExecutor(max_workers=get_max_worker_count(reconcile_target_list)) as executor:
+        is_failed = reconcile_pass(
+            executor,
+            aws_service,
+            reconcile_target_list,
+            ip_from_event_set,
+            MetricBuffer(),
+            is_dry_run=True,
+            reconcile_plan_list=reconcile_plan_list,
+        )
+    return {"DryRun": True, "IsFailed": is_failed, "Plans": reconcile_plan_list}
+
+
+def run_reconcile_pass_and_publish(executor, config, aws_service, reconcile_target_list, ip_from_event_set):
+    """
+    Run one reconcile pass with a new metric buffer and publish its metrics. A pass that raises is logged and
+    counted as failed, so the loop mode and the daemon go on to the next pass
+    :param executor: thread pool of the passes
+    :param config: Config
+    :param aws_service: AwsServices
+    :param reconcile_target_list: list of ReconcileTarget to reconcile
+    :param ip_from_event_set: a set of ALB node IPs from the event
+    :return: True when the pass failed
+    """
+    # A new buffer per pass. It is not flushed when the IP count metrics are off
+    metric_buffer = MetricBuffer()
+    try:
+        is_failed = reconcile_pass(
+            executor, aws_service, reconcile_target_list, ip_from_event_set, metric_buffer
+        )
+    except Exception as e:
+        logger.exception(f"Reconcile pass failed. Error: {e}")
+        is_failed = True
+    try:
+        publish_metrics(config, aws_service, metric_buffer)
+    except Exception as e:
+        logger.exception(f"Failed to publish the metrics of the reconcile pass. Error: {e}")
+    return is_failed
+
+
+def run_reconcile_passes(
+        config,
+        aws_service,
+        reconcile_target_list,
+        ip_from_event_set,
+        loop_deadline,
+        stop_event=None,
+):
+    """
+    Run one reconcile pass, then more passes every RECONCILE_LOOP_INTERVAL seconds until the loop deadline
+    :param config: Config. Its RECONCILE_LOOP_INTERVAL and CloudWatch metric flag apply to every pass
+    :param aws_service: AwsServices
+    :param reconcile_target_list: list of ReconcileTarget to reconcile
+    :param ip_from_event_set: a set of ALB node IPs from the triggering event. Only used by the first pass
+    :param loop_deadline: time (time.monotonic) after which no more passes start. None: one pass. math.inf: until
+    the stop event is set
+    :param stop_event: threading.Event that stops the passes when it is set. e.g. on SIGTERM of a daemon
+    :return: True when a pass failed
+    """
+    # The thread pool outlives the passes of the loop mode, so every thread keeps its DNS sampler
+    with ThreadPoolExecutor(max_workers=get_max_worker_count(reconcile_target_list)) as executor:
+        pass_start_time = time.monotonic()
+        is_failed = run_reconcile_pass_and_publish(
+            executor, config, aws_service, reconcile_target_list, ip_from_event_set
+        )
+        longest_pass_duration = time.monotonic() - pass_start_time
+
+        # Loop mode: run more passes until the deadline. Deregistration goes by the time an IP is missing from the
+        # DNS, so every pass deregisters as well. The state is only uploaded to S3 when a pass changes it
+        pass_count = 1
+        while loop_deadline is not None:
+            next_pass_start_time = pass_start_time + config.RECONCILE_LOOP_INTERVAL
+            if next_pass_start_time + longest_pass_duration > loop_deadline:
+                logger.info(
+                    f"Reconcile loop is near its deadline. Stop after {pass_count} passes"
+                )
+                break
+            wait_duration = max(next_pass_start_time - time.monotonic(), 0)
+            if stop_event is None:
+                time.sleep(wait_duration)
+            elif stop_event.wait(wait_duration):
+                logger.info(f"Reconcile loop is stopped after {pass_count} passes")
+                break
+            pass_count += 1
+            logger.info(f"\n>>>>Reconcile loop pass-{pass_count}<<<<")
+            pass_start_time = time.monotonic()
+            is_failed = (
+                run_reconcile_pass_and_publish(
+                    executor, config, aws_service, reconcile_target_list, set()
+                )
+                or is_failed
+            )
+            longest_pass_duration = max(
+                longest_pass_duration, time.monotonic() - pass_start_time
+            )
+    return is_failed
+
+
+def get_config(environ=None):
+    """
+    Read the configuration of one invocation from the environment variables and validate it. The validated
+    configuration is reused for as long as the environment variables are unchanged, so a warm container only
+    validates it once
+    :param environ: environment variables. Default: os.environ
+    :return: Config
+    """
+    config = Config.from_environment(environ)
+    with _config_cache_lock:
+        cached_config = _config_cache.get("Config")
+        if cached_config is not None and cached_config.value_per_variable == config.value_per_variable:
+            return cached_config
+    validate_environment_variable(config)
+    with _config_cache_lock:
+        _config_cache["Config"] = config
+    return config
+
+
+def reconcile_event(config, event, context):
+    """
+    Reconcile the mappings of a configuration that the event asks for
+    :param config: Config
+    :param event: Lambda event
+    :param context: Lambda context. None outside of Lambda
+    :return: the reconcile plans for a dry run event
+    """
+
+    # Validate environment variables
+    reconcile_target_list = validate_environment_variable(config)
+
+    # Initialize AWS service clients. They are shared by all of the mappings
+    aws_service = AwsServices.from_config(config)
+
+    # Pick the mappings to reconcile. An ALB change only reconciles the mappings of that ALB
+    (
+        reconcile_target_list,
+        ip_from_event_set,
+    ) = get_triggered_reconcile_target_list(event, reconcile_target_list)
+    if (event or {}).get("DryRun"):
+        return plan(aws_service, reconcile_target_list, ip_from_event_set)
+    loop_deadline = get_reconcile_loop_deadline(config, context)
+
+    is_failed = run_reconcile_passes(
+        config, aws_service, reconcile_target_list, ip_from_event_set, loop_deadline
     )
+
+    # Fail the invocation when an ALB has no IP in the DNS or a mapping failed to reconcile
+    if is_failed:
+        sys.exit(1)
+
+
+def lambda_handler(event, context):
+    """
+    Main Lambda handler
+    This is invoked when Lambda is called
+    """
+    return reconcile_event(get_config(), event, context)
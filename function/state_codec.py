@@ -0,0 +1,287 @@
+import calendar
+import json
+import socket
+import struct
+import time
+from common import logger
+from lifecycle import LIFECYCLE_STATE_LIST, STATE_TIMESTAMP_FORMAT
+
+# Encodings of the state object
+STATE_ENCODING_JSON = "json"
+STATE_ENCODING_BINARY = "binary"
+# First bytes of a binary state object. A JSON state object starts with "{"
+BINARY_STATE_MAGIC = b"NLBS"
+# Version of the binary layout. Bump it when the layout changes and keep decoding the older ones
+# 1: active IPs and pending deregistration invocation counts. 2: active IPs and the lifecycle of every IP.
+# 3: active IPs, the lifecycle and the DNS observations of every IP
+BINARY_STATE_FORMAT_VERSION = 3
+# Magic, binary layout version and state version
+BINARY_STATE_HEADER = struct.Struct("!4sBB")
+# Pending deregistration invocation count of a version 1 layout
+INVOCATION_COUNT_FORMAT = struct.Struct("!H")
+# Lifecycle of an IP: lifecycle state index, Since, FirstSeen and MissingSince (0: not missing) in epoch seconds
+LIFECYCLE_ENTRY_FORMAT = struct.Struct("!BIII")
+# DNS observations of an IP: LastSeen, History, RunCount, Confidence in 1/10000 and the packed IPv4 address of the
+# NameServer (0.0.0.0: none)
+OBSERVATION_ENTRY_FORMAT = struct.Struct("!IHBH4s")
+# Scale of the Confidence in the binary layout. The Confidence is kept with 4 decimals, so it is packed exactly
+CONFIDENCE_SCALE = 10000
+NO_NAMESERVER = socket.inet_pton(socket.AF_INET, "0.0.0.0")
+# Keys of the active IP dict that the binary layout holds
+ACTIVE_IP_KEY_SET = {"LoadBalancerName", "TimeStamp", "IPList", "IPCount"}
+STATE_KEY_SET = {"Version", "ActiveIP", "Targets", "Observations"}
+LIFECYCLE_ENTRY_KEY_SET = {"State", "Since", "FirstSeen", "MissingSince"}
+OBSERVATION_ENTRY_KEY_SET = {"LastSeen", "History", "RunCount", "Confidence", "NameServer"}
+# Packed IP address length per address family. The addresses of one family are packed back to back
+IP_LENGTH_PER_ADDRESS_FAMILY = {socket.AF_INET: 4, socket.AF_INET6: 16}
+
+
+def get_address_family(ip):
+    """
+    :param ip: IPv4 or IPv6 address
+    :return: socket.AF_INET or socket.AF_INET6
+    """
+    return socket.AF_INET6 if ":" in ip else socket.AF_INET
+
+
+def pack_ip_block(ip_list, value_format=None, value_per_ip=None):
+    """
+    Pack the IPv4 addresses followed by the IPv6 addresses, each block behind its 16-bit count. The order of the
+    addresses within a family is kept
+    :param ip_list: list of IP addresses
+    :param value_format: struct of the values that follow every address. None when there is no value
+    :param value_per_ip: dict of IP to its values (tuple)
+    :return: packed addresses
+    """
+    part_list = []
+    for address_family in IP_LENGTH_PER_ADDRESS_FAMILY:
+        family_ip_list = [ip for ip in ip_list if get_address_family(ip) == address_family]
+        part_list.append(struct.pack("!H", len(family_ip_list)))
+        for ip in family_ip_list:
+            try:
+                part_list.append(socket.inet_pton(address_family, ip))
+            except OSError:
+                raise ValueError(f"Invalid IP address: {ip}")
+            if value_format is not None:
+                part_list.append(value_format.pack(*value_per_ip[ip]))
+    return b"".join(part_list)
+
+
+def unpack_ip_block(body, offset, value_format=None):
+    """
+    Unpack what pack_ip_block packed
+    :param body: binary state object
+    :param offset: offset of the IPv4 address count
+    :param value_format: struct of the values that follow every address. None when there is no value
+    :return: list of (IP address, values) and the offset of the first byte after the block
+    """
+    value_format_text = value_format.format.lstrip("!") if value_format is not None else ""
+    ip_list = []
+    for (address_family, ip_length) in IP_LENGTH_PER_ADDRESS_FAMILY.items():
+        (ip_count,) = struct.unpack_from("!H", body, offset)
+        offset += 2
+        entry_format = struct.Struct(f"!{ip_length}s{value_format_text}")
+        block_end = offset + ip_count * entry_format.size
+        if block_end > len(body):
+            raise ValueError("Binary state is truncated")
+        # Unpack the whole block in one call
+        for entry in entry_format.iter_unpack(body[offset: block_end]):
+            ip_list.append((socket.inet_ntop(address_family, entry[0]), entry[1:]))
+        offset = block_end
+    return ip_list, offset
+
+
+def pack_active_ip(active_ip_dict):
+    """
+    :param active_ip_dict: active IP dict of the state
+    :return: packed active IP dict
+    """
+    if set(active_ip_dict) != ACTIVE_IP_KEY_SET:
+        raise ValueError("Active IPs hold keys that the binary layout does not")
+    if active_ip_dict["IPCount"] != len(active_ip_dict["IPList"]):
+        raise ValueError("IPCount of the active IPs does not match their IPList")
+    load_balancer_name = active_ip_dict["LoadBalancerName"].encode()
+    timestamp = calendar.timegm(time.strptime(active_ip_dict["TimeStamp"], STATE_TIMESTAMP_FORMAT))
+    return b"".join(
+        [
+            struct.pack("!H", len(load_balancer_name)),
+            load_balancer_name,
+            struct.pack("!I", timestamp),
+            pack_ip_block(active_ip_dict["IPList"]),
+        ]
+    )
+
+
+def unpack_active_ip(body, offset):
+    """
+    :param body: binary state object
+    :param offset: offset of the packed active IP dict
+    :return: active IP dict and the offset of the first byte after it
+    """
+    (load_balancer_name_length,) = struct.unpack_from("!H", body, offset)
+    offset += 2
+    load_balancer_name = bytes(body[offset: offset + load_balancer_name_length]).decode()
+    offset += load_balancer_name_length
+    (timestamp,) = struct.unpack_from("!I", body, offset)
+    (active_ip_list, offset) = unpack_ip_block(body, offset + 4)
+    active_ip_dict = {
+        "LoadBalancerName": load_balancer_name,
+        "TimeStamp": time.strftime(STATE_TIMESTAMP_FORMAT, time.gmtime(timestamp)),
+        "IPList": [ip for (ip, _) in active_ip_list],
+        "IPCount": len(active_ip_list),
+    }
+    return active_ip_dict, offset
+
+
+def pack_observation_entry(entry):
+    """
+    :param entry: DNS observations of an IP
+    :return: values of the IP in OBSERVATION_ENTRY_FORMAT
+    """
+    try:
+        nameserver = socket.inet_pton(socket.AF_INET, entry["NameServer"]) if entry["NameServer"] else NO_NAMESERVER
+    except OSError:
+        raise ValueError(f"Name server is not an IPv4 address: {entry['NameServer']}")
+    return (
+        entry["LastSeen"],
+        entry["History"],
+        entry["RunCount"],
+        round(entry["Confidence"] * CONFIDENCE_SCALE),
+        nameserver,
+    )
+
+
+def unpack_observation_entry(value_tuple):
+    """
+    :param value_tuple: values of an IP in OBSERVATION_ENTRY_FORMAT
+    :return: DNS observations of the IP
+    """
+    (last_seen, history, run_count, confidence, nameserver) = value_tuple
+    return {
+        "LastSeen": last_seen,
+        "History": history,
+        "RunCount": run_count,
+        "Confidence": confidence / CONFIDENCE_SCALE,
+        "NameServer": socket.inet_ntop(socket.AF_INET, nameserver) if nameserver != NO_NAMESERVER else None,
+    }
+
+
+def encode_binary_state(state):
+    """
+    Encode the state as packed 4 or 16-byte addresses, with the lifecycle of every IP as a small integer state
+    and 32-bit timestamps and its DNS observations as fixed-size integers, behind a version header
+    :param state: state (dict)
+    :return: binary state object
+    """
+    active_ip_dict = state.get("ActiveIP") or {}
+    entry_per_ip = state.get("Targets") or {}
+    observation_entry_per_ip = state.get("Observations") or {}
+    if not set(state) <= STATE_KEY_SET:
+        raise ValueError("State holds keys that the binary layout does not")
+    value_per_ip = {}
+    for (ip, entry) in entry_per_ip.items():
+        if set(entry) != LIFECYCLE_ENTRY_KEY_SET:
+            raise ValueError(f"Lifecycle of {ip} holds keys that the binary layout does not")
+        value_per_ip[ip] = (
+            LIFECYCLE_STATE_LIST.index(entry["State"]),
+            entry["Since"],
+            entry["FirstSeen"],
+            entry["MissingSince"] or 0,
+        )
+    observation_value_per_ip = {}
+    for (ip, entry) in observation_entry_per_ip.items():
+        if set(entry) != OBSERVATION_ENTRY_KEY_SET:
+            raise ValueError(f"DNS observations of {ip} hold keys that the binary layout does not")
+        observation_value_per_ip[ip] = pack_observation_entry(entry)
+
+    part_list = [
+        BINARY_STATE_HEADER.pack(
+            BINARY_STATE_MAGIC, BINARY_STATE_FORMAT_VERSION, state.get("Version", 0)
+        ),
+        struct.pack("!B", int(bool(active_ip_dict))),
+    ]
+    if active_ip_dict:
+        part_list.append(pack_active_ip(active_ip_dict))
+    part_list.append(pack_ip_block(list(entry_per_ip), LIFECYCLE_ENTRY_FORMAT, value_per_ip))
+    part_list.append(
+        pack_ip_block(list(observation_entry_per_ip), OBSERVATION_ENTRY_FORMAT, observation_value_per_ip)
+    )
+    return b"".join(part_list)
+
+
+def decode_binary_state(body):
+    """
+    Decode a binary state object of any layout version
+    :param body: binary state object
+    :return: state (dict)
+    """
+    (_, format_version, state_version) = BINARY_STATE_HEADER.unpack_from(body)
+    if format_version not in (1, 2, 3):
+        raise ValueError(f"Unknown binary state format version: {format_version}")
+    offset = BINARY_STATE_HEADER.size
+    has_active_ip = body[offset]
+    offset += 1
+    active_ip_dict = {}
+    if has_active_ip:
+        (active_ip_dict, offset) = unpack_active_ip(body, offset)
+
+    if format_version == 1:
+        (pending_ip_list, _) = unpack_ip_block(body, offset, INVOCATION_COUNT_FORMAT)
+        return {
+            "Version": state_version,
+            "ActiveIP": active_ip_dict,
+            "PendingDeregistrationIP": {
+                ip: invocation_count for (ip, (invocation_count,)) in pending_ip_list
+            },
+        }
+
+    (entry_list, offset) = unpack_ip_block(body, offset, LIFECYCLE_ENTRY_FORMAT)
+    state = {
+        "Version": state_version,
+        "ActiveIP": active_ip_dict,
+        "Targets": {
+            ip: {
+                "State": LIFECYCLE_STATE_LIST[state_index],
+                "Since": since,
+                "FirstSeen": first_seen,
+                "MissingSince": missing_since or None,
+            }
+            for (ip, (state_index, since, first_seen, missing_since)) in entry_list
+        },
+    }
+    if format_version >= 3:
+        (observation_entry_list, _) = unpack_ip_block(body, offset, OBSERVATION_ENTRY_FORMAT)
+        state["Observations"] = {
+            ip: unpack_observation_entry(value_tuple) for (ip, value_tuple) in observation_entry_list
+        }
+    return state
+
+
+def encode_state(state, encoding=STATE_ENCODING_JSON):
+    """
+    Encode the state for S3. A state that the binary layout cannot hold is written as JSON
+    :param state: state (dict)
+    :param encoding: STATE_ENCODING_JSON or STATE_ENCODING_BINARY
+    :return: (object body, content type)
+    """
+    if encoding == STATE_ENCODING_BINARY:
+        try:
+            return encode_binary_state(state), "application/octet-stream"
+        except (ValueError, KeyError, TypeError, OverflowError, struct.error) as e:
+            logger.warning(f"Failed to encode the state as binary. Write it as JSON. Error: {e}")
+    return json.dumps(state), "application/json"
+
+
+def decode_state(body):
+    """
+    Decode a state object of either encoding. The encoding is told by the first bytes of the object, so
+    JSON state objects keep being read after the binary encoding is turned on and the other way around
+    :param body: object body (bytes)
+    :return: state (dict)
+    """
+    if body[: len(BINARY_STATE_MAGIC)] == BINARY_STATE_MAGIC:
+        try:
+            return decode_binary_state(body)
+        except (IndexError, UnicodeDecodeError, struct.error) as e:
+            raise ValueError(f"Binary state is truncated or malformed. Error: {e}")
+    return json.loads(body)
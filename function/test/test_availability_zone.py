@@ -0,0 +1,68 @@
+from mock import patch, MagicMock
+
+MOCKED_SUBNET_LIST = [
+    {"SubnetId": "subnet-1", "AvailabilityZone": "us-east-1a", "CidrBlockList": ["10.0.0.0/24", "2600:1f18::/64"]},
+    {"SubnetId": "subnet-2", "AvailabilityZone": "us-east-1b", "CidrBlockList": ["10.0.1.0/24"]},
+]
+
+
+def test_availability_zone_map(env_setup):
+    from availability_zone import AvailabilityZoneMap
+
+    availability_zone_map = AvailabilityZoneMap(MOCKED_SUBNET_LIST)
+    assert availability_zone_map.availability_zone_set == {"us-east-1a", "us-east-1b"}
+    assert availability_zone_map.get_availability_zone_set(4) == {"us-east-1a", "us-east-1b"}
+    assert availability_zone_map.get_availability_zone_set(6) == {"us-east-1a"}
+    assert availability_zone_map.get_availability_zone("10.0.1.5") == "us-east-1b"
+    assert availability_zone_map.get_availability_zone("2600:1f18::a") == "us-east-1a"
+    assert availability_zone_map.get_availability_zone("10.0.9.5") is None
+    assert availability_zone_map.get_ip_set_per_availability_zone({"10.0.0.5", "10.0.9.5"}) == {
+        "us-east-1a": {"10.0.0.5"},
+        "us-east-1b": set(),
+        None: {"10.0.9.5"},
+    }
+
+
+@patch.dict("availability_zone._availability_zone_map_cache", clear=True)
+@patch("availability_zone.time")
+@patch("availability_zone.logger", return_value=MagicMock())
+def test_get_availability_zone_map(mocked_logger, mocked_time, env_setup):
+    from availability_zone import get_availability_zone_map
+
+    mocked_aws_service = MagicMock()
+    mocked_aws_service.get_load_balancer_subnet_list.return_value = MOCKED_SUBNET_LIST
+    mocked_time.monotonic.return_value = 100
+
+    # The subnets are read once and cached
+    availability_zone_map = get_availability_zone_map(mocked_aws_service, "mocked_alb.dns.name.com")
+    mocked_time.monotonic.return_value = 100 + 3599
+    assert get_availability_zone_map(mocked_aws_service, "mocked_alb.dns.name.com") is availability_zone_map
+    mocked_aws_service.get_load_balancer_subnet_list.assert_called_once_with("mocked_alb.dns.name.com")
+
+    # They are read again once the cached map is older than the TTL
+    mocked_time.monotonic.return_value = 100 + 3600
+    assert get_availability_zone_map(mocked_aws_service, "mocked_alb.dns.name.com") is not availability_zone_map
+    assert mocked_aws_service.get_load_balancer_subnet_list.call_count == 2
+
+    # The subnets of an ALB that could not be read are read again after a short TTL
+    mocked_aws_service.get_load_balancer_subnet_list.return_value = []
+    mocked_time.monotonic.return_value = 100
+    empty_availability_zone_map = get_availability_zone_map(mocked_aws_service, "mocked_alb_2.dns.name.com")
+    assert not empty_availability_zone_map.availability_zone_set
+    mocked_time.monotonic.return_value = 100 + 59
+    assert get_availability_zone_map(mocked_aws_service, "mocked_alb_2.dns.name.com") is empty_availability_zone_map
+    mocked_aws_service.get_load_balancer_subnet_list.return_value = MOCKED_SUBNET_LIST
+    mocked_time.monotonic.return_value = 100 + 60
+    assert get_availability_zone_map(mocked_aws_service, "mocked_alb_2.dns.name.com").availability_zone_set
+
+
+@patch.dict("availability_zone._availability_zone_map_cache", clear=True)
+def test_get_cached_availability_zone_map():
+    from availability_zone import AvailabilityZoneMap, _availability_zone_map_cache, get_cached_availability_zone_map
+
+    # The map is only taken from the cache. The ALB subnets are never read
+    assert get_cached_availability_zone_map("mocked_alb.dns.name.com") is None
+    availability_zone_map = _availability_zone_map_cache["mocked_alb.dns.name.com"] = AvailabilityZoneMap(
+        MOCKED_SUBNET_LIST
+    )
+    assert get_cached_availability_zone_map("mocked_alb.dns.name.com") is availability_zone_map
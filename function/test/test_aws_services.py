@@ -0,0 +1,430 @@
+import io
+import json
+import pytest
+from mock import patch, MagicMock
+from botocore.exceptions import ClientError
+from test.unittest_constant import UnittestConstant
+
+MOCKED_STATE = {
+    "Version": 3,
+    "ActiveIP": {},
+    "Targets": {
+        "1.1.1.1": {"State": "missing", "Since": 1621294332, "FirstSeen": 1621294212, "MissingSince": 1621294332}
+    },
+    "Observations": {
+        "1.1.1.1": {"LastSeen": 1621294272, "History": 6, "RunCount": 3, "Confidence": 0.05, "NameServer": None}
+    },
+}
+
+
+def make_client_error(code, http_status_code):
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": code},
+            "ResponseMetadata": {"HTTPStatusCode": http_status_code},
+        },
+        "mocked_operation",
+    )
+
+
+@patch.dict("aws_services._client_cache", clear=True)
+@patch.dict("aws_services._s3_object_cache", clear=True)
+@patch("aws_services.boto3")
+def test_download_state_from_s3(mocked_boto3, env_setup):
+    from aws_services import AwsServices
+
+    mocked_s3_client = MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+
+    # Case 1: When the state object does not exist yet
+    mocked_s3_client.get_object.side_effect = make_client_error("NoSuchKey", 404)
+    assert aws_service.download_state_from_s3(UnittestConstant.STATE_KEY) == ({}, None)
+
+    # Case 2: First download. The object is cached with its ETag
+    mocked_s3_client.get_object.side_effect = None
+    mocked_s3_client.get_object.return_value = {
+        "Body": io.BytesIO(json.dumps(MOCKED_STATE).encode()),
+        "ETag": '"etag-1"',
+    }
+    assert aws_service.download_state_from_s3(UnittestConstant.STATE_KEY) == (
+        MOCKED_STATE,
+        '"etag-1"',
+    )
+    mocked_s3_client.get_object.assert_called_with(
+        Bucket=UnittestConstant.S3_BUCKET, Key=UnittestConstant.STATE_KEY
+    )
+
+    # Case 3: Unchanged object. The in-container copy is used
+    mocked_s3_client.get_object.side_effect = make_client_error("304", 304)
+    assert aws_service.download_state_from_s3(UnittestConstant.STATE_KEY) == (
+        MOCKED_STATE,
+        '"etag-1"',
+    )
+    mocked_s3_client.get_object.assert_called_with(
+        Bucket=UnittestConstant.S3_BUCKET,
+        Key=UnittestConstant.STATE_KEY,
+        IfNoneMatch='"etag-1"',
+    )
+
+    # Case 4: Binary state object
+    from state_codec import encode_binary_state
+
+    mocked_s3_client.get_object.side_effect = None
+    mocked_s3_client.get_object.return_value = {
+        "Body": io.BytesIO(encode_binary_state(MOCKED_STATE)),
+        "ETag": '"etag-2"',
+    }
+    assert aws_service.download_state_from_s3(UnittestConstant.STATE_KEY) == (
+        MOCKED_STATE,
+        '"etag-2"',
+    )
+
+    # Case 5: Corrupt, truncated or unknown format state objects are treated as missing and are not cached.
+    # The ETag is returned so that the next write replaces the object
+    from aws_services import _s3_object_cache
+
+    for corrupt_body in (
+        b'{"Version": 3, "ActiveIP"',
+        encode_binary_state(MOCKED_STATE)[:-5],
+        b"\xff\xfe not a state",
+        b"[]",
+    ):
+        mocked_s3_client.get_object.return_value = {
+            "Body": io.BytesIO(corrupt_body),
+            "ETag": '"etag-3"',
+        }
+        assert aws_service.download_state_from_s3(UnittestConstant.STATE_KEY) == ({}, '"etag-3"')
+        assert (UnittestConstant.S3_BUCKET, UnittestConstant.STATE_KEY) not in _s3_object_cache
+
+
+@patch.dict("aws_services._client_cache", clear=True)
+@patch.dict("aws_services._s3_object_cache", clear=True)
+@patch("aws_services.boto3")
+def test_write_state_to_s3(mocked_boto3):
+    from aws_services import AwsServices, _s3_object_cache
+
+    mocked_s3_client = MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+
+    # Case 1: The state object does not exist yet. Only create it
+    mocked_s3_client.put_object.return_value = {"ETag": '"etag-1"'}
+    assert aws_service.write_state_to_s3(MOCKED_STATE, UnittestConstant.STATE_KEY, None)
+    assert mocked_s3_client.put_object.call_args.kwargs["IfNoneMatch"] == "*"
+    assert _s3_object_cache[
+               (UnittestConstant.S3_BUCKET, UnittestConstant.STATE_KEY)
+           ] == ('"etag-1"', MOCKED_STATE)
+
+    # Case 2: Overwrite only the version that was loaded
+    mocked_s3_client.put_object.return_value = {"ETag": '"etag-2"'}
+    assert aws_service.write_state_to_s3(
+        MOCKED_STATE, UnittestConstant.STATE_KEY, '"etag-1"'
+    )
+    assert mocked_s3_client.put_object.call_args.kwargs["IfMatch"] == '"etag-1"'
+
+    # Case 3: A concurrent invocation changed the state object
+    mocked_s3_client.put_object.side_effect = make_client_error(
+        "PreconditionFailed", 412
+    )
+    assert not aws_service.write_state_to_s3(
+        MOCKED_STATE, UnittestConstant.STATE_KEY, '"etag-1"'
+    )
+    assert not _s3_object_cache
+
+    # Case 4: Binary encoding
+    mocked_s3_client.put_object.side_effect = None
+    assert aws_service.write_state_to_s3(
+        MOCKED_STATE, UnittestConstant.STATE_KEY, '"etag-2"', encoding="binary"
+    )
+    assert mocked_s3_client.put_object.call_args.kwargs["Body"].startswith(b"NLBS")
+    assert mocked_s3_client.put_object.call_args.kwargs["ContentType"] == "application/octet-stream"
+
+
+@patch.dict("aws_services._client_cache", clear=True)
+@patch.dict("aws_services._s3_object_cache", clear=True)
+@patch("aws_services._unsupported_put_parameter_set", set())
+@patch("aws_services.boto3")
+def test_write_state_to_s3_without_conditional_write(mocked_boto3):
+    from botocore.exceptions import EndpointConnectionError, ParamValidationError
+    from aws_services import AwsServices
+
+    mocked_s3_client = MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+
+    # Case 1: botocore of the runtime predates conditional writes. Write the state unconditionally
+    mocked_s3_client.put_object.side_effect = [
+        ParamValidationError(report='Unknown parameter in input: "IfMatch"'),
+        {"ETag": '"etag-2"'},
+    ]
+    assert aws_service.write_state_to_s3(MOCKED_STATE, UnittestConstant.STATE_KEY, '"etag-1"')
+    assert "IfMatch" in mocked_s3_client.put_object.call_args_list[0].kwargs
+    assert "IfMatch" not in mocked_s3_client.put_object.call_args.kwargs
+
+    # Case 2: The next writes are unconditional right away
+    mocked_s3_client.put_object.reset_mock()
+    mocked_s3_client.put_object.side_effect = None
+    mocked_s3_client.put_object.return_value = {"ETag": '"etag-3"'}
+    assert aws_service.write_state_to_s3(MOCKED_STATE, UnittestConstant.STATE_KEY, '"etag-2"')
+    mocked_s3_client.put_object.assert_called_once()
+    assert "IfMatch" not in mocked_s3_client.put_object.call_args.kwargs
+
+    # Case 3: Any other botocore error fails the write without raising
+    mocked_s3_client.put_object.side_effect = EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+    assert not aws_service.write_state_to_s3(MOCKED_STATE, UnittestConstant.STATE_KEY, '"etag-3"')
+
+
+@patch("aws_services.time")
+@patch.dict("aws_services._client_cache", clear=True)
+@patch("aws_services.boto3")
+def test_register_target(mocked_boto3, mocked_time):
+    from aws_services import AwsServices
+
+    mocked_elbv2_client = MagicMock()
+    mocked_boto3.client.return_value = mocked_elbv2_client
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+    target_list = [{"Id": f"10.10.10.{i}", "Port": 80} for i in range(5)]
+
+    # Case 1: Targets are registered in chunks. Throttled calls are retried with backoff and counted
+    from metrics import MetricRecorder
+
+    metric_recorder = MetricRecorder({})
+    mocked_elbv2_client.register_targets.side_effect = [
+        make_client_error("Throttling", 400),
+        None,
+        None,
+        None,
+    ]
+    with patch("aws_services.TARGET_CHUNK_SIZE", 2), patch(
+            "aws_services.TARGET_MUTATION_MAX_WORKERS", 1
+    ):
+        actual_result = aws_service.register_target(
+            UnittestConstant.NLB_TG_ARN, target_list, metric_recorder
+        )
+    assert actual_result == target_list
+    assert mocked_elbv2_client.register_targets.call_count == 4
+    mocked_time.sleep.assert_called_once()
+    assert metric_recorder.metric_values["ApiRetryCount"] == [1]
+
+    # Case 2: A chunk fails. Its targets are retried alone and only the bad one is left out
+    mocked_elbv2_client.register_targets.reset_mock()
+
+    def mocked_register_targets(TargetGroupArn, Targets):
+        if {"Id": "10.10.10.1", "Port": 80} in Targets:
+            raise make_client_error("InvalidTarget", 400)
+
+    mocked_elbv2_client.register_targets.side_effect = mocked_register_targets
+    with patch("aws_services.TARGET_CHUNK_SIZE", 2):
+        actual_result = aws_service.register_target(
+            UnittestConstant.NLB_TG_ARN, target_list
+        )
+    assert actual_result == [target for target in target_list if target["Id"] != "10.10.10.1"]
+
+    # Case 3: Throttling that never stops. Give up after API_MAX_ATTEMPTS
+    mocked_elbv2_client.register_targets.reset_mock()
+    mocked_elbv2_client.register_targets.side_effect = make_client_error("Throttling", 400)
+    with patch("aws_services.API_MAX_ATTEMPTS", 2):
+        actual_result = aws_service.register_target(
+            UnittestConstant.NLB_TG_ARN, target_list[:1]
+        )
+    assert actual_result == []
+    assert mocked_elbv2_client.register_targets.call_count == 2
+
+    # Case 4: A chunk that stays throttled fails as a whole. It is not split into single-target calls
+    mocked_elbv2_client.register_targets.reset_mock()
+    with patch("aws_services.API_MAX_ATTEMPTS", 2):
+        actual_result = aws_service.register_target(
+            UnittestConstant.NLB_TG_ARN, target_list
+        )
+    assert actual_result == []
+    assert mocked_elbv2_client.register_targets.call_count == 2
+
+
+@patch.dict("aws_services._client_cache", clear=True)
+@patch("aws_services.boto3")
+def test_get_target_group_snapshot(mocked_boto3):
+    from aws_services import AwsServices
+
+    mocked_elbv2_client = MagicMock()
+    mocked_boto3.client.return_value = mocked_elbv2_client
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+    mocked_elbv2_client.describe_target_health.return_value = {
+        "TargetHealthDescriptions": [
+            {
+                "Target": {"Id": "1.1.1.1", "Port": 80, "AvailabilityZone": "us-east-1a"},
+                "TargetHealth": {"State": "healthy"},
+            },
+            {
+                "Target": {"Id": "2.2.2.2", "Port": 80},
+                "TargetHealth": {"State": "initial"},
+            },
+            {
+                "Target": {"Id": "3.3.3.3", "Port": 80},
+                "TargetHealth": {"State": "draining"},
+            },
+        ]
+    }
+
+    target_group_snapshot = aws_service.get_target_group_snapshot(
+        UnittestConstant.NLB_TG_ARN
+    )
+    mocked_elbv2_client.describe_target_health.assert_called_once_with(
+        TargetGroupArn=UnittestConstant.NLB_TG_ARN
+    )
+    assert target_group_snapshot.target_state[("1.1.1.1", 80, "us-east-1a")] == "healthy"
+    assert target_group_snapshot.ip_set == {"1.1.1.1", "2.2.2.2", "3.3.3.3"}
+    assert target_group_snapshot.registered_ip_set == {"1.1.1.1", "2.2.2.2"}
+    assert target_group_snapshot.draining_ip_set == {"3.3.3.3"}
+    assert target_group_snapshot.get_target_count_by_state() == {
+        "healthy": 1,
+        "initial": 1,
+        "draining": 1,
+    }
+    assert target_group_snapshot.get_ip_count_by_availability_zone() == {"us-east-1a": 1}
+
+    # Targets of another VPC are registered with the availability zone "all". They are counted in the availability
+    # zone of the ALB subnet that holds them
+    from aws_services import TargetGroupSnapshot
+    from availability_zone import AvailabilityZoneMap
+
+    availability_zone_map = AvailabilityZoneMap(
+        [
+            {"SubnetId": "subnet-1", "AvailabilityZone": "us-east-1a", "CidrBlockList": ["10.0.0.0/24"]},
+            {"SubnetId": "subnet-2", "AvailabilityZone": "us-east-1b", "CidrBlockList": ["10.0.1.0/24"]},
+        ]
+    )
+    target_group_snapshot = TargetGroupSnapshot(
+        UnittestConstant.NLB_TG_ARN,
+        [
+            {"Target": {"Id": ip, "Port": 80, "AvailabilityZone": "all"}, "TargetHealth": {"State": "healthy"}}
+            for ip in ("10.0.0.1", "10.0.1.1", "10.0.1.2", "10.0.9.1")
+        ],
+    )
+    assert target_group_snapshot.get_ip_count_by_availability_zone() == {}
+    assert target_group_snapshot.get_ip_count_by_availability_zone(availability_zone_map) == {
+        "us-east-1a": 1,
+        "us-east-1b": 2,
+    }
+
+    # The error is raised when the target group cannot be described
+    mocked_elbv2_client.describe_target_health.side_effect = make_client_error(
+        "TargetGroupNotFound", 400
+    )
+    with pytest.raises(ClientError):
+        aws_service.get_target_group_snapshot(UnittestConstant.NLB_TG_ARN)
+
+
+@patch.dict("aws_services._client_cache", clear=True)
+@patch("aws_services.boto3")
+def test_get_client(mocked_boto3):
+    from aws_services import AwsServices, get_client
+
+    mocked_boto3.client.side_effect = lambda *args, **kwargs: MagicMock()
+
+    # Clients are created on first use and shared by every AwsServices instance
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+    mocked_boto3.client.assert_not_called()
+    s3_client = aws_service.s3_client
+    assert s3_client is get_client("s3", UnittestConstant.AWS_REGION)
+    assert s3_client is AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET).s3_client
+    assert aws_service.elbv2 is not s3_client
+    mocked_boto3.client.assert_any_call("s3", region_name=UnittestConstant.AWS_REGION)
+    assert mocked_boto3.client.call_count == 2
+
+
+@patch.dict("aws_services._client_cache", clear=True)
+@patch("aws_services.boto3")
+def test_publish_metric_data(mocked_boto3):
+    from aws_services import AwsServices
+
+    mocked_cw_client = MagicMock()
+    mocked_boto3.client.return_value = mocked_cw_client
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+    metric_data_list = [{"MetricName": "LoadBalancerIPCount", "Value": 2.0}]
+
+    assert aws_service.publish_metric_data("mocked_namespace", metric_data_list)
+    mocked_cw_client.put_metric_data.assert_called_once_with(
+        Namespace="mocked_namespace", MetricData=metric_data_list
+    )
+
+    # A failed call is logged and not raised
+    mocked_cw_client.put_metric_data.side_effect = make_client_error("InvalidParameterValue", 400)
+    assert not aws_service.publish_metric_data("mocked_namespace", metric_data_list)
+
+
+@patch.dict("aws_services._client_cache", clear=True)
+@patch.dict("aws_services._load_balancer_arn_cache", clear=True)
+@patch("aws_services.boto3")
+def test_get_load_balancer_subnet_list(mocked_boto3):
+    from aws_services import AwsServices
+
+    mocked_client = MagicMock()
+    mocked_boto3.client.return_value = mocked_client
+    aws_service = AwsServices(UnittestConstant.AWS_REGION, UnittestConstant.S3_BUCKET)
+    load_balancer = {
+        "LoadBalancerArn": "mocked_alb_arn",
+        "DNSName": UnittestConstant.ALB_DNS_NAME,
+        "AvailabilityZones": [
+            {"ZoneName": "us-east-1a", "SubnetId": "subnet-1"},
+            {"ZoneName": "us-east-1b", "SubnetId": "subnet-2"},
+        ],
+    }
+    paged_response_list = [
+        {
+            "LoadBalancers": [
+                {"LoadBalancerArn": "other_alb_arn", "DNSName": "other-alb.elb.amazonaws.com", "AvailabilityZones": []}
+            ],
+            "NextMarker": "mocked_marker",
+        },
+        {"LoadBalancers": [load_balancer]},
+    ]
+    mocked_client.describe_load_balancers.side_effect = paged_response_list
+    mocked_client.describe_subnets.return_value = {
+        "Subnets": [
+            {
+                "SubnetId": "subnet-1",
+                "AvailabilityZone": "us-east-1a",
+                "CidrBlock": "10.0.0.0/24",
+                "Ipv6CidrBlockAssociationSet": [
+                    {"Ipv6CidrBlock": "2600:1f18::/64", "Ipv6CidrBlockState": {"State": "associated"}},
+                    {"Ipv6CidrBlock": "2600:1f18:0:1::/64", "Ipv6CidrBlockState": {"State": "disassociated"}},
+                ],
+            },
+            {"SubnetId": "subnet-2", "AvailabilityZone": "us-east-1b", "CidrBlock": "10.0.1.0/24"},
+        ]
+    }
+
+    # Case 1: Page through the load balancers until the ALB is found and read its subnets
+    assert aws_service.get_load_balancer_subnet_list(UnittestConstant.ALB_DNS_NAME) == [
+        {"SubnetId": "subnet-1", "AvailabilityZone": "us-east-1a", "CidrBlockList": ["10.0.0.0/24", "2600:1f18::/64"]},
+        {"SubnetId": "subnet-2", "AvailabilityZone": "us-east-1b", "CidrBlockList": ["10.0.1.0/24"]},
+    ]
+    mocked_client.describe_load_balancers.assert_called_with(Marker="mocked_marker")
+    mocked_client.describe_subnets.assert_called_once_with(SubnetIds=["subnet-1", "subnet-2"])
+
+    # Case 2: The ALB is described by its cached ARN after it was found once
+    mocked_client.describe_load_balancers.reset_mock()
+    mocked_client.describe_load_balancers.side_effect = None
+    mocked_client.describe_load_balancers.return_value = {"LoadBalancers": [load_balancer]}
+    assert len(aws_service.get_load_balancer_subnet_list(UnittestConstant.ALB_DNS_NAME)) == 2
+    mocked_client.describe_load_balancers.assert_called_once_with(LoadBalancerArns=["mocked_alb_arn"])
+
+    # Case 3: The cached ALB no longer exists. Page through the load balancers again
+    mocked_client.describe_load_balancers.reset_mock()
+    mocked_client.describe_load_balancers.side_effect = [
+        make_client_error("LoadBalancerNotFound", 400)
+    ] + paged_response_list
+    assert len(aws_service.get_load_balancer_subnet_list(UnittestConstant.ALB_DNS_NAME)) == 2
+    assert mocked_client.describe_load_balancers.call_count == 3
+
+    # Case 4: A failed call is logged and not raised
+    mocked_client.describe_load_balancers.side_effect = make_client_error("AccessDenied", 403)
+    assert aws_service.get_load_balancer_subnet_list(UnittestConstant.ALB_DNS_NAME) == []
+
+    # Case 5: The EC2 endpoint cannot be reached. e.g. a VPC without an EC2 endpoint
+    from botocore.exceptions import EndpointConnectionError
+
+    mocked_client.describe_load_balancers.side_effect = None
+    mocked_client.describe_subnets.side_effect = EndpointConnectionError(endpoint_url="https://ec2.amazonaws.com")
+    assert aws_service.get_load_balancer_subnet_list(UnittestConstant.ALB_DNS_NAME) == []
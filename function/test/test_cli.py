@@ -0,0 +1,119 @@
+import json
+import pytest
+from mock import patch
+from test.unittest_constant import UnittestConstant
+
+
+@patch("builtins.print")
+@patch("populate_NLB_TG_with_ALB.reconcile_event")
+def test_plan_command(mocked_reconcile_event, mocked_print, env_setup):
+    from cli import main
+
+    # Case 1: Plan every mapping and print the plans as JSON
+    mocked_reconcile_event.return_value = {"DryRun": True, "IsFailed": False, "Plans": [{"ToRegister": ["1.1.1.1"]}]}
+    assert main(["plan"]) == 0
+    (config, event, context) = mocked_reconcile_event.call_args.args
+    assert config.ALB_DNS_NAME == UnittestConstant.ALB_DNS_NAME
+    assert (event, context) == ({"DryRun": True}, None)
+    assert json.loads(mocked_print.call_args.args[0]) == mocked_reconcile_event.return_value
+
+    # Case 2: Plan the mappings of one ALB. Fail when an ALB has no IP in the DNS
+    mocked_reconcile_event.return_value = {"DryRun": True, "IsFailed": True, "Plans": []}
+    assert main(["plan", "--alb-dns-name", "internal-alb.us-east-1.elb.amazonaws.com"]) == 1
+    assert mocked_reconcile_event.call_args.args[1] == {
+        "DryRun": True, "AlbDnsName": "internal-alb.us-east-1.elb.amazonaws.com"
+    }
+
+
+def test_load_config(env_setup, tmp_path, monkeypatch):
+    from cli import main
+
+    monkeypatch.setenv("MAX_LOOKUP_PER_INVOCATION", "10")
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({
+        "MAX_LOOKUP_PER_INVOCATION": 20,
+        "DEREGISTRATION_DELAY": 60,
+        "TARGET_MAPPINGS": [{"AlbDnsName": "internal-alb-1.us-east-1.elb.amazonaws.com"}],
+    }))
+
+    # The configuration file wins over the environment variables and --set wins over the file
+    with patch("cli.plan_command", return_value=0) as mocked_plan_command:
+        assert main(["plan", "--config", str(config_path), "--set", "DEREGISTRATION_DELAY=120"]) == 0
+    config = mocked_plan_command.call_args.args[1]
+    assert config.MAX_LOOKUP_PER_INVOCATION == 20
+    assert config.DEREGISTRATION_DELAY == 120
+    assert json.loads(config.TARGET_MAPPINGS) == [{"AlbDnsName": "internal-alb-1.us-east-1.elb.amazonaws.com"}]
+    assert config.S3_BUCKET == UnittestConstant.S3_BUCKET
+    assert not config.error_list
+
+
+@patch("populate_NLB_TG_with_ALB.reconcile_event")
+def test_run_command(mocked_reconcile_event, env_setup):
+    from cli import main
+
+    # Case 1: One reconcile pass of every mapping
+    assert main(["run"]) == 0
+    mocked_reconcile_event.assert_called_once()
+    assert mocked_reconcile_event.call_args.args[1:] == ({}, None)
+
+    # Case 2: A failed pass exits with 1
+    mocked_reconcile_event.side_effect = SystemExit(1)
+    assert main(["run", "--alb-dns-name", "internal-alb.us-east-1.elb.amazonaws.com"]) == 1
+    assert mocked_reconcile_event.call_args.args[1] == {"AlbDnsName": "internal-alb.us-east-1.elb.amazonaws.com"}
+
+
+@patch("signal.signal")
+@patch("populate_NLB_TG_with_ALB.run_reconcile_passes")
+@patch("aws_services.AwsServices")
+def test_daemon_command(mocked_aws_services, mocked_run_reconcile_passes, mocked_signal, env_setup):
+    from cli import main, DEFAULT_DAEMON_INTERVAL
+
+    # Case 1: Passes every default interval until stopped
+    mocked_run_reconcile_passes.return_value = False
+    assert main(["daemon"]) == 0
+    (config, _, reconcile_target_list, ip_from_event_set, loop_deadline, stop_event) = (
+        mocked_run_reconcile_passes.call_args.args
+    )
+    assert config.RECONCILE_LOOP_INTERVAL == DEFAULT_DAEMON_INTERVAL
+    assert len(reconcile_target_list) == 1
+    assert reconcile_target_list[0].config is config
+    assert ip_from_event_set == set()
+    assert loop_deadline == float("inf")
+    # SIGTERM and SIGINT stop the passes
+    assert mocked_signal.call_count == 2
+    mocked_signal.call_args.args[1]()
+    assert stop_event.is_set()
+
+    # Case 2: --interval wins over RECONCILE_LOOP_INTERVAL. RECONCILE_LOOP_DURATION bounds the daemon
+    assert main(["daemon", "--interval", "15", "--set", "RECONCILE_LOOP_DURATION=3600"]) == 0
+    assert mocked_run_reconcile_passes.call_args.args[0].RECONCILE_LOOP_INTERVAL == 15
+    assert mocked_run_reconcile_passes.call_args.args[4] != float("inf")
+
+    # Case 3: Exits with 1 when a pass failed
+    mocked_run_reconcile_passes.return_value = True
+    assert main(["daemon"]) == 1
+
+    # Case 4: A non-positive interval is a usage error. Nothing is validated or built
+    mocked_aws_services.reset_mock()
+    mocked_run_reconcile_passes.reset_mock()
+    for argv in (["daemon", "--interval", "0"], ["daemon", "--set", "RECONCILE_LOOP_INTERVAL=-5"]):
+        with pytest.raises(SystemExit) as exc_info:
+            main(argv)
+        assert exc_info.value.code == 2
+    mocked_aws_services.from_config.assert_not_called()
+    mocked_run_reconcile_passes.assert_not_called()
+
+
+def test_invalid_config(env_setup, capsys):
+    from cli import main
+
+    # An invalid configuration exits with the usage error status and its message instead of a traceback
+    for argv in (
+            ["run", "--set", "MAX_LOOKUP_PER_INVOCATION=0"],
+            ["plan", "--set", "STATE_ENCODING=xml"],
+            ["daemon", "--set", "NOT_A_SETTING"],
+    ):
+        with pytest.raises(SystemExit) as exc_info:
+            main(argv)
+        assert exc_info.value.code == 2
+    assert "--set is required to be NAME=VALUE" in capsys.readouterr().err
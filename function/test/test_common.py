@@ -1,5 +1,8 @@
+import threading
 import pytest
+import dns.resolver
 from mock import patch, MagicMock, call
+from convergence import StableLookupStopPolicy
 
 MOCKED_DNS_NAME = "mocked.domain.name.com"
 MOCKED_DNS_RECORD_TYPE = "A"
@@ -23,7 +26,30 @@ def test_precondition(mocked_logger, env_setup):
         mocked_logger.error.assert_called_once_with(mocked_error_messages)
 
 
-@patch("common.dns.resolver", return_value=MagicMock())
+@patch.dict("common._resolver_pool", clear=True)
+@patch("dns.resolver", return_value=MagicMock())
+def test_get_resolver(mocked_resolver):
+    import common as common_util
+
+    mocked_resolver.Resolver.side_effect = lambda *args, **kwargs: MagicMock()
+
+    # The default resolver caches answers and is reused
+    default_resolver = common_util.get_resolver()
+    assert default_resolver is common_util.get_resolver()
+    assert default_resolver.cache == mocked_resolver.LRUCache.return_value
+    mocked_resolver.Resolver.assert_called_once_with()
+
+    # A resolver bound to a name server is reused per name server and skips /etc/resolv.conf
+    nameserver_resolver = common_util.get_resolver("1.1.1.1")
+    assert nameserver_resolver is common_util.get_resolver("1.1.1.1")
+    assert nameserver_resolver is not default_resolver
+    assert nameserver_resolver.nameservers == ["1.1.1.1"]
+    mocked_resolver.Resolver.assert_called_with(configure=False)
+    assert mocked_resolver.Resolver.call_count == 2
+
+
+@patch.dict("common._resolver_pool", clear=True)
+@patch("dns.resolver", return_value=MagicMock())
 @patch("common.logger", return_value=MagicMock())
 def test_dns_lookup(mocked_logger, mocked_resolver):
     import common as common_util
@@ -54,6 +80,30 @@ def test_dns_lookup(mocked_logger, mocked_resolver):
     mocked_logger.exception.assert_has_calls(logger_exception_calls)
 
 
+@patch("dns_sampler.DnsSampler")
+def test_get_dns_sampler(mocked_DnsSampler):
+    import common as common_util
+
+    mocked_DnsSampler.side_effect = lambda *args: MagicMock()
+
+    # The sampler is built once per thread and domain name and then reused
+    with patch("common._thread_local", threading.local()):
+        dns_sampler = common_util.get_dns_sampler(MOCKED_DNS_NAME, "A")
+        assert dns_sampler is common_util.get_dns_sampler(MOCKED_DNS_NAME, "A")
+        mocked_DnsSampler.assert_called_once_with(MOCKED_DNS_NAME, "A")
+
+        # Another thread gets its own sampler
+        other_thread_dns_sampler_list = []
+        other_thread = threading.Thread(
+            target=lambda: other_thread_dns_sampler_list.append(
+                common_util.get_dns_sampler(MOCKED_DNS_NAME, "A")
+            )
+        )
+        other_thread.start()
+        other_thread.join()
+        assert other_thread_dns_sampler_list[0] is not dns_sampler
+
+
 @patch("common.dns_lookup")
 @patch("common.logger", return_value=MagicMock())
 def test_dns_lookup_with_retry(mocked_logger, mocked_dns_lookup):
@@ -62,6 +112,7 @@ def test_dns_lookup_with_retry(mocked_logger, mocked_dns_lookup):
     # Case 1: When there are less than 8 IPs in the DNS lookup. break out from retry
     mocked_dns_lookup.return_value = ["10.10.10.10"]
     common_util.dns_lookup_with_retry(MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 10)
+    mocked_dns_lookup.assert_called_once()
     mocked_logger.info.assert_called_with(
         "There are less than 8 IPs in the DNS response. Stop further DNS lookup..."
     )
@@ -114,112 +165,198 @@ def test_get_elb_authoritative_name_server_ip_list(mocked_logger, mocked_dns_loo
     assert actual_result == expected_result
 
 
-@patch("common.dns_lookup_with_retry")
-@patch("common.get_elb_authoritative_name_server_ip_list")
-def test_get_elb_ip_from_dns(
-        mocked_get_elb_authoritative_name_server_ip_list, mocked_dns_lookup_with_retry
-):
-    import common as common_util
-
-    mocked_get_elb_authoritative_name_server_ip_list.return_value = [
-        "1.1.1.1",
-        "2.2.2.2",
-    ]
-
-    common_util.get_elb_ip_from_dns(MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 5)
-    mocked_dns_lookup_with_retry.assert_called_once_with(
-        MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 5, ["1.1.1.1", "2.2.2.2"]
-    )
-
-
+@patch("common.get_dns_sampler")
 @patch("common.logger", return_value=MagicMock())
-def test_get_pending_registration_ip_set(mocked_logger):
+def test_dns_lookup_concurrently(mocked_logger, mocked_get_dns_sampler):
     import common as common_util
 
-    # Return the IPs that are in DNS but not in the target group
-    ip_from_dns_set = {"1.1.1.1", "2.2.2.2", "3.3.3.3"}
-    ip_from_target_group_set = {"1.1.1.1"}
-
-    expected_result = {"2.2.2.2", "3.3.3.3"}
-    actual_result = common_util.get_pending_registration_ip_set(
-        ip_from_dns_set,
-        ip_from_target_group_set
-    )
-    assert actual_result == expected_result
+    dns_servers = ["1.1.1.1", "2.2.2.2"]
+    eight_ip_list = [f"10.10.10.{i}" for i in range(8)]
+    mocked_dns_sampler = MagicMock()
+    mocked_dns_sampler.burst_timeout_count = 0
+    mocked_get_dns_sampler.return_value = mocked_dns_sampler
 
+    def mocked_burst(ip_list):
+        return lambda nameserver_list, timeout: iter(
+            [(nameserver, ip_list) for nameserver in nameserver_list]
+        )
 
-@patch("common.logger", return_value=MagicMock())
-def test_get_invocation_count_per_pending_deregistration_ip_without_pending(
-        mocked_logger,
-):
-    # When there is no pending IP from the previous invocation
-    # Pending deregistration IPs (Without considering INVOCATIONS_BEFORE_DEREGISTRATION) are:
-    # 1. In the active IP list from the previous invocation but no longer in the DNS
-    # 2. Currently registered but no longer in the DNS
+    # Case 1: When there are less than 8 IPs in the DNS lookup. Stop further lookup
+    mocked_dns_sampler.burst.side_effect = mocked_burst(["10.10.10.10"])
+    actual_result = common_util.dns_lookup_concurrently(
+        MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 10, dns_servers
+    )
+    assert actual_result == {"10.10.10.10"}
+    mocked_get_dns_sampler.assert_called_with(MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE)
+    mocked_logger.info.assert_any_call(
+        "There are less than 8 IPs in the DNS response. Stop further DNS lookup..."
+    )
+    mocked_logger.info.assert_called_with(
+        "DNS sampling confidence: 1.000. Estimated unseen IP count: 0.00"
+    )
 
-    import common as common_util
+    # Case 2: Lookups are spread over the name servers in bursts and complete all attempts
+    mocked_dns_sampler.reset_mock()
+    mocked_dns_sampler.burst.side_effect = mocked_burst(eight_ip_list)
+    with patch("common.DNS_SAMPLING_BURST_SIZE", 3):
+        actual_result = common_util.dns_lookup_concurrently(
+            MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 4, dns_servers
+        )
+    assert actual_result == set(eight_ip_list)
+    assert [
+               burst_call.args[0] for burst_call in mocked_dns_sampler.burst.call_args_list
+           ] == [["1.1.1.1", "2.2.2.2", "1.1.1.1"], ["2.2.2.2"]]
+
+    # Case 3: Stop once no IP is estimated to be unseen
+    mocked_dns_sampler.reset_mock()
+    with patch("common.DNS_SAMPLING_BURST_SIZE", 1):
+        common_util.dns_lookup_concurrently(
+            MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 50, dns_servers
+        )
+    assert mocked_dns_sampler.burst.call_count == 5
+    mocked_logger.info.assert_any_call(
+        "Estimated unseen IP count (0.00) is below 0.05 after 5 DNS lookups. Stop further DNS lookup..."
+    )
 
-    ip_from_dns_set = {"1.1.1.1", "2.2.2.2", "3.3.3.3"}
-    ip_from_target_group_set = {"1.1.1.1", "5.5.5.5"}
-    active_ip_set_from_previous_invocation = {"2.2.2.2", "6.6.6.6"}
+    # Case 4: Stop with the given stop policy once the IP set stops changing
+    mocked_dns_sampler.reset_mock()
+    with patch("common.DNS_SAMPLING_BURST_SIZE", 2):
+        common_util.dns_lookup_concurrently(
+            MOCKED_DNS_NAME,
+            MOCKED_DNS_RECORD_TYPE,
+            50,
+            dns_servers,
+            stop_policy=StableLookupStopPolicy(3),
+        )
+    assert mocked_dns_sampler.burst.call_count == 2
+    mocked_logger.info.assert_any_call(
+        "No new IP found in the last 3 DNS lookups. Stop further DNS lookup..."
+    )
 
-    # 6.6.6.6 is no longer in the DNS while it is in the active IP list from the previous invocation
-    # 5.5.5.5 is no longer in the DNS while it is in the target group
-    pending_ip_dict_from_previous_invocation = {}
-    expected_result = {"5.5.5.5": 1, "6.6.6.6": 1}
-    actual_result = common_util.get_invocation_count_per_pending_deregistration_ip(
-        ip_from_dns_set,
-        ip_from_target_group_set,
-        active_ip_set_from_previous_invocation,
-        pending_ip_dict_from_previous_invocation,
+    # Case 5: Stop when the time budget is used up
+    mocked_dns_sampler.reset_mock()
+    actual_result = common_util.dns_lookup_concurrently(
+        MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 50, dns_servers, time_budget=0
     )
+    assert actual_result == set()
+    mocked_dns_sampler.burst.assert_not_called()
 
-    assert actual_result == expected_result
+    # Case 6: Lookup counts and the IP count per lookup are recorded
+    from metrics import MetricRecorder
 
+    metric_recorder = MetricRecorder({})
+    mocked_dns_sampler.burst.side_effect = lambda nameserver_list, timeout: iter(
+        [(nameserver_list[0], ["10.10.10.10"])]
+    )
+    mocked_dns_sampler.burst_timeout_count = 1
+    common_util.dns_lookup_concurrently(
+        MOCKED_DNS_NAME,
+        MOCKED_DNS_RECORD_TYPE,
+        2,
+        dns_servers,
+        metric_recorder=metric_recorder,
+    )
+    assert metric_recorder.metric_values["DnsLookupCount"] == [1]
+    assert metric_recorder.metric_values["DnsLookupTimeoutCount"] == [1]
+    assert metric_recorder.metric_values["DnsLookupIPCount"] == [1]
+    assert metric_recorder.metric_values["DnsSamplingConfidence"] == [1.0]
+
+    # Case 7: The queries that are abandoned once the sampling converged are not timeouts
+    metric_recorder = MetricRecorder({})
+    mocked_dns_sampler.burst.side_effect = mocked_burst(["10.10.10.10"])
+    mocked_dns_sampler.burst_timeout_count = 0
+    common_util.dns_lookup_concurrently(
+        MOCKED_DNS_NAME,
+        MOCKED_DNS_RECORD_TYPE,
+        10,
+        dns_servers,
+        metric_recorder=metric_recorder,
+    )
+    assert metric_recorder.metric_values["DnsLookupCount"] == [1]
+    assert metric_recorder.metric_values["DnsLookupTimeoutCount"] == [0]
 
-@patch("common.logger", return_value=MagicMock())
-def test_get_invocation_count_per_pending_deregistration_ip_with_pending(mocked_logger):
-    # When there are pending IPs from the previous invocation
-    # Pending deregistration IPs (Without considering INVOCATIONS_BEFORE_DEREGISTRATION) are:
-    # 1. In the active IP list from the previous invocation but no longer in the DNS
-    # 2. Currently registered but no longer in the DNS
 
+@patch("common.dns_lookup_concurrently")
+@patch("common.dns_lookup_with_retry")
+@patch("common.get_elb_authoritative_name_server_ip_list")
+def test_get_elb_ip_from_dns(
+        mocked_get_elb_authoritative_name_server_ip_list,
+        mocked_dns_lookup_with_retry,
+        mocked_dns_lookup_concurrently,
+):
     import common as common_util
+    from availability_zone import AvailabilityZoneMap
+    from convergence import CoverageStopPolicy
+    from metrics import MetricRecorder
+    from observation import DnsObservation
 
-    ip_from_dns_set = {"1.1.1.1", "2.2.2.2", "3.3.3.3"}
-    ip_from_target_group_set = {"1.1.1.1", "5.5.5.5"}
-    active_ip_set_from_previous_invocation = {"2.2.2.2", "6.6.6.6"}
+    # Case 1: When authoritative name servers are found. Sample them in parallel
+    mocked_get_elb_authoritative_name_server_ip_list.return_value = [
+        "1.1.1.1",
+        "2.2.2.2",
+    ]
+    stop_policy = CoverageStopPolicy()
+    metric_recorder = MetricRecorder({})
 
-    pending_ip_dict_from_previous_invocation = {
-        "1.1.1.1": 1,
-        "2.2.2.2": 2,
-        "5.5.5.5": 3,
-    }
-    expected_result = {"5.5.5.5": 4, "6.6.6.6": 1}
-    actual_result = common_util.get_invocation_count_per_pending_deregistration_ip(
-        ip_from_dns_set,
-        ip_from_target_group_set,
-        active_ip_set_from_previous_invocation,
-        pending_ip_dict_from_previous_invocation,
+    common_util.get_elb_ip_from_dns(
+        MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 5, stop_policy, metric_recorder
     )
-    assert actual_result == expected_result
-
+    mocked_dns_lookup_concurrently.assert_called_once_with(
+        MOCKED_DNS_NAME,
+        MOCKED_DNS_RECORD_TYPE,
+        5,
+        ["1.1.1.1", "2.2.2.2"],
+        stop_policy=stop_policy,
+        metric_recorder=metric_recorder,
+    )
+    mocked_dns_lookup_with_retry.assert_not_called()
+    assert not stop_policy.required_availability_zone_set
 
-@patch("common.logger", return_value=MagicMock())
-def test_get_pending_deregistration_ip_set(mocked_logger):
-    import common as common_util
+    # Case 2: When no authoritative name server is found. Fall back to the default resolver
+    mocked_get_elb_authoritative_name_server_ip_list.return_value = []
+    common_util.get_elb_ip_from_dns(
+        MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 5, stop_policy, metric_recorder
+    )
+    mocked_dns_lookup_with_retry.assert_called_once_with(
+        MOCKED_DNS_NAME,
+        MOCKED_DNS_RECORD_TYPE,
+        5,
+        stop_policy=stop_policy,
+        metric_recorder=metric_recorder,
+    )
 
-    invocation_count_per_pending_deregistration_ip = {
-        "1.1.1.1": 1,
-        "2.2.2.2": 2,
-        "3.3.3.3": 3,
-    }
-    invocation_before_deregistration = 3
-    actual_result = common_util.get_pending_deregistration_ip_set(
-        invocation_count_per_pending_deregistration_ip, invocation_before_deregistration
+    # Case 3: With the Availability Zone map of the ELB. Sampling goes on until every Availability Zone that has
+    # a subnet of the IP version has an IP seen
+    availability_zone_map = AvailabilityZoneMap(
+        [
+            {"SubnetId": "subnet-1", "AvailabilityZone": "us-east-1a", "CidrBlockList": ["10.0.0.0/24"]},
+            {"SubnetId": "subnet-2", "AvailabilityZone": "us-east-1b", "CidrBlockList": ["10.0.1.0/24"]},
+            {"SubnetId": "subnet-3", "AvailabilityZone": "us-east-1c", "CidrBlockList": ["2600:1f18::/64"]},
+        ]
     )
-    expected_result = {"3.3.3.3"}
-    assert actual_result == expected_result
+    stop_policy = CoverageStopPolicy()
+    mocked_dns_lookup_with_retry.side_effect = lambda *args, **kwargs: stop_policy.add_sample(["10.0.0.1"])
+    common_util.get_elb_ip_from_dns(
+        MOCKED_DNS_NAME,
+        MOCKED_DNS_RECORD_TYPE,
+        5,
+        stop_policy,
+        metric_recorder,
+        availability_zone_map=availability_zone_map,
+    )
+    assert stop_policy.required_availability_zone_set == {"us-east-1a", "us-east-1b"}
+    assert stop_policy.unseen_availability_zone_set == {"us-east-1b"}
+    assert metric_recorder.metric_values["UnseenAvailabilityZoneCount"] == [1]
+
+    # Case 4: With a DNS observation. It gets the sampling confidence and the name server of every IP
+    stop_policy = CoverageStopPolicy()
+    mocked_dns_lookup_with_retry.side_effect = lambda *args, **kwargs: stop_policy.add_sample(["10.0.0.1"])
+    dns_observation = DnsObservation()
+    common_util.get_elb_ip_from_dns(
+        MOCKED_DNS_NAME, MOCKED_DNS_RECORD_TYPE, 5, stop_policy, dns_observation=dns_observation
+    )
+    assert dns_observation.sampling_confidence == 1.0
+    assert dns_observation.nameserver_per_ip == {"10.0.0.1": None}
 
 
 def test_get_elb_ip_target_from_ip_list_same_vpc():
@@ -240,12 +377,42 @@ def test_get_elb_ip_target_from_ip_list_different_vpc():
 
     ip_list = ["1.1.1.1", "2.2.2.2"]
     elb_listener = "80"
-    with patch("common.LambdaEnv.SAME_VPC", False):
-        actual_result = common_util.get_elb_ip_target_from_ip_list(
-            ip_list, elb_listener
-        )
-        expected_result = [
-            {"Id": "1.1.1.1", "Port": "80", "AvailabilityZone": "all"},
-            {"Id": "2.2.2.2", "Port": "80", "AvailabilityZone": "all"},
-        ]
-        assert actual_result == expected_result
+    actual_result = common_util.get_elb_ip_target_from_ip_list(
+        ip_list, elb_listener, same_vpc=False
+    )
+    expected_result = [
+        {"Id": "1.1.1.1", "Port": "80", "AvailabilityZone": "all"},
+        {"Id": "2.2.2.2", "Port": "80", "AvailabilityZone": "all"},
+    ]
+    assert actual_result == expected_result
+
+
+@patch("common.logger", return_value=MagicMock())
+def test_get_ip_set_per_version(mocked_logger):
+    from common import get_ip_set_per_version
+
+    # IPv6 addresses are kept in their canonical text form and invalid addresses are dropped
+    assert get_ip_set_per_version(
+        ["1.1.1.1", "2600:1F18:0:0::000A", "2600:1f18::a", "not-an-ip"]
+    ) == {4: {"1.1.1.1"}, 6: {"2600:1f18::a"}}
+    mocked_logger.warning.assert_called_once()
+    assert get_ip_set_per_version([]) == {4: set(), 6: set()}
+
+
+def test_get_alb_name_from_dns_name():
+    from common import get_alb_name_from_dns_name
+
+    assert (
+        get_alb_name_from_dns_name("internal-my-alb-1234567890.us-east-1.elb.amazonaws.com")
+        == "my-alb"
+    )
+    assert get_alb_name_from_dns_name("My-Alb-1234567890.us-east-1.elb.amazonaws.com") == "my-alb"
+
+
+def test_get_alb_name_from_eni_description():
+    from common import get_alb_name_from_eni_description
+
+    assert get_alb_name_from_eni_description("ELB app/My-Alb/50dc6c495c0c9188") == "my-alb"
+    # Network interfaces of an NLB or anything else
+    assert get_alb_name_from_eni_description("ELB net/my-nlb/50dc6c495c0c9188") is None
+    assert get_alb_name_from_eni_description(None) is None
@@ -0,0 +1,57 @@
+def test_config():
+    from constant import Config
+
+    # Case 1: Defaults of a missing configuration
+    config = Config({})
+    assert config.MAX_LOOKUP_PER_INVOCATION == 0
+    assert config.DEREGISTRATION_CONFIDENCE == 0.01
+    assert config.SAME_VPC is True
+    assert config.REGION == ""
+    assert not config.error_list
+
+    # Case 2: Environment variables are parsed
+    config = Config.from_environment({
+        "ALB_DNS_NAME": "internal-alb.us-east-1.elb.amazonaws.com",
+        "ALB_LISTENER": "443",
+        "IP_ADDRESS_TYPE": "IPv6",
+        "CW_METRIC_FLAG_IP_COUNT": "True",
+        "AWS_REGION": "us-east-1",
+    })
+    assert config.ALB_LISTENER == 443
+    assert config.IP_ADDRESS_TYPE == "ipv6"
+    assert config.CW_METRIC_FLAG_IP_COUNT is True
+    assert config.REGION == "us-east-1"
+
+    # Case 3: Values of a configuration file keep their JSON type
+    config = Config({"MAX_LOOKUP_PER_INVOCATION": 50, "SAME_VPC": False})
+    assert config.MAX_LOOKUP_PER_INVOCATION == 50
+    assert config.SAME_VPC is False
+
+    # Case 4: An invalid value keeps its default and is reported
+    config = Config({"ALB_LISTENER": "https", "DEREGISTRATION_DELAY": "60"})
+    assert config.ALB_LISTENER == 0
+    assert config.DEREGISTRATION_DELAY == 60
+    assert config.error_list == ["ALB_LISTENER is invalid: https"]
+
+
+def test_reconcile_target():
+    from constant import Config, ReconcileTarget
+
+    config = Config({"DEREGISTRATION_DELAY": "60"})
+    primary_target = ReconcileTarget(
+        "internal-alb.us-east-1.elb.amazonaws.com", 443, "arn:...", "internal-alb.us-east-1.elb.amazonaws.com",
+        is_primary=True, config=config,
+    )
+    assert primary_target.config is config
+    assert primary_target.state_key == "internal-alb.us-east-1.elb.amazonaws.com/state.json"
+    assert primary_target.active_ip_list_key == "internal-alb.us-east-1.elb.amazonaws.com/active_ip.json"
+    assert primary_target.pending_ip_list_key == "internal-alb.us-east-1.elb.amazonaws.com/pending_ip.json"
+
+    # Without a configuration, the mapping is reconciled with the defaults
+    ipv6_target = ReconcileTarget(
+        "internal-alb.us-east-1.elb.amazonaws.com", 443, "arn:...", "internal-alb.us-east-1.elb.amazonaws.com",
+        is_primary=True, ip_address_type="ipv6",
+    )
+    assert ipv6_target.config.DEREGISTRATION_DELAY == 0
+    assert ipv6_target.state_key == "internal-alb.us-east-1.elb.amazonaws.com/ipv6/state.json"
+    assert ipv6_target.active_ip_list_key is None
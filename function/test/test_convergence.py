@@ -0,0 +1,83 @@
+import pytest
+
+EIGHT_IP_LIST = [f"10.10.10.{i}" for i in range(8)]
+
+
+def test_complete_response_stop_policy():
+    from convergence import CompleteResponseStopPolicy
+
+    stop_policy = CompleteResponseStopPolicy()
+
+    # Case 1: A full response may hide more IPs
+    stop_policy.add_sample(EIGHT_IP_LIST)
+    assert not stop_policy.should_stop()
+    assert stop_policy.confidence == 0.0
+
+    # Case 2: A response with less than 8 IPs holds all of them
+    stop_policy.add_sample(EIGHT_IP_LIST[:3])
+    assert stop_policy.should_stop()
+    assert stop_policy.stop_reason == "There are less than 8 IPs in the DNS response"
+    assert stop_policy.confidence == 1.0
+    assert stop_policy.estimated_unseen_ip_count == 0.0
+
+
+def test_stable_lookup_stop_policy():
+    from convergence import StableLookupStopPolicy
+
+    stop_policy = StableLookupStopPolicy(2)
+    stop_policy.add_sample(EIGHT_IP_LIST, "205.251.192.1")
+    stop_policy.add_sample(EIGHT_IP_LIST[1:] + ["10.10.10.100"], "205.251.194.1")
+    assert not stop_policy.should_stop()
+    # Every IP keeps the name server of the first response that held it
+    assert stop_policy.nameserver_per_ip["10.10.10.0"] == "205.251.192.1"
+    assert stop_policy.nameserver_per_ip["10.10.10.100"] == "205.251.194.1"
+    stop_policy.add_sample(EIGHT_IP_LIST)
+    assert not stop_policy.should_stop()
+    stop_policy.add_sample(EIGHT_IP_LIST)
+    assert stop_policy.should_stop()
+    assert stop_policy.stop_reason == "No new IP found in the last 2 DNS lookups"
+
+
+def test_coverage_stop_policy():
+    from convergence import CoverageStopPolicy
+
+    # Case 1: The same 8 IPs in every response. Stop after the minimum lookup count
+    stop_policy = CoverageStopPolicy(min_lookup_count=3)
+    for lookup_count in range(1, 4):
+        assert not stop_policy.should_stop()
+        stop_policy.add_sample(EIGHT_IP_LIST)
+    assert stop_policy.should_stop()
+    assert stop_policy.estimated_unseen_ip_count == 0.0
+    assert stop_policy.confidence == 1.0
+
+    # Case 2: Many IPs are only seen once. Keep sampling
+    stop_policy = CoverageStopPolicy(min_lookup_count=3)
+    ip_list = [f"10.10.10.{i}" for i in range(24)]
+    for offset in (0, 8, 16, 4):
+        stop_policy.add_sample(ip_list[offset: offset + 8])
+    (singleton_count, doubleton_count) = (16, 8)
+    assert stop_policy.estimated_unseen_ip_count == pytest.approx(
+        3 / 4 * singleton_count ** 2 / (2 * doubleton_count)
+    )
+    assert 0.0 < stop_policy.confidence < 1.0
+    assert not stop_policy.should_stop()
+
+
+def test_availability_zone_coverage():
+    from convergence import CoverageStopPolicy, StableLookupStopPolicy
+
+    def get_availability_zone(ip):
+        return "us-east-1b" if ip == "10.10.10.100" else "us-east-1a"
+
+    # Keep sampling until every Availability Zone has an IP seen
+    for stop_policy in (CoverageStopPolicy(min_lookup_count=3), StableLookupStopPolicy(2)):
+        stop_policy.require_availability_zone_coverage({"us-east-1a", "us-east-1b"}, get_availability_zone)
+        for _ in range(4):
+            stop_policy.add_sample(EIGHT_IP_LIST)
+        assert stop_policy.unseen_availability_zone_set == {"us-east-1b"}
+        assert not stop_policy.should_stop()
+        stop_policy.add_sample(EIGHT_IP_LIST[1:] + ["10.10.10.100"])
+        for _ in range(4):
+            stop_policy.add_sample(EIGHT_IP_LIST[1:] + ["10.10.10.100"])
+        assert stop_policy.unseen_availability_zone_set == set()
+        assert stop_policy.should_stop()
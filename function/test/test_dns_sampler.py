@@ -0,0 +1,103 @@
+import socket
+import threading
+import pytest
+import dns.message
+import dns.query
+import dns.rdatatype
+import dns.rrset
+
+MOCKED_DNS_NAME = "mocked.domain.name.com"
+
+
+def make_response_wire(query_wire, ip_list, rdtype="A"):
+    """
+    Build a DNS response (with name compression) to the given query
+    """
+    query = dns.message.from_wire(query_wire)
+    response = dns.message.make_response(query)
+    response.answer.append(
+        dns.rrset.from_text_list(MOCKED_DNS_NAME + ".", 60, "IN", rdtype, ip_list)
+    )
+    return response.to_wire()
+
+
+@pytest.fixture()
+def mocked_nameserver():
+    """
+    Answer every query on a localhost UDP socket with a stale response first and then the real one
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.bind(("127.0.0.1", 0))
+    server_socket.settimeout(5)
+
+    def serve():
+        try:
+            while True:
+                (query_wire, source) = server_socket.recvfrom(512)
+                stale_wire = bytearray(make_response_wire(query_wire, ["9.9.9.9"]))
+                stale_wire[0] ^= 0xFF
+                server_socket.sendto(stale_wire, source)
+                server_socket.sendto(
+                    make_response_wire(query_wire, ["10.10.10.10", "11.11.11.11"]),
+                    source,
+                )
+        except OSError:
+            return
+
+    server_thread = threading.Thread(target=serve, daemon=True)
+    server_thread.start()
+    yield server_socket.getsockname()[1]
+    server_socket.close()
+
+
+def test_parse_answer_address_list():
+    from dns_sampler import parse_answer_address_list
+
+    query = dns.message.make_query(MOCKED_DNS_NAME, "AAAA")
+    wire = make_response_wire(query.to_wire(), ["2001:db8::1", "2001:db8::2"], "AAAA")
+
+    # Case 1: Addresses in the answer section are returned
+    actual_result = parse_answer_address_list(wire, query.id, dns.rdatatype.AAAA)
+    assert sorted(actual_result) == ["2001:db8::1", "2001:db8::2"]
+
+    # Case 2: Response to another query
+    with pytest.raises(dns.query.BadResponse):
+        parse_answer_address_list(wire, (query.id + 1) % 65536, dns.rdatatype.AAAA)
+
+    # Case 3: Truncated response
+    with pytest.raises(dns.query.BadResponse):
+        parse_answer_address_list(wire[:-3], query.id, dns.rdatatype.AAAA)
+
+
+def test_dns_sampler_burst(mocked_nameserver):
+    from dns_sampler import DnsSampler
+
+    dns_sampler = DnsSampler(MOCKED_DNS_NAME, "A")
+
+    # Every query of the burst is answered once and stale responses are skipped
+    actual_result = list(
+        dns_sampler.burst(["127.0.0.1"] * 5, 2, port=mocked_nameserver)
+    )
+    assert len(actual_result) == 5
+    for (nameserver, ip_list) in actual_result:
+        assert nameserver == "127.0.0.1"
+        assert sorted(ip_list) == ["10.10.10.10", "11.11.11.11"]
+    assert dns_sampler.burst_timeout_count == 0
+
+    # The socket is reused across bursts
+    for _ in range(2):
+        assert len(list(dns_sampler.burst(["127.0.0.1"], 2, port=mocked_nameserver))) == 1
+    assert len(dns_sampler.sockets) == 1
+
+    # Queries without a response are dropped at the shared deadline
+    actual_result = list(
+        dns_sampler.burst(["127.0.0.1", "127.0.0.2"], 0.2, port=mocked_nameserver)
+    )
+    assert [nameserver for (nameserver, _) in actual_result] == ["127.0.0.1"]
+    assert dns_sampler.burst_timeout_count == 1
+
+    # Queries that are abandoned by the caller are not timeouts
+    for _ in dns_sampler.burst(["127.0.0.1", "127.0.0.2"], 0.2, port=mocked_nameserver):
+        break
+    assert dns_sampler.burst_timeout_count == 0
+    dns_sampler.close()
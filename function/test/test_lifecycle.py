@@ -0,0 +1,107 @@
+from mock import patch, MagicMock
+
+MOCKED_ACTIVE_IP_DICT = {
+    "LoadBalancerName": "internal-alb-internal-12345.us-east-1.elb.amazonaws.com",
+    "TimeStamp": "2021-05-17 23:31:12",
+    "IPList": ["1.1.1.1", "2.2.2.2"],
+    "IPCount": 2,
+}
+# Epoch seconds of the TimeStamp of MOCKED_ACTIVE_IP_DICT
+MOCKED_ACTIVE_TIME = 1621294272
+MOCKED_NOW = 1621294392
+
+
+def test_get_lifecycle_state(env_setup):
+    from lifecycle import get_lifecycle_state
+
+    # (is_in_dns, is_registered, is_draining, previous lifecycle state): expected lifecycle state
+    expected_lifecycle_state_per_case = {
+        (True, False, False, None): "discovered",
+        (True, True, False, "discovered"): "registered",
+        (False, True, False, "registered"): "missing",
+        (True, True, False, "missing"): "registered",
+        (False, False, True, "missing"): "draining",
+        (False, False, False, "draining"): "deregistered",
+        (False, False, False, "registered"): "deregistered",
+        (True, False, False, "deregistered"): "discovered",
+        (False, False, False, "discovered"): None,
+    }
+    for (case, expected_lifecycle_state) in expected_lifecycle_state_per_case.items():
+        assert get_lifecycle_state(*case) == expected_lifecycle_state
+
+
+@patch("lifecycle.logger", return_value=MagicMock())
+def test_from_state(mocked_logger, env_setup):
+    from lifecycle import IpLifecycleTable
+
+    # Case 1: Version 2 state. The entries are copied
+    targets = {"1.1.1.1": {"State": "registered", "Since": 1, "FirstSeen": 1, "MissingSince": None}}
+    ip_lifecycle_table = IpLifecycleTable.from_state({"Version": 2, "Targets": targets}, MOCKED_NOW)
+    ip_lifecycle_table.set_lifecycle_state({"1.1.1.1"}, "missing", MOCKED_NOW)
+    assert targets["1.1.1.1"]["State"] == "registered"
+
+    # Case 2: Version 1 state. The active IPs are registered as of their TimeStamp and the pending IPs start
+    # missing now
+    ip_lifecycle_table = IpLifecycleTable.from_state(
+        {
+            "Version": 1,
+            "ActiveIP": MOCKED_ACTIVE_IP_DICT,
+            "PendingDeregistrationIP": {"2.2.2.2": 2, "3.3.3.3": 1},
+        },
+        MOCKED_NOW,
+    )
+    assert ip_lifecycle_table.to_state() == {
+        "1.1.1.1": {
+            "State": "registered", "Since": MOCKED_ACTIVE_TIME, "FirstSeen": MOCKED_ACTIVE_TIME, "MissingSince": None
+        },
+        "2.2.2.2": {
+            "State": "missing", "Since": MOCKED_NOW, "FirstSeen": MOCKED_ACTIVE_TIME, "MissingSince": MOCKED_NOW
+        },
+        "3.3.3.3": {"State": "missing", "Since": MOCKED_NOW, "FirstSeen": MOCKED_NOW, "MissingSince": MOCKED_NOW},
+    }
+
+    # Case 3: No state
+    assert IpLifecycleTable.from_state({}, MOCKED_NOW).to_state() == {}
+
+
+@patch("lifecycle.logger", return_value=MagicMock())
+def test_update(mocked_logger, env_setup):
+    from lifecycle import IpLifecycleTable
+
+    ip_lifecycle_table = IpLifecycleTable()
+
+    # New IPs in the DNS are discovered. A registered IP that is not in the DNS is missing
+    changed_ip_set = ip_lifecycle_table.update({"1.1.1.1", "2.2.2.2"}, {"1.1.1.1", "3.3.3.3"}, set(), 100)
+    assert changed_ip_set == {"1.1.1.1", "2.2.2.2", "3.3.3.3"}
+    assert ip_lifecycle_table.get_ip_set("registered") == {"1.1.1.1"}
+    assert ip_lifecycle_table.get_ip_set("discovered") == {"2.2.2.2"}
+    assert ip_lifecycle_table.get_ip_set("missing") == {"3.3.3.3"}
+    ip_lifecycle_table.set_lifecycle_state({"2.2.2.2"}, "registered", 100)
+
+    # Nothing entered or left the DNS or the target group. Nothing changes
+    state = ip_lifecycle_table.to_state()
+    assert ip_lifecycle_table.update({"1.1.1.1", "2.2.2.2"}, {"1.1.1.1", "2.2.2.2", "3.3.3.3"}, set(), 160) == set()
+    assert ip_lifecycle_table.to_state() == state
+
+    # 1.1.1.1 leaves the DNS. It stays missing since the first update that missed it
+    ip_lifecycle_table.update({"2.2.2.2"}, {"1.1.1.1", "2.2.2.2", "3.3.3.3"}, set(), 220)
+    ip_lifecycle_table.update({"2.2.2.2"}, {"1.1.1.1", "2.2.2.2", "3.3.3.3"}, set(), 280)
+    assert ip_lifecycle_table.to_state()["1.1.1.1"]["MissingSince"] == 220
+    assert ip_lifecycle_table.get_pending_deregistration_ip_set(280, 120) == {"3.3.3.3"}
+    assert ip_lifecycle_table.get_pending_deregistration_ip_set(340, 120) == {"1.1.1.1", "3.3.3.3"}
+
+    # 1.1.1.1 is back in the DNS before it was deregistered. 3.3.3.3 drains and leaves the target group
+    ip_lifecycle_table.update({"1.1.1.1", "2.2.2.2"}, {"1.1.1.1", "2.2.2.2"}, {"3.3.3.3"}, 340)
+    assert ip_lifecycle_table.to_state()["1.1.1.1"]["MissingSince"] is None
+    assert ip_lifecycle_table.get_ip_set("registered") == {"1.1.1.1", "2.2.2.2"}
+    assert ip_lifecycle_table.get_ip_set("draining") == {"3.3.3.3"}
+    ip_lifecycle_table.update({"1.1.1.1", "2.2.2.2"}, {"1.1.1.1", "2.2.2.2"}, set(), 400)
+    assert ip_lifecycle_table.get_ip_count_per_lifecycle_state() == {
+        "discovered": 0, "registered": 2, "missing": 0, "draining": 0, "deregistered": 1
+    }
+
+    # Deregistered IPs are kept for the retention only
+    ip_lifecycle_table.prune(400 + 3599)
+    assert "3.3.3.3" in ip_lifecycle_table.to_state()
+    ip_lifecycle_table.prune(400 + 3600)
+    assert "3.3.3.3" not in ip_lifecycle_table.to_state()
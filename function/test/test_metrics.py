@@ -0,0 +1,78 @@
+import json
+from mock import patch, MagicMock
+
+MOCKED_DIMENSIONS = {"LoadBalancerName": "mocked_alb.dns.name.com"}
+
+
+def test_metric_recorder():
+    from metrics import MetricRecorder, METRIC_NAMESPACE
+
+    metric_recorder = MetricRecorder(MOCKED_DIMENSIONS)
+    with metric_recorder.time_step("DnsSampling"):
+        pass
+    metric_recorder.add_count("DnsLookupCount")
+    metric_recorder.add_count("DnsLookupCount", 2)
+    metric_recorder.put_metric("DnsLookupIPCount", 8)
+    metric_recorder.put_metric("DnsLookupIPCount", 3)
+
+    emf_log_event = metric_recorder.to_emf()
+    metric_directive = emf_log_event["_aws"]["CloudWatchMetrics"][0]
+    assert metric_directive["Namespace"] == METRIC_NAMESPACE
+    assert metric_directive["Dimensions"] == [["LoadBalancerName"]]
+    assert {"Name": "DnsSamplingDuration", "Unit": "Milliseconds"} in metric_directive["Metrics"]
+    assert emf_log_event["LoadBalancerName"] == "mocked_alb.dns.name.com"
+    # A counter has one value and any other metric keeps every value
+    assert emf_log_event["DnsLookupCount"] == 3
+    assert emf_log_event["DnsLookupIPCount"] == [8, 3]
+    assert emf_log_event["DnsSamplingDuration"] >= 0
+
+
+@patch("builtins.print")
+def test_metric_recorder_flush(mocked_print):
+    from metrics import MetricRecorder
+
+    # Nothing is written when no metric was recorded
+    metric_recorder = MetricRecorder(MOCKED_DIMENSIONS)
+    metric_recorder.flush()
+    mocked_print.assert_not_called()
+
+    # One EMF log line and the metrics are reset
+    metric_recorder.add_count("ApiRetryCount")
+    metric_recorder.flush()
+    mocked_print.assert_called_once()
+    assert json.loads(mocked_print.call_args.args[0])["ApiRetryCount"] == 1
+    assert not metric_recorder.metric_values
+
+
+def test_metric_buffer():
+    from metrics import MetricBuffer, METRIC_NAMESPACE
+
+    mocked_aws_service = MagicMock()
+    mocked_aws_service.publish_metric_data.return_value = True
+    metric_buffer = MetricBuffer()
+    for ip_count in range(5):
+        metric_buffer.put("LoadBalancerIPCount", ip_count, MOCKED_DIMENSIONS)
+    metric_buffer.put("DnsConvergenceTime", 120.5, MOCKED_DIMENSIONS, "Milliseconds")
+
+    # Every datum is published in as few calls as possible and the buffer is reset
+    with patch("metrics.PUT_METRIC_DATA_MAX_DATUM_COUNT", 4):
+        assert metric_buffer.flush(mocked_aws_service) == 6
+    assert mocked_aws_service.publish_metric_data.call_count == 2
+    (namespace, metric_data_chunk) = mocked_aws_service.publish_metric_data.call_args.args
+    assert namespace == METRIC_NAMESPACE
+    assert metric_data_chunk[-1]["MetricName"] == "DnsConvergenceTime"
+    assert metric_data_chunk[-1]["Unit"] == "Milliseconds"
+    assert metric_data_chunk[-1]["Dimensions"] == [
+        {"Name": "LoadBalancerName", "Value": "mocked_alb.dns.name.com"}
+    ]
+    assert metric_buffer.flush(mocked_aws_service) == 0
+    assert mocked_aws_service.publish_metric_data.call_count == 2
+
+    # A unique datum is kept once per metric and dimensions until the next flush
+    for ip_count in (3, 3):
+        metric_buffer.put("LoadBalancerIPCount", ip_count, MOCKED_DIMENSIONS, is_unique=True)
+    metric_buffer.put("LoadBalancerIPCount", 3, {"LoadBalancerName": "mocked_alb_2.dns.name.com"}, is_unique=True)
+    assert len(metric_buffer.metric_data_list) == 2
+    assert metric_buffer.flush(mocked_aws_service) == 2
+    metric_buffer.put("LoadBalancerIPCount", 3, MOCKED_DIMENSIONS, is_unique=True)
+    assert len(metric_buffer.metric_data_list) == 1
@@ -0,0 +1,86 @@
+import pytest
+from mock import MagicMock
+
+MOCKED_NOW = 1621294392
+
+
+def test_dns_observation(env_setup):
+    from observation import DnsObservation
+
+    stop_policy = MagicMock()
+    stop_policy.confidence = 0.9
+    stop_policy.nameserver_per_ip = {"1.1.1.1": "205.251.192.1"}
+    stop_policy.lookup_count = 12
+    stop_policy.estimated_unseen_ip_count = 0.01234
+    stop_policy.stop_reason = "Estimated unseen IP count is below 0.05"
+    dns_observation = DnsObservation()
+    assert dns_observation.sampling_confidence == 0.0
+    dns_observation.add_sampling(stop_policy)
+    assert dns_observation.sampling_confidence == 0.9
+    assert dns_observation.nameserver_per_ip == {"1.1.1.1": "205.251.192.1"}
+    assert dns_observation.get_sampling_statistics() == {
+        "LookupCount": 12,
+        "SamplingConfidence": 0.9,
+        "EstimatedUnseenIPCount": 0.01,
+        "StopReason": "Estimated unseen IP count is below 0.05",
+    }
+
+    # An estimate that cannot be made is left out
+    stop_policy.estimated_unseen_ip_count = float("inf")
+    dns_observation.add_sampling(stop_policy)
+    assert dns_observation.get_sampling_statistics()["EstimatedUnseenIPCount"] is None
+
+
+def test_get_detection_rate(env_setup):
+    from observation import get_detection_rate
+
+    # Case 1: Seen by every invocation. The rate is capped
+    assert get_detection_rate({"History": 0b1111, "RunCount": 4}) == 0.95
+    # Case 2: The current run of misses does not count
+    assert get_detection_rate({"History": 0b1110, "RunCount": 4}) == 0.95
+    # Case 3: The recent invocations weigh more
+    assert get_detection_rate({"History": 0b0011, "RunCount": 4}) == pytest.approx(1.8 / 2.952)
+    assert get_detection_rate({"History": 0b0100, "RunCount": 4}) == pytest.approx(1 / 1.8)
+    # Case 4: No hit yet
+    assert get_detection_rate({"History": 0, "RunCount": 3}) == 0.5
+
+
+def test_update(env_setup):
+    from observation import DnsObservation, IpObservationIndex
+
+    dns_observation = DnsObservation(sampling_confidence=1.0)
+    dns_observation.nameserver_per_ip = {"1.1.1.1": "205.251.192.1", "2.2.2.2": "205.251.194.1"}
+    ip_observation_index = IpObservationIndex()
+    # 1.1.1.1 is returned by every invocation and 2.2.2.2 by every other invocation
+    for invocation_index in range(8):
+        ip_seen_set = {"1.1.1.1", "2.2.2.2"} if invocation_index % 2 else {"1.1.1.1"}
+        ip_observation_index.update(ip_seen_set, dns_observation, MOCKED_NOW + invocation_index * 60)
+    state = ip_observation_index.to_state()
+    # LastSeen and the name server are updated every 5 minutes only
+    assert state["1.1.1.1"] == {
+        "LastSeen": MOCKED_NOW + 300, "History": 255, "RunCount": 8, "Confidence": 1.0, "NameServer": "205.251.192.1"
+    }
+    assert state["2.2.2.2"]["History"] == 0b01010101
+    assert state["2.2.2.2"]["Confidence"] == 1.0
+
+    # Both of them are gone. 1.1.1.1 loses its confidence fast and 2.2.2.2, that was rarely returned, slowly
+    ip_observation_index.update(set(), dns_observation, MOCKED_NOW + 480)
+    ip_observation_index.update(set(), dns_observation, MOCKED_NOW + 540)
+    assert ip_observation_index.get_confidence("1.1.1.1") == 0.0025
+    assert ip_observation_index.get_confidence("2.2.2.2") > 0.1
+    assert ip_observation_index.get_low_confidence_ip_set({"1.1.1.1", "2.2.2.2"}, 0.01) == {"1.1.1.1"}
+
+    # A sampling that tells nothing does not lower the confidence
+    ip_observation_index.update(set(), DnsObservation(), MOCKED_NOW + 600)
+    assert ip_observation_index.get_confidence("1.1.1.1") == 0.0025
+
+    # The tracked IPs without observation start at full confidence
+    ip_observation_index.update(set(), dns_observation, MOCKED_NOW + 660, {"3.3.3.3"})
+    assert ip_observation_index.get_confidence("3.3.3.3") == 0.5
+    assert ip_observation_index.get_confidence("4.4.4.4") == 1.0
+
+    ip_observation_index.retain({"2.2.2.2"})
+    assert set(ip_observation_index.to_state()) == {"2.2.2.2"}
+    assert IpObservationIndex.from_state({"Observations": ip_observation_index.to_state()}).to_state() == (
+        ip_observation_index.to_state()
+    )
@@ -1,3 +1,5 @@
+import json
+import threading
 import pytest
 from mock import patch, MagicMock, call
 from test.unittest_constant import UnittestConstant
@@ -13,99 +15,445 @@ mocked_active_ip_dict_from_previous_invocation = {
 
 mocked_pending_ip_dict_from_previous_invocation = {"3.3.3.3": "1", "1.1.1.1": "2"}
 
+mocked_state_from_previous_invocation = {
+    "Version": 3,
+    "ActiveIP": mocked_active_ip_dict_from_previous_invocation,
+    "Targets": {
+        "1.1.1.1": {"State": "registered", "Since": 1621294272, "FirstSeen": 1621294212, "MissingSince": None},
+        "3.3.3.3": {"State": "missing", "Since": 1621294332, "FirstSeen": 1621294212, "MissingSince": 1621294332},
+    },
+    "Observations": {
+        "1.1.1.1": {
+            "LastSeen": 1621294272, "History": 65535, "RunCount": 16, "Confidence": 1.0, "NameServer": "205.251.192.1"
+        },
+        "3.3.3.3": {
+            "LastSeen": 1621294272, "History": 14, "RunCount": 4, "Confidence": 0.05, "NameServer": "205.251.194.1"
+        },
+    },
+}
+
+MOCKED_ALB_ENI_EVENT = {
+    "source": "aws.ec2",
+    "detail-type": "AWS API Call via CloudTrail",
+    "detail": {
+        "eventName": "CreateNetworkInterface",
+        "requestParameters": {"description": "ELB app/mocked_alb_2/50dc6c495c0c9188"},
+        "responseElements": {
+            "networkInterface": {
+                "description": "ELB app/mocked_alb_2/50dc6c495c0c9188",
+                "privateIpAddress": "9.9.9.9",
+            }
+        },
+    },
+}
+
+MOCKED_TARGET_MAPPING = {
+    "AlbDnsName": "mocked_alb_2.dns.name.com",
+    "AlbListener": 443,
+    "NlbTgArn": "arn:aws:elasticloadbalancing:us-east-1:12345:targetgroup/TG-mocked-2/12345abcde",
+}
+
+
+def get_mocked_config(**value_per_variable):
+    from constant import Config
+
+    return Config(dict(
+        {
+            "ALB_DNS_NAME": UnittestConstant.ALB_DNS_NAME,
+            "ALB_LISTENER": UnittestConstant.ALB_LISTENER,
+            "S3_BUCKET": UnittestConstant.S3_BUCKET,
+            "NLB_TG_ARN": UnittestConstant.NLB_TG_ARN,
+            "MAX_LOOKUP_PER_INVOCATION": UnittestConstant.MAX_LOOKUP_PER_INVOCATION,
+            "INVOCATIONS_BEFORE_DEREGISTRATION": UnittestConstant.INVOCATIONS_BEFORE_DEREGISTRATION,
+            "CW_METRIC_FLAG_IP_COUNT": UnittestConstant.CW_METRIC_FLAG_IP_COUNT,
+            "SAME_VPC": UnittestConstant.SAME_VPC,
+            "AWS_REGION": UnittestConstant.AWS_REGION,
+        },
+        **value_per_variable
+    ))
+
+
+def get_mocked_reconcile_target(config=None):
+    from constant import ReconcileTarget
+
+    return ReconcileTarget(
+        UnittestConstant.ALB_DNS_NAME,
+        int(UnittestConstant.ALB_LISTENER),
+        UnittestConstant.NLB_TG_ARN,
+        state_key_prefix=UnittestConstant.ALB_DNS_NAME,
+        is_primary=True,
+        config=config or get_mocked_config(),
+    )
+
 
 def test_validate_environment_variable():
     from populate_NLB_TG_with_ALB import validate_environment_variable
 
     # Raise exception when MAX_LOOKUP_PER_INVOCATION <= 0
-    with patch("populate_NLB_TG_with_ALB.LambdaEnv.MAX_LOOKUP_PER_INVOCATION", 0):
-        with pytest.raises(ValueError) as e:
-            expected_error_message = (
-                "MAX_LOOKUP_PER_INVOCATION is required to be a positive number"
-            )
-            validate_environment_variable()
-            assert str(e) == expected_error_message
+    with pytest.raises(ValueError) as e:
+        validate_environment_variable(get_mocked_config(MAX_LOOKUP_PER_INVOCATION="0"))
+    assert str(e.value) == "MAX_LOOKUP_PER_INVOCATION is required to be a positive number"
 
     # Raise exception when INVOCATIONS_BEFORE_DEREGISTRATION <= 0
-    with patch(
-        "populate_NLB_TG_with_ALB.LambdaEnv.INVOCATIONS_BEFORE_DEREGISTRATION", 0
-    ):
-        with pytest.raises(ValueError) as e:
-            expected_error_message = (
-                "INVOCATIONS_BEFORE_DEREGISTRATION is required to be a positive number"
-            )
-            validate_environment_variable()
-            assert str(e) == expected_error_message
+    with pytest.raises(ValueError) as e:
+        validate_environment_variable(get_mocked_config(INVOCATIONS_BEFORE_DEREGISTRATION="0"))
+    assert str(e.value) == "INVOCATIONS_BEFORE_DEREGISTRATION is required to be a positive number"
 
+    # Raise exception when a value cannot be parsed
+    with pytest.raises(ValueError) as e:
+        validate_environment_variable(get_mocked_config(ALB_LISTENER="https"))
+    assert str(e.value) == "Configuration is invalid: ALB_LISTENER is invalid: https"
 
-@patch("populate_NLB_TG_with_ALB.sys")
+    # Raise exception when the S3 bucket or the region is missing
+    with pytest.raises(ValueError):
+        validate_environment_variable(get_mocked_config(S3_BUCKET=""))
+
+    # Raise exception when TARGET_MAPPINGS is not valid JSON
+    with pytest.raises(ValueError):
+        validate_environment_variable(get_mocked_config(TARGET_MAPPINGS="[{"))
+
+    # Raise exception when a mapping is duplicated
+    with pytest.raises(ValueError):
+        validate_environment_variable(
+            get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING, MOCKED_TARGET_MAPPING]))
+        )
+
+    # Several target groups can be mapped to one ALB listener
+    second_target_group_mapping = dict(
+        MOCKED_TARGET_MAPPING,
+        NlbTgArn="arn:aws:elasticloadbalancing:us-east-1:12345:targetgroup/TG-mocked-3/67890abcde",
+    )
+    assert len(validate_environment_variable(
+        get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING, second_target_group_mapping]))
+    )) == 3
+
+    # Raise exception when the deregistration confidence is not between 0 and 1
+    for deregistration_confidence in ("0", "1.5"):
+        with pytest.raises(ValueError):
+            validate_environment_variable(get_mocked_config(DEREGISTRATION_CONFIDENCE=deregistration_confidence))
+
+    # Raise exception when the state encoding is unknown
+    with pytest.raises(ValueError):
+        validate_environment_variable(get_mocked_config(STATE_ENCODING="xml"))
+
+    # Raise exception when no mapping is given
+    with pytest.raises(ValueError):
+        validate_environment_variable(get_mocked_config(ALB_DNS_NAME=""))
+
+    # Return the mappings to reconcile. They are reconciled with the validated configuration
+    config = get_mocked_config()
+    reconcile_target_list = validate_environment_variable(config)
+    assert [target.alb_dns_name for target in reconcile_target_list] == [
+        UnittestConstant.ALB_DNS_NAME
+    ]
+    assert reconcile_target_list[0].config is config
+
+    # A configuration is validated once
+    with patch("populate_NLB_TG_with_ALB.get_reconcile_target_list") as mocked_get_reconcile_target_list:
+        assert validate_environment_variable(config) is reconcile_target_list
+    mocked_get_reconcile_target_list.assert_not_called()
+
+
+def test_get_reconcile_target_list():
+    from populate_NLB_TG_with_ALB import get_reconcile_target_list
+
+    ipv6_target_mapping = dict(MOCKED_TARGET_MAPPING, IpAddressType="IPv6")
+    (primary_target, additional_target, ipv6_target) = get_reconcile_target_list(
+        get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING, ipv6_target_mapping]))
+    )
+
+    # The primary mapping keeps the state object and the legacy objects of the single ALB mode
+    assert primary_target.alb_dns_name == UnittestConstant.ALB_DNS_NAME
+    assert primary_target.alb_listener == 80
+    assert primary_target.nlb_tg_arn == UnittestConstant.NLB_TG_ARN
+    assert primary_target.state_key == UnittestConstant.STATE_KEY
+    assert primary_target.active_ip_list_key == UnittestConstant.ACTIVE_IP_LIST_KEY
+
+    # An additional mapping has its own state object per ALB listener and target group. It reads the state object
+    # per ALB listener when its own does not exist yet
+    assert additional_target.alb_dns_name == "mocked_alb_2.dns.name.com"
+    assert additional_target.alb_listener == 443
+    assert additional_target.state_key == (
+        "mocked_alb_2.dns.name.com/443/targetgroup/TG-mocked-2/12345abcde/state.json"
+    )
+    assert additional_target.previous_state_key == "mocked_alb_2.dns.name.com/443/state.json"
+    assert additional_target.active_ip_list_key is None
+    assert additional_target.ip_version == 4
+
+    # An IPv6 mapping of the same ALB listener has its own state object
+    assert ipv6_target.ip_version == 6
+    assert ipv6_target.state_key == (
+        "mocked_alb_2.dns.name.com/443/targetgroup/TG-mocked-2/12345abcde/ipv6/state.json"
+    )
+    assert ipv6_target.previous_state_key == "mocked_alb_2.dns.name.com/443/ipv6/state.json"
+
+    # An IPv6 primary mapping does not read the legacy objects of the IPv4 one
+    (primary_target,) = get_reconcile_target_list(get_mocked_config(IP_ADDRESS_TYPE="ipv6"))
+    assert primary_target.state_key == f"{UnittestConstant.ALB_DNS_NAME}/ipv6/state.json"
+    assert primary_target.previous_state_key is None
+    assert primary_target.active_ip_list_key is None
+
+
+@patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
+def test_get_triggered_reconcile_target_list(mocked_logger):
+    from constant import ReconcileTarget
+    from populate_NLB_TG_with_ALB import get_triggered_reconcile_target_list
+
+    second_reconcile_target = ReconcileTarget(
+        MOCKED_TARGET_MAPPING["AlbDnsName"],
+        MOCKED_TARGET_MAPPING["AlbListener"],
+        MOCKED_TARGET_MAPPING["NlbTgArn"],
+        state_key_prefix=MOCKED_TARGET_MAPPING["AlbDnsName"],
+    )
+    reconcile_target_list = [get_mocked_reconcile_target(), second_reconcile_target]
+
+    # Case 1: Scheduled event. Reconcile every mapping
+    scheduled_event = {"source": "aws.events", "detail-type": "Scheduled Event"}
+    for event in (scheduled_event, {}, None):
+        actual_result = get_triggered_reconcile_target_list(event, reconcile_target_list)
+        assert actual_result == (reconcile_target_list, set())
+
+    # Case 2: Network interface of an ALB node is created. Reconcile that ALB with the IP of the new node
+    actual_result = get_triggered_reconcile_target_list(
+        MOCKED_ALB_ENI_EVENT, reconcile_target_list
+    )
+    assert actual_result == ([second_reconcile_target], {"9.9.9.9"})
+
+    # Case 3: Manual trigger
+    actual_result = get_triggered_reconcile_target_list(
+        {"AlbDnsName": UnittestConstant.ALB_DNS_NAME}, reconcile_target_list
+    )
+    assert actual_result == (reconcile_target_list[:1], set())
+
+    # Case 4: The event matches no configured ALB. Reconcile every mapping
+    actual_result = get_triggered_reconcile_target_list(
+        {"AlbDnsName": "internal-other-alb-12345.us-east-1.elb.amazonaws.com"},
+        reconcile_target_list,
+    )
+    assert actual_result == (reconcile_target_list, set())
+
+
+@patch("builtins.print")
+@patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
 @patch("populate_NLB_TG_with_ALB.get_elb_ip_from_dns")
-def test_get_ip_from_dns(mocked_get_elb_ip_from_dns, mocked_sys):
+def test_get_ip_from_dns(mocked_get_elb_ip_from_dns, mocked_logger, mocked_print):
     from populate_NLB_TG_with_ALB import get_ip_from_dns
 
-    # Case 1: When there is no IP found in the DNS. Exit
+    config = get_mocked_config()
+    # Case 1: When there is no IP found in the DNS
     mocked_get_elb_ip_from_dns.return_value = set()
-    get_ip_from_dns()
-    mocked_sys.exit.assert_called_once_with(1)
+    assert get_ip_from_dns(config, UnittestConstant.ALB_DNS_NAME) == set()
+    mocked_logger.error.assert_called_once()
 
     # Case 2: When there are IPs in the DNS
     mocked_get_elb_ip_from_dns.return_value = {"1.1.1.1", "2.2.2.2"}
-    actual_result = get_ip_from_dns()
+    actual_result = get_ip_from_dns(config, UnittestConstant.ALB_DNS_NAME)
     expected_result = {"1.1.1.1", "2.2.2.2"}
     assert actual_result == expected_result
+    mocked_get_elb_ip_from_dns.assert_called_with(
+        UnittestConstant.ALB_DNS_NAME,
+        "A",
+        int(UnittestConstant.MAX_LOOKUP_PER_INVOCATION),
+        metric_recorder=mocked_get_elb_ip_from_dns.call_args.kwargs["metric_recorder"],
+        availability_zone_map=None,
+        dns_observation=None,
+    )
+    mocked_print.assert_not_called()
 
+    # Case 3: IPv6. Look up the AAAA records and keep the IPv6 addresses only
+    mocked_get_elb_ip_from_dns.return_value = {"2600:1F18::A", "1.1.1.1"}
+    assert get_ip_from_dns(config, UnittestConstant.ALB_DNS_NAME, ip_version=6) == {"2600:1f18::a"}
+    assert mocked_get_elb_ip_from_dns.call_args.args[1] == "AAAA"
+    mocked_get_elb_ip_from_dns.return_value = {"1.1.1.1", "2.2.2.2"}
 
-@patch("populate_NLB_TG_with_ALB.AwsServices")
-@patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
-def test_update_elb_ip_count_metric(mocked_logger, mocked_AwsServices):
+    # Case 4: With the AWS service object. Sample with the Availability Zone map of the ALB
+    with patch("populate_NLB_TG_with_ALB.get_availability_zone_map") as mocked_get_availability_zone_map:
+        get_ip_from_dns(config, UnittestConstant.ALB_DNS_NAME, aws_service=mocked_aws_services)
+    mocked_get_availability_zone_map.assert_called_once_with(mocked_aws_services, UnittestConstant.ALB_DNS_NAME)
+    assert (
+        mocked_get_elb_ip_from_dns.call_args.kwargs["availability_zone_map"]
+        == mocked_get_availability_zone_map.return_value
+    )
+
+    # Case 5: When step metrics are enabled. Emit one EMF log line per ALB
+    get_ip_from_dns(get_mocked_config(CW_METRIC_FLAG_STEP_METRICS="true"), UnittestConstant.ALB_DNS_NAME)
+    emf_log_event = json.loads(mocked_print.call_args.args[0])
+    assert emf_log_event["LoadBalancerName"] == UnittestConstant.ALB_DNS_NAME
+    assert emf_log_event["DnsIPCount"] == 2
+    assert "DnsSamplingDuration" in emf_log_event
+
+    # Case 6: A dry run emits no step metrics, as they would land in the series of the real reconciles
+    mocked_print.reset_mock()
+    get_ip_from_dns(
+        get_mocked_config(CW_METRIC_FLAG_STEP_METRICS="true"), UnittestConstant.ALB_DNS_NAME, is_dry_run=True
+    )
+    mocked_print.assert_not_called()
+
+
+def test_update_elb_ip_count_metric():
+    from metrics import MetricBuffer
     from populate_NLB_TG_with_ALB import update_elb_ip_count_metric
 
-    mocked_AwsServices.return_value = mocked_aws_services
-    mocked_active_ip_from_dns_meta_data = {}
+    metric_buffer = MetricBuffer()
+    # The mappings of one ALB publish its IP count once per pass
+    for _ in range(2):
+        update_elb_ip_count_metric(metric_buffer, mocked_active_ip_dict_from_previous_invocation)
+    (metric_data,) = metric_buffer.metric_data_list
+    assert metric_data["MetricName"] == "LoadBalancerIPCount"
+    assert metric_data["Value"] == 2.0
+    assert metric_data["Dimensions"] == [
+        {
+            "Name": "LoadBalancerName",
+            "Value": mocked_active_ip_dict_from_previous_invocation["LoadBalancerName"],
+        }
+    ]
+
+
+@patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
+def test_publish_metrics(mocked_logger):
+    from populate_NLB_TG_with_ALB import publish_metrics
+
+    mocked_metric_buffer = MagicMock()
     # When CW_METRIC_FLAG_IP_COUNT is set to False
-    with patch("populate_NLB_TG_with_ALB.LambdaEnv.CW_METRIC_FLAG_IP_COUNT", False):
-        update_elb_ip_count_metric(
-            mocked_aws_services, mocked_active_ip_from_dns_meta_data
-        )
-        mocked_logger.info.assert_called_with(
-            "CW_METRIC_FLAG_IP_COUNT is set to False. Skip publish CloudWatch metric..."
-        )
+    publish_metrics(get_mocked_config(CW_METRIC_FLAG_IP_COUNT="false"), mocked_aws_services, mocked_metric_buffer)
+    mocked_logger.info.assert_called_with(
+        "CW_METRIC_FLAG_IP_COUNT is set to False. Skip publish CloudWatch metric..."
+    )
+    mocked_metric_buffer.flush.assert_not_called()
 
     # When CW_METRIC_FLAG_IP_COUNT is set to True
-    update_elb_ip_count_metric(mocked_aws_services, mocked_active_ip_from_dns_meta_data)
+    publish_metrics(get_mocked_config(), mocked_aws_services, mocked_metric_buffer)
     mocked_logger.info.assert_called_with(
-        "CW_METRIC_FLAG_IP_COUNT is set to True. Publishing ELB node IP count metric"
-    )
-    mocked_aws_services.publish_elb_ip_count_metric.assert_called_with(
-        mocked_active_ip_from_dns_meta_data
+        "CW_METRIC_FLAG_IP_COUNT is set to True. Publishing ELB node IP count and controller metrics"
     )
+    mocked_metric_buffer.flush.assert_called_once_with(mocked_aws_services)
 
 
 @patch("populate_NLB_TG_with_ALB.AwsServices")
 @patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
-def test_get_ip_from_previous_invocation(mocked_logger, mocked_AwsServices):
-    from populate_NLB_TG_with_ALB import get_ip_from_previous_invocation
+def test_get_state_from_previous_invocation(mocked_logger, mocked_AwsServices):
+    from populate_NLB_TG_with_ALB import get_state_from_previous_invocation
 
     mocked_AwsServices.return_value = mocked_aws_services
+
+    # Case 1: When the state object exists
+    mocked_aws_services.download_state_from_s3.return_value = (
+        mocked_state_from_previous_invocation,
+        "mocked_etag",
+    )
+    actual_result = get_state_from_previous_invocation(
+        mocked_aws_services, get_mocked_reconcile_target()
+    )
+
+    mocked_aws_services.download_state_from_s3.assert_called_once_with(
+        UnittestConstant.STATE_KEY
+    )
+    mocked_aws_services.download_elb_ip_from_s3.assert_not_called()
+    assert actual_result == (mocked_state_from_previous_invocation, "mocked_etag")
+
+    # Case 2: When the state object does not exist yet. Read the legacy objects
+    mocked_aws_services.download_state_from_s3.return_value = ({}, None)
     mocked_aws_services.download_elb_ip_from_s3.side_effect = [
         mocked_active_ip_dict_from_previous_invocation,
         mocked_pending_ip_dict_from_previous_invocation,
     ]
-    (
-        actual_active_ip_dict_from_previous_invocation,
-        actual_pending_ip_dict_from_previous_invocation,
-        actual_active_ip_set_from_previous_invocation,
-    ) = get_ip_from_previous_invocation(mocked_aws_services)
+    actual_result = get_state_from_previous_invocation(
+        mocked_aws_services, get_mocked_reconcile_target()
+    )
 
-    assert (
-        actual_active_ip_dict_from_previous_invocation
-        == mocked_active_ip_dict_from_previous_invocation
+    mocked_aws_services.download_elb_ip_from_s3.assert_has_calls(
+        [
+            call(UnittestConstant.ACTIVE_IP_LIST_KEY),
+            call(UnittestConstant.PENDING_IP_LIST_KEY),
+        ]
     )
-    assert (
-        actual_pending_ip_dict_from_previous_invocation
-        == mocked_pending_ip_dict_from_previous_invocation
+    assert actual_result == (
+        {
+            "ActiveIP": mocked_active_ip_dict_from_previous_invocation,
+            "PendingDeregistrationIP": mocked_pending_ip_dict_from_previous_invocation,
+        },
+        None,
+    )
+
+    # Case 3: When the state object of an additional mapping does not exist yet. Read the state object under the
+    # previous state key. The state is written to the new state key only if it does not exist
+    from constant import ReconcileTarget
+
+    reconcile_target = ReconcileTarget(
+        MOCKED_TARGET_MAPPING["AlbDnsName"],
+        MOCKED_TARGET_MAPPING["AlbListener"],
+        MOCKED_TARGET_MAPPING["NlbTgArn"],
+        state_key_prefix="mocked_alb_2.dns.name.com/443/targetgroup/TG-mocked-2/12345abcde",
+        previous_state_key_prefix="mocked_alb_2.dns.name.com/443",
+    )
+    mocked_aws_services.reset_mock()
+    mocked_aws_services.download_state_from_s3.side_effect = [
+        ({}, None),
+        (mocked_state_from_previous_invocation, "mocked_previous_etag"),
+    ]
+    actual_result = get_state_from_previous_invocation(mocked_aws_services, reconcile_target)
+    assert mocked_aws_services.download_state_from_s3.call_args_list == [
+        call(reconcile_target.state_key),
+        call("mocked_alb_2.dns.name.com/443/state.json"),
+    ]
+    mocked_aws_services.download_elb_ip_from_s3.assert_not_called()
+    assert actual_result == (mocked_state_from_previous_invocation, None)
+    mocked_aws_services.download_state_from_s3.side_effect = None
+
+
+@patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
+def test_save_state(mocked_logger):
+    from lifecycle import IpLifecycleTable, DRAINING
+    from observation import IpObservationIndex
+    from populate_NLB_TG_with_ALB import build_state, save_state
+
+    mocked_aws_services.reset_mock()
+    state_from_previous_invocation = mocked_state_from_previous_invocation
+    ip_lifecycle_table = IpLifecycleTable.from_state(state_from_previous_invocation, 1621294392)
+    ip_observation_index = IpObservationIndex.from_state(state_from_previous_invocation)
+
+    # Case 1: When the state is unchanged. Skip the upload
+    state = build_state(mocked_active_ip_dict_from_previous_invocation, ip_lifecycle_table, ip_observation_index)
+    assert state == state_from_previous_invocation
+    reconcile_target = get_mocked_reconcile_target()
+    assert not save_state(
+        mocked_aws_services,
+        reconcile_target,
+        state,
+        state_from_previous_invocation,
+        "mocked_etag",
+    )
+    mocked_aws_services.write_state_to_s3.assert_not_called()
+    mocked_logger.info.assert_called_with(
+        "State is unchanged since the previous invocation. Skip uploading state to S3"
+    )
+
+    # Case 2: When the state changed
+    ip_lifecycle_table.set_lifecycle_state({"3.3.3.3"}, DRAINING, 1621294392)
+    state = build_state(mocked_active_ip_dict_from_previous_invocation, ip_lifecycle_table, ip_observation_index)
+    save_state(
+        mocked_aws_services,
+        reconcile_target,
+        state,
+        state_from_previous_invocation,
+        "mocked_etag",
+    )
+    mocked_aws_services.write_state_to_s3.assert_called_once_with(
+        state, UnittestConstant.STATE_KEY, "mocked_etag", "json"
+    )
+
+    # Case 3: When the state object does not exist yet. Always upload
+    mocked_aws_services.reset_mock()
+    save_state(
+        mocked_aws_services,
+        reconcile_target,
+        state_from_previous_invocation,
+        state_from_previous_invocation,
+        None,
+    )
+    mocked_aws_services.write_state_to_s3.assert_called_once_with(
+        state_from_previous_invocation, UnittestConstant.STATE_KEY, None, "json"
     )
-    assert actual_active_ip_set_from_previous_invocation == {"1.1.1.1", "2.2.2.2"}
 
 
 @patch("populate_NLB_TG_with_ALB.AwsServices", return_value=MagicMock())
@@ -115,12 +463,15 @@ def test_update_target_group(mocked_logger, mocked_AwsServices):
 
     mocked_AwsServices.return_value = mocked_aws_services
 
-    # When pending registration and deregistration IP sets are empty, expect is_registered is False
+    # When pending registration and deregistration IP sets are empty, expect no registered or deregistered IP
     pending_registration_ip_set = set()
     pending_deregistration_ip_set = set()
-    expected_result = False
+    expected_result = (set(), set())
     actual_result = update_target_group(
-        pending_registration_ip_set, pending_deregistration_ip_set, mocked_aws_services
+        pending_registration_ip_set,
+        pending_deregistration_ip_set,
+        mocked_aws_services,
+        get_mocked_reconcile_target(),
     )
     logger_info_calls = [
         call("No pending registration IP found. Skipping ELB target registration..."),
@@ -131,15 +482,471 @@ def test_update_target_group(mocked_logger, mocked_AwsServices):
     mocked_logger.info.assert_has_calls(logger_info_calls)
     assert actual_result == expected_result
 
-    # When pending registration and deregistration IPs are not empty
-    pending_registration_ip_set = {"1.1.1.1"}
+    # When pending registration and deregistration IPs are not empty. Return the IPs that were registered and
+    # deregistered
+    from metrics import MetricRecorder
+
+    metric_recorder = MetricRecorder({})
+    pending_registration_ip_set = {"1.1.1.1", "3.3.3.3"}
     pending_deregistration_ip_set = {"2.2.2.2"}
-    update_target_group(
-        pending_registration_ip_set, pending_deregistration_ip_set, mocked_aws_services
-    )
-    mocked_aws_services.register_target.assert_called_with(
-        UnittestConstant.NLB_TG_ARN, [{"Id": "1.1.1.1", "Port": 80}]
+    mocked_aws_services.register_target.return_value = [{"Id": "1.1.1.1", "Port": 80}]
+    mocked_aws_services.deregister_target.return_value = [{"Id": "2.2.2.2", "Port": 80}]
+    actual_result = update_target_group(
+        pending_registration_ip_set,
+        pending_deregistration_ip_set,
+        mocked_aws_services,
+        get_mocked_reconcile_target(),
+        metric_recorder,
     )
+    registered_target_list = mocked_aws_services.register_target.call_args.args[1]
+    assert sorted(target["Id"] for target in registered_target_list) == ["1.1.1.1", "3.3.3.3"]
     mocked_aws_services.deregister_target.assert_called_with(
-        UnittestConstant.NLB_TG_ARN, [{"Id": "2.2.2.2", "Port": 80}]
+        UnittestConstant.NLB_TG_ARN, [{"Id": "2.2.2.2", "Port": 80}], metric_recorder
+    )
+    assert actual_result == ({"1.1.1.1"}, {"2.2.2.2"})
+    assert metric_recorder.metric_values["RegisteredTargetCount"] == [1]
+    assert metric_recorder.metric_values["FailedRegistrationCount"] == [1]
+    assert metric_recorder.metric_values["DeregisteredTargetCount"] == [1]
+    assert "RegisterTargetsDuration" in metric_recorder.metric_values
+
+
+@patch("populate_NLB_TG_with_ALB.time")
+@patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
+def test_reconcile(mocked_logger, mocked_time):
+    from aws_services import TargetGroupSnapshot
+    from metrics import MetricBuffer
+    from observation import DnsObservation
+    from populate_NLB_TG_with_ALB import reconcile
+
+    mocked_time.perf_counter.return_value = 0
+    mocked_time.time.return_value = 1621294392
+    mocked_aws_service = MagicMock()
+    mocked_aws_service.register_target.side_effect = lambda tg_arn, target_list, metric_recorder: target_list
+    mocked_aws_service.deregister_target.side_effect = lambda tg_arn, target_list, metric_recorder: target_list
+    target_group_snapshot = TargetGroupSnapshot(
+        UnittestConstant.NLB_TG_ARN,
+        [
+            {"Target": {"Id": ip, "Port": 443}, "TargetHealth": {"State": "healthy"}}
+            for ip in ("1.1.1.1", "3.3.3.3")
+        ],
+    )
+    # 3.3.3.3 was seen by every invocation until the previous one, which missed it. 2.2.2.2 is new
+    ip_from_dns_set = {"1.1.1.1", "2.2.2.2"}
+
+    def reconcile_with(state_from_previous_invocation, dns_observation=None, config=None):
+        mocked_aws_service.reset_mock()
+        reconcile(
+            mocked_aws_service,
+            get_mocked_reconcile_target(config),
+            ip_from_dns_set,
+            target_group_snapshot,
+            (state_from_previous_invocation, "mocked_etag"),
+            MetricBuffer(),
+            dns_observation=dns_observation,
+        )
+        return mocked_aws_service.write_state_to_s3.call_args.args[0]
+
+    # Case 1: The DNS sampling saw little, so one more miss is weak evidence. Only register 2.2.2.2
+    dns_observation = DnsObservation(sampling_confidence=0.2)
+    dns_observation.nameserver_per_ip = {"1.1.1.1": "205.251.192.1", "2.2.2.2": "205.251.194.1"}
+    state = reconcile_with(mocked_state_from_previous_invocation, dns_observation)
+    registered_target_list = mocked_aws_service.register_target.call_args.args[1]
+    assert [target["Id"] for target in registered_target_list] == ["2.2.2.2"]
+    mocked_aws_service.deregister_target.assert_not_called()
+    assert state["Version"] == 3
+    # The time stamp is the time of the reconcile
+    assert state["ActiveIP"]["TimeStamp"] == "2021-05-17 23:33:12"
+    assert state["Targets"]["2.2.2.2"]["State"] == "registered"
+    assert state["Targets"]["3.3.3.3"]["State"] == "missing"
+    assert state["Observations"]["2.2.2.2"] == {
+        "LastSeen": 1621294392, "History": 1, "RunCount": 1, "Confidence": 1.0, "NameServer": "205.251.194.1"
+    }
+    assert state["Observations"]["3.3.3.3"]["Confidence"] == 0.0405
+
+    # Case 2: A confident DNS sampling misses 3.3.3.3 again. It is clearly gone and it has been missing for the
+    # deregistration delay, so deregister it
+    state = reconcile_with(mocked_state_from_previous_invocation, config=get_mocked_config(DEREGISTRATION_DELAY="60"))
+    deregistered_target_list = mocked_aws_service.deregister_target.call_args.args[1]
+    assert [target["Id"] for target in deregistered_target_list] == ["3.3.3.3"]
+    assert state["Targets"]["3.3.3.3"]["State"] == "draining"
+    assert "3.3.3.3" not in state["Observations"]
+
+    # Case 3: But not before it has been missing for the deregistration delay. By default two minutes, from
+    # INVOCATIONS_BEFORE_DEREGISTRATION
+    reconcile_with(mocked_state_from_previous_invocation)
+    mocked_aws_service.deregister_target.assert_not_called()
+
+    # Case 4: A state without DNS observations. 3.3.3.3 loses its confidence at the default detection rate
+    state = reconcile_with(dict(mocked_state_from_previous_invocation, Version=2, Observations={}))
+    mocked_aws_service.deregister_target.assert_not_called()
+    assert state["Observations"]["3.3.3.3"]["Confidence"] == 0.5
+
+    # Case 5: Dry run. Return the plan without registering, deregistering, uploading the state or emitting the
+    # step metrics
+    mocked_aws_service.reset_mock()
+    mocked_metric_recorder = MagicMock()
+    reconcile_plan = reconcile(
+        mocked_aws_service,
+        get_mocked_reconcile_target(get_mocked_config(DEREGISTRATION_DELAY="60", CW_METRIC_FLAG_STEP_METRICS="true")),
+        ip_from_dns_set,
+        target_group_snapshot,
+        (mocked_state_from_previous_invocation, "mocked_etag"),
+        MetricBuffer(),
+        mocked_metric_recorder,
+        is_dry_run=True,
+    )
+    assert mocked_aws_service.method_calls == []
+    mocked_metric_recorder.flush.assert_not_called()
+    assert reconcile_plan["ToRegister"] == ["2.2.2.2"]
+    assert reconcile_plan["ToDeregister"] == ["3.3.3.3"]
+    assert reconcile_plan["MissingIPConfidence"] == {"3.3.3.3": 0.0025}
+    assert (reconcile_plan["DnsIPCount"], reconcile_plan["TargetGroupIPCount"]) == (2, 2)
+    assert reconcile_plan["DnsSampling"]["SamplingConfidence"] == 1.0
+
+
+@patch("populate_NLB_TG_with_ALB.time")
+@patch("populate_NLB_TG_with_ALB.logger", return_value=MagicMock())
+def test_reconcile_back_to_back_passes(mocked_logger, mocked_time):
+    from aws_services import TargetGroupSnapshot
+    from populate_NLB_TG_with_ALB import reconcile
+
+    # Loop mode passes 5 seconds apart. Every one of them confidently misses 3.3.3.3, which every previous
+    # invocation saw. Its confidence is gone after two passes, but it stays registered for the deregistration delay
+    mocked_time.perf_counter.return_value = 0
+    mocked_aws_service = MagicMock()
+    mocked_aws_service.deregister_target.side_effect = lambda tg_arn, target_list, metric_recorder: target_list
+    target_group_snapshot = TargetGroupSnapshot(
+        UnittestConstant.NLB_TG_ARN,
+        [
+            {"Target": {"Id": ip, "Port": 80}, "TargetHealth": {"State": "healthy"}}
+            for ip in ("1.1.1.1", "3.3.3.3")
+        ],
+    )
+    state = {
+        "Version": 3,
+        "ActiveIP": mocked_active_ip_dict_from_previous_invocation,
+        "Targets": {
+            ip: {"State": "registered", "Since": 1621294212, "FirstSeen": 1621294212, "MissingSince": None}
+            for ip in ("1.1.1.1", "3.3.3.3")
+        },
+        "Observations": {
+            ip: {"LastSeen": 1621294212, "History": 65535, "RunCount": 16, "Confidence": 1.0, "NameServer": None}
+            for ip in ("1.1.1.1", "3.3.3.3")
+        },
+    }
+    first_miss_time = 1621294392
+    for elapsed in range(0, 125, 5):
+        mocked_time.time.return_value = first_miss_time + elapsed
+        mocked_aws_service.reset_mock()
+        reconcile(
+            mocked_aws_service,
+            get_mocked_reconcile_target(),
+            {"1.1.1.1"},
+            target_group_snapshot,
+            (state, "mocked_etag"),
+        )
+        if elapsed < 120:
+            mocked_aws_service.deregister_target.assert_not_called()
+        # The state is only uploaded when the pass changed it
+        if mocked_aws_service.write_state_to_s3.called:
+            state = mocked_aws_service.write_state_to_s3.call_args.args[0]
+    assert state["Targets"]["3.3.3.3"]["State"] == "draining"
+    assert set(state["Observations"]) == {"1.1.1.1"}
+    deregistered_target_list = mocked_aws_service.deregister_target.call_args.args[1]
+    assert [target["Id"] for target in deregistered_target_list] == ["3.3.3.3"]
+
+
+@patch("populate_NLB_TG_with_ALB.reconcile")
+@patch("populate_NLB_TG_with_ALB.get_state_from_previous_invocation")
+@patch("populate_NLB_TG_with_ALB.get_ip_from_dns")
+def test_reconcile_pass(
+        mocked_get_ip_from_dns, mocked_get_state_from_previous_invocation, mocked_reconcile
+):
+    from concurrent.futures import ThreadPoolExecutor
+    from metrics import MetricBuffer
+    from populate_NLB_TG_with_ALB import reconcile_pass
+
+    # The DNS sampling, the target health and the state are read at the same time. Each read waits for the
+    # other two, so the pass fails when they run one after another
+    barrier = threading.Barrier(3, timeout=5)
+
+    def read_after_other_reads(value):
+        def read(*args):
+            barrier.wait()
+            return value
+        return read
+
+    mocked_aws_service = MagicMock()
+    mocked_get_ip_from_dns.side_effect = read_after_other_reads({"1.1.1.1"})
+    mocked_aws_service.get_target_group_snapshot.side_effect = read_after_other_reads("snapshot")
+    mocked_get_state_from_previous_invocation.side_effect = read_after_other_reads("state")
+    reconcile_target = get_mocked_reconcile_target()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        is_failed = reconcile_pass(
+            executor, mocked_aws_service, [reconcile_target], {"9.9.9.9"}, MetricBuffer()
+        )
+    assert not is_failed
+    mocked_reconcile.assert_called_once()
+    assert mocked_reconcile.call_args.args[1:5] == (
+        reconcile_target, {"1.1.1.1", "9.9.9.9"}, "snapshot", "state"
+    )
+
+    # When the target group cannot be described. Skip the mapping for this pass and fail the pass
+    mocked_reconcile.reset_mock()
+    mocked_get_ip_from_dns.side_effect = None
+    mocked_get_ip_from_dns.return_value = {"1.1.1.1"}
+    mocked_get_state_from_previous_invocation.side_effect = None
+    mocked_aws_service.get_target_group_snapshot.side_effect = Exception("Throttling")
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        is_failed = reconcile_pass(
+            executor, mocked_aws_service, [reconcile_target], set(), MetricBuffer()
+        )
+    assert is_failed
+    mocked_reconcile.assert_not_called()
+
+
+@patch("populate_NLB_TG_with_ALB.reconcile")
+@patch("populate_NLB_TG_with_ALB.get_state_from_previous_invocation")
+@patch("populate_NLB_TG_with_ALB.get_ip_from_dns")
+def test_reconcile_pass_with_failed_dns_sampling(
+        mocked_get_ip_from_dns, mocked_get_state_from_previous_invocation, mocked_reconcile
+):
+    from concurrent.futures import ThreadPoolExecutor
+    from metrics import MetricBuffer
+    from populate_NLB_TG_with_ALB import reconcile_pass, get_reconcile_target_list
+
+    def get_ip_from_dns(config, alb_dns_name, *args):
+        if alb_dns_name == UnittestConstant.ALB_DNS_NAME:
+            raise OSError("Network is unreachable")
+        return {"2.2.2.2"}
+
+    # The DNS sampling of one ALB fails. The mapping of the other ALB is reconciled and the pass fails
+    mocked_get_ip_from_dns.side_effect = get_ip_from_dns
+    mocked_get_state_from_previous_invocation.return_value = ({}, None)
+    reconcile_target_list = get_reconcile_target_list(
+        get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING]))
     )
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        is_failed = reconcile_pass(
+            executor, MagicMock(), reconcile_target_list, set(), MetricBuffer()
+        )
+    assert is_failed
+    mocked_reconcile.assert_called_once()
+    assert mocked_reconcile.call_args.args[1] is reconcile_target_list[1]
+    assert mocked_reconcile.call_args.args[2] == {"2.2.2.2"}
+
+
+@patch("populate_NLB_TG_with_ALB.sys")
+@patch("populate_NLB_TG_with_ALB.reconcile")
+@patch("populate_NLB_TG_with_ALB.get_state_from_previous_invocation")
+@patch("populate_NLB_TG_with_ALB.get_ip_from_dns")
+@patch("populate_NLB_TG_with_ALB.AwsServices")
+def test_reconcile_event(
+        mocked_AwsServices,
+        mocked_get_ip_from_dns,
+        mocked_get_state_from_previous_invocation,
+        mocked_reconcile,
+        mocked_sys,
+):
+    from populate_NLB_TG_with_ALB import reconcile_event
+
+    mocked_AwsServices.from_config.return_value = mocked_aws_services
+    second_target_mapping = dict(MOCKED_TARGET_MAPPING, AlbListener=80)
+    mocked_ip_from_dns_set_per_alb = {
+        UnittestConstant.ALB_DNS_NAME: {"1.1.1.1"},
+        "mocked_alb_2.dns.name.com": {"2.2.2.2"},
+    }
+    mocked_get_ip_from_dns.side_effect = (
+        lambda config, alb_dns_name, metric_buffer, ip_version, aws_service, dns_observation, is_dry_run:
+        mocked_ip_from_dns_set_per_alb.get(alb_dns_name)
+    )
+
+    # Case 1: Every ALB is sampled once and every mapping is reconciled with one shared AWS service object
+    config = get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING, second_target_mapping]))
+    reconcile_event(config, {}, None)
+    assert mocked_get_ip_from_dns.call_count == 2
+    mocked_AwsServices.from_config.assert_called_once_with(config)
+    reconciled_target_list = sorted(
+        (reconcile_call.args[1].alb_listener, reconcile_call.args[2])
+        for reconcile_call in mocked_reconcile.call_args_list
+    )
+    assert reconciled_target_list == [(80, {"1.1.1.1"}), (80, {"2.2.2.2"}), (443, {"2.2.2.2"})]
+    mocked_sys.exit.assert_not_called()
+
+    # Case 2: When an ALB has no IP in the DNS. Reconcile the other mappings and fail the invocation
+    mocked_reconcile.reset_mock()
+    mocked_ip_from_dns_set_per_alb[UnittestConstant.ALB_DNS_NAME] = set()
+    reconcile_event(get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING])), {}, None)
+    mocked_reconcile.assert_called_once()
+    mocked_sys.exit.assert_called_once_with(1)
+
+    # Case 2.1: When the DNS sampling of an ALB fails. Reconcile the mappings of the other ALBs and fail the
+    # invocation
+    mocked_reconcile.reset_mock()
+    mocked_sys.reset_mock()
+    get_ip_from_dns_side_effect = mocked_get_ip_from_dns.side_effect
+
+    def get_ip_from_dns(config, alb_dns_name, *args):
+        if alb_dns_name == UnittestConstant.ALB_DNS_NAME:
+            raise ValueError("Failed to resolve the name servers of the ALB")
+        return {"2.2.2.2"}
+
+    mocked_get_ip_from_dns.side_effect = get_ip_from_dns
+    reconcile_event(
+        get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING, second_target_mapping])), {}, None
+    )
+    assert sorted(
+        reconcile_call.args[1].alb_listener for reconcile_call in mocked_reconcile.call_args_list
+    ) == [80, 443]
+    mocked_sys.exit.assert_called_once_with(1)
+    mocked_get_ip_from_dns.side_effect = get_ip_from_dns_side_effect
+
+    # Case 3: Triggered by a new ALB node. Only reconcile that ALB, with the IP of the new node
+    mocked_reconcile.reset_mock()
+    mocked_get_ip_from_dns.reset_mock()
+    reconcile_event(
+        get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING])), MOCKED_ALB_ENI_EVENT, None
+    )
+    mocked_get_ip_from_dns.assert_called_once()
+    assert mocked_get_ip_from_dns.call_args.args[1] == "mocked_alb_2.dns.name.com"
+    mocked_reconcile.assert_called_once()
+    assert mocked_reconcile.call_args.args[2] == {"2.2.2.2", "9.9.9.9"}
+
+    # Case 4: Dualstack ALB with an IPv4 and an IPv6 target group. Sample its A and AAAA records once each and
+    # reconcile every target group with the IPs of its own version
+    mocked_reconcile.reset_mock()
+    mocked_get_ip_from_dns.reset_mock()
+    mocked_get_ip_from_dns.side_effect = (
+        lambda config, alb_dns_name, metric_buffer, ip_version, aws_service, dns_observation, is_dry_run:
+        {4: {"2.2.2.2"}, 6: {"2600:1f18::a"}}[ip_version]
+    )
+    ipv6_target_mapping = dict(MOCKED_TARGET_MAPPING, IpAddressType="ipv6")
+    reconcile_event(
+        get_mocked_config(ALB_DNS_NAME="", TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING, ipv6_target_mapping])),
+        {},
+        None,
+    )
+    assert sorted(call_args.args[3] for call_args in mocked_get_ip_from_dns.call_args_list) == [4, 6]
+    assert sorted(
+        (reconcile_call.args[1].ip_version, reconcile_call.args[2])
+        for reconcile_call in mocked_reconcile.call_args_list
+    ) == [(4, {"2.2.2.2"}), (6, {"2600:1f18::a"})]
+
+    # Case 5: Dry run. Reconcile every mapping up to its plan, publish nothing and return the plans
+    mocked_reconcile.reset_mock()
+    mocked_reconcile.side_effect = lambda *args: {"ToRegister": sorted(args[2])}
+    mocked_aws_services.reset_mock()
+    result = reconcile_event(
+        get_mocked_config(TARGET_MAPPINGS=json.dumps([MOCKED_TARGET_MAPPING])), {"DryRun": True}, None
+    )
+    assert result["DryRun"] and not result["IsFailed"]
+    assert sorted(plan["ToRegister"] for plan in result["Plans"]) == [["2.2.2.2"], ["2.2.2.2"]]
+    assert all(reconcile_call.args[-1] for reconcile_call in mocked_reconcile.call_args_list)
+    mocked_aws_services.put_metric_data.assert_not_called()
+
+
+@patch("populate_NLB_TG_with_ALB.time")
+@patch("populate_NLB_TG_with_ALB.reconcile")
+@patch("populate_NLB_TG_with_ALB.get_state_from_previous_invocation")
+@patch("populate_NLB_TG_with_ALB.get_ip_from_dns")
+@patch("populate_NLB_TG_with_ALB.AwsServices")
+def test_reconcile_event_loop_mode(
+        mocked_AwsServices,
+        mocked_get_ip_from_dns,
+        mocked_get_state_from_previous_invocation,
+        mocked_reconcile,
+        mocked_time,
+):
+    from populate_NLB_TG_with_ALB import reconcile_event
+
+    mocked_AwsServices.from_config.return_value = mocked_aws_services
+    mocked_get_ip_from_dns.return_value = {"1.1.1.1"}
+    clock = [0]
+    mocked_time.monotonic.side_effect = lambda: clock[0]
+    mocked_time.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+    mocked_context = MagicMock()
+    mocked_context.get_remaining_time_in_millis.return_value = 30000
+
+    # A pass every 5 seconds until 10 seconds before the timeout
+    reconcile_event(get_mocked_config(RECONCILE_LOOP_INTERVAL="5"), {}, mocked_context)
+    assert mocked_reconcile.call_count == 5
+    assert clock[0] == 20
+
+    # The loop duration caps the loop
+    mocked_reconcile.reset_mock()
+    clock[0] = 0
+    reconcile_event(
+        get_mocked_config(RECONCILE_LOOP_INTERVAL="5", RECONCILE_LOOP_DURATION="7"), {}, mocked_context
+    )
+    assert mocked_reconcile.call_count == 2
+
+    # Loop mode is off by default
+    mocked_reconcile.reset_mock()
+    reconcile_event(get_mocked_config(), {}, mocked_context)
+    mocked_reconcile.assert_called_once()
+
+    # A pass that raises fails the invocation after the remaining passes and their metrics
+    clock[0] = 0
+    with patch("populate_NLB_TG_with_ALB.reconcile_pass") as mocked_reconcile_pass, patch(
+            "populate_NLB_TG_with_ALB.publish_metrics"
+    ) as mocked_publish_metrics:
+        mocked_reconcile_pass.side_effect = [OSError("Network is unreachable")] + [False] * 4
+        with pytest.raises(SystemExit):
+            reconcile_event(get_mocked_config(RECONCILE_LOOP_INTERVAL="5"), {}, mocked_context)
+    assert mocked_reconcile_pass.call_count == 5
+    assert mocked_publish_metrics.call_count == 5
+
+
+@patch("populate_NLB_TG_with_ALB.publish_metrics")
+@patch("populate_NLB_TG_with_ALB.reconcile_pass")
+def test_run_reconcile_passes_until_stopped(mocked_reconcile_pass, mocked_publish_metrics):
+    import math
+    from populate_NLB_TG_with_ALB import run_reconcile_passes
+
+    # A daemon keeps passing after a pass raises, until its stop event is set
+    config = get_mocked_config(RECONCILE_LOOP_INTERVAL="1")
+    mocked_reconcile_pass.side_effect = [OSError("Network is unreachable"), False, False]
+    mocked_stop_event = MagicMock()
+    mocked_stop_event.wait.side_effect = [False, False, True]
+    is_failed = run_reconcile_passes(
+        config, MagicMock(), [get_mocked_reconcile_target(config)], set(), math.inf, mocked_stop_event
+    )
+    assert is_failed
+    assert mocked_reconcile_pass.call_count == 3
+    assert mocked_publish_metrics.call_count == 3
+
+
+@patch.dict("populate_NLB_TG_with_ALB._config_cache", clear=True)
+def test_get_config(env_setup, monkeypatch):
+    import os
+    from populate_NLB_TG_with_ALB import get_config
+
+    # The configuration is read from the environment variables and validated
+    config = get_config()
+    assert config.S3_BUCKET == UnittestConstant.S3_BUCKET
+    assert [target.alb_dns_name for target in config.reconcile_target_list] == [UnittestConstant.ALB_DNS_NAME]
+
+    # A warm container reuses the validated configuration while the environment variables are unchanged
+    with patch("populate_NLB_TG_with_ALB.validate_environment_variable") as mocked_validate_environment_variable:
+        assert get_config() is config
+    mocked_validate_environment_variable.assert_not_called()
+
+    # A changed environment variable is picked up without a cold start
+    monkeypatch.setenv("MAX_LOOKUP_PER_INVOCATION", "20")
+    assert get_config().MAX_LOOKUP_PER_INVOCATION == 20
+
+    # An invalid configuration is not cached
+    with pytest.raises(ValueError):
+        get_config(dict(os.environ, S3_BUCKET=""))
+    assert get_config().MAX_LOOKUP_PER_INVOCATION == 20
+
+
+@patch.dict("populate_NLB_TG_with_ALB._config_cache", clear=True)
+@patch("populate_NLB_TG_with_ALB.reconcile_event")
+def test_lambda_handler(mocked_reconcile_event, env_setup):
+    from populate_NLB_TG_with_ALB import lambda_handler
+
+    assert lambda_handler({"DryRun": True}, None) == mocked_reconcile_event.return_value
+    (config, event, context) = mocked_reconcile_event.call_args.args
+    assert config.ALB_DNS_NAME == UnittestConstant.ALB_DNS_NAME
+    assert (event, context) == ({"DryRun": True}, None)
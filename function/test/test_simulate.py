@@ -0,0 +1,28 @@
+def test_run_scenario():
+    from benchmark.simulate import run_scenario
+
+    # New ALB nodes are registered by the first invocation after the scale-out
+    actual_result = run_scenario("scale_out", minutes=5)
+    assert actual_result["RegistrationConvergenceMinutes"] == 1
+    assert actual_result["MissingIPMinutes"] == 0
+    assert actual_result["FailedInvocationCount"] == 0
+    assert actual_result["DnsQueryCount"] > 0
+    assert actual_result["ApiCallCount"]["RegisterTargets"] == 2
+
+    # Removed ALB nodes were seen by every invocation, so two confident misses take their confidence. They are
+    # deregistered once they have been missing for the default deregistration delay (two minutes). A much lower
+    # DEREGISTRATION_CONFIDENCE takes one more miss
+    actual_result = run_scenario("scale_in", minutes=8)
+    assert actual_result["DeregistrationConvergenceMinutes"] == 3
+    assert actual_result["StaleIPMinutes"] == 16
+    actual_result = run_scenario("scale_in", minutes=8, deregistration_confidence=0.0001)
+    assert actual_result["DeregistrationConvergenceMinutes"] == 4
+
+    # Or once they have been missing from the DNS for DEREGISTRATION_DELAY seconds
+    actual_result = run_scenario("scale_in", minutes=8, deregistration_delay=180)
+    assert actual_result["DeregistrationConvergenceMinutes"] == 4
+
+    # The binary state codec converges like the JSON one
+    actual_result = run_scenario("scale_in", minutes=8, state_encoding="binary")
+    assert actual_result["DeregistrationConvergenceMinutes"] == 3
+    assert actual_result["FailedInvocationCount"] == 0
@@ -0,0 +1,147 @@
+import json
+import pytest
+
+MOCKED_ACTIVE_IP_DICT = {
+    "LoadBalancerName": "internal-alb-internal-12345.us-east-1.elb.amazonaws.com",
+    "TimeStamp": "2021-05-17 23:31:12",
+    "IPList": ["1.1.1.1", "2600:1f18::a"],
+    "IPCount": 2,
+}
+
+MOCKED_TARGETS = {
+    "1.1.1.1": {"State": "registered", "Since": 1621294272, "FirstSeen": 1621294212, "MissingSince": None},
+    "3.3.3.3": {"State": "missing", "Since": 1621294332, "FirstSeen": 1621294212, "MissingSince": 1621294332},
+    "2600:1f18::a": {"State": "discovered", "Since": 1621294392, "FirstSeen": 1621294392, "MissingSince": None},
+}
+
+MOCKED_STATE = {
+    "Version": 3,
+    "ActiveIP": MOCKED_ACTIVE_IP_DICT,
+    "Targets": MOCKED_TARGETS,
+    "Observations": {
+        "1.1.1.1": {
+            "LastSeen": 1621294272, "History": 65535, "RunCount": 16, "Confidence": 1.0, "NameServer": "205.251.192.1"
+        },
+        "3.3.3.3": {"LastSeen": 1621294272, "History": 14, "RunCount": 4, "Confidence": 0.0133, "NameServer": None},
+        "2600:1f18::a": {
+            "LastSeen": 1621294392, "History": 1, "RunCount": 1, "Confidence": 1.0, "NameServer": "205.251.194.1"
+        },
+    },
+}
+
+
+def test_encode_binary_state(env_setup):
+    from state_codec import decode_binary_state, encode_binary_state
+
+    # Case 1: Round trip. The binary state is a fraction of the JSON one
+    body = encode_binary_state(MOCKED_STATE)
+    assert decode_binary_state(body) == MOCKED_STATE
+    assert len(body) < len(json.dumps(MOCKED_STATE)) / 2
+
+    # Case 2: Empty state
+    empty_state = {"Version": 3, "ActiveIP": {}, "Targets": {}, "Observations": {}}
+    assert decode_binary_state(encode_binary_state(empty_state)) == empty_state
+
+    # Case 3: The binary layout does not hold unknown keys or lifecycle states
+    with pytest.raises(ValueError):
+        encode_binary_state(dict(MOCKED_STATE, Unknown={}))
+    with pytest.raises(ValueError):
+        encode_binary_state(
+            dict(MOCKED_STATE, Targets={"1.1.1.1": dict(MOCKED_TARGETS["1.1.1.1"], State="unknown")})
+        )
+    with pytest.raises(ValueError):
+        encode_binary_state(
+            dict(
+                MOCKED_STATE,
+                Observations={"1.1.1.1": dict(MOCKED_STATE["Observations"]["1.1.1.1"], NameServer="2600:9000::1")},
+            )
+        )
+
+
+def test_decode_binary_state_format_1(env_setup):
+    from state_codec import (
+        BINARY_STATE_HEADER,
+        BINARY_STATE_MAGIC,
+        INVOCATION_COUNT_FORMAT,
+        decode_binary_state,
+        pack_active_ip,
+        pack_ip_block,
+    )
+
+    # Objects written with the first binary layout hold the pending deregistration invocation counts
+    body = b"".join(
+        [
+            BINARY_STATE_HEADER.pack(BINARY_STATE_MAGIC, 1, 1),
+            b"\x01",
+            pack_active_ip(MOCKED_ACTIVE_IP_DICT),
+            pack_ip_block(
+                ["3.3.3.3", "2600:1f18::b"],
+                INVOCATION_COUNT_FORMAT,
+                {"3.3.3.3": (1,), "2600:1f18::b": (2,)},
+            ),
+        ]
+    )
+    assert decode_binary_state(body) == {
+        "Version": 1,
+        "ActiveIP": MOCKED_ACTIVE_IP_DICT,
+        "PendingDeregistrationIP": {"3.3.3.3": 1, "2600:1f18::b": 2},
+    }
+
+
+def test_decode_binary_state_format_2(env_setup):
+    from state_codec import (
+        BINARY_STATE_HEADER,
+        BINARY_STATE_MAGIC,
+        LIFECYCLE_ENTRY_FORMAT,
+        decode_binary_state,
+        pack_active_ip,
+        pack_ip_block,
+    )
+
+    # Objects written with the second binary layout have no DNS observations
+    body = b"".join(
+        [
+            BINARY_STATE_HEADER.pack(BINARY_STATE_MAGIC, 2, 2),
+            b"\x01",
+            pack_active_ip(MOCKED_ACTIVE_IP_DICT),
+            pack_ip_block(
+                ["1.1.1.1"], LIFECYCLE_ENTRY_FORMAT, {"1.1.1.1": (1, 1621294272, 1621294212, 0)}
+            ),
+        ]
+    )
+    assert decode_binary_state(body) == {
+        "Version": 2,
+        "ActiveIP": MOCKED_ACTIVE_IP_DICT,
+        "Targets": {"1.1.1.1": MOCKED_TARGETS["1.1.1.1"]},
+    }
+
+
+def test_encode_state(env_setup):
+    from state_codec import encode_state
+
+    # Case 1: JSON by default
+    (body, content_type) = encode_state(MOCKED_STATE)
+    assert json.loads(body) == MOCKED_STATE
+    assert content_type == "application/json"
+
+    # Case 2: Binary
+    (body, content_type) = encode_state(MOCKED_STATE, "binary")
+    assert body.startswith(b"NLBS")
+    assert content_type == "application/octet-stream"
+
+    # Case 3: Fall back to JSON when the binary layout cannot hold the state
+    state = dict(MOCKED_STATE, Unknown={})
+    (body, content_type) = encode_state(state, "binary")
+    assert json.loads(body) == state
+
+
+def test_decode_state(env_setup):
+    from state_codec import decode_state, encode_binary_state
+
+    # Both encodings are read
+    assert decode_state(json.dumps(MOCKED_STATE).encode()) == MOCKED_STATE
+    assert decode_state(encode_binary_state(MOCKED_STATE)) == MOCKED_STATE
+
+    # Truncated binary state
+    with pytest.raises(ValueError):
+        decode_state(encode_binary_state(MOCKED_STATE)[:-3])
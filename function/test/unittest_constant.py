@@ -14,6 +14,8 @@ class UnittestConstant:
     CW_METRIC_FLAG_IP_COUNT = "TRUE"
     SAME_VPC = "TRUE"
     AWS_REGION = "us-east-1"
+    STATE_FILENAME = "state.json"
+    STATE_KEY = f"{ALB_DNS_NAME}/{STATE_FILENAME}"
     ACTIVE_FILENAME = "active_ip.json"
     PENDING_DEREGISTRATION_FILENAME = "pending_ip.json"
     ACTIVE_IP_LIST_KEY = f"{ALB_DNS_NAME}/{ACTIVE_FILENAME}"
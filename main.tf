@@ -6,18 +6,47 @@ locals {
   full_function_name = "${local.function_name_base}-${local.job_identifier}"
 
   # These filenames are hardcoded in constant.py in the Lambda function.
+  state_key_filename      = "state.json"
   active_ip_key_filename  = "active_ip.json"
   pending_ip_key_filename = "pending_ip.json"
 
-  # These keys are the default values in constant.py in the Lambda function.
+  # These keys are the default values in constant.py in the Lambda function. An IPv6 target group keeps its own
+  # state object.
+  state_key_full      = var.ip_address_type == "ipv6" ? "${var.alb_dns_name}/ipv6/${local.state_key_filename}" : "${var.alb_dns_name}/${local.state_key_filename}"
   active_ip_key_full  = "${var.alb_dns_name}/${local.active_ip_key_filename}"
   pending_ip_key_full = "${var.alb_dns_name}/${local.pending_ip_key_filename}"
+
+  # Every additional mapping keeps its own state object per ALB listener and target group. The key holds the
+  # resource part of the target group ARN (targetgroup/<name>/<id>).
+  target_mapping_state_keys_full = concat(
+    [for mapping in var.target_mappings : "${mapping.alb_dns_name}/${mapping.alb_listener_port}/${element(split(":", mapping.nlb_target_group_arn), 5)}/${local.state_key_filename}"],
+    [for mapping in var.ipv6_target_mappings : "${mapping.alb_dns_name}/${mapping.alb_listener_port}/${element(split(":", mapping.nlb_target_group_arn), 5)}/ipv6/${local.state_key_filename}"],
+  )
+  # The state objects per ALB listener of earlier versions, which seed the state object of a mapping.
+  target_mapping_previous_state_keys_full = concat(
+    [for mapping in var.target_mappings : "${mapping.alb_dns_name}/${mapping.alb_listener_port}/${local.state_key_filename}"],
+    [for mapping in var.ipv6_target_mappings : "${mapping.alb_dns_name}/${mapping.alb_listener_port}/ipv6/${local.state_key_filename}"],
+  )
+  target_mappings_env = jsonencode(concat(
+    [for mapping in var.target_mappings : {
+      AlbDnsName    = mapping.alb_dns_name
+      AlbListener   = mapping.alb_listener_port
+      NlbTgArn      = mapping.nlb_target_group_arn
+      IpAddressType = "ipv4"
+    }],
+    [for mapping in var.ipv6_target_mappings : {
+      AlbDnsName    = mapping.alb_dns_name
+      AlbListener   = mapping.alb_listener_port
+      NlbTgArn      = mapping.nlb_target_group_arn
+      IpAddressType = "ipv6"
+    }],
+  ))
 }
 
 resource "aws_cloudwatch_event_rule" "main" {
   name                = "${local.full_function_name}-trigger"
-  description         = "Trigger the ${local.full_function_name} Lambda function every minute."
-  schedule_expression = "rate(1 minute)"
+  description         = "Trigger the ${local.full_function_name} Lambda function on a schedule."
+  schedule_expression = var.schedule_expression
   is_enabled          = true
   tags                = var.tags
 }
@@ -28,6 +57,34 @@ resource "aws_cloudwatch_event_target" "main" {
   arn       = module.updater.lambda_arn
 }
 
+# Trigger the Lambda function as soon as an ALB node network interface is created. This relies on the EC2 API
+# calls that CloudTrail delivers to EventBridge.
+resource "aws_cloudwatch_event_rule" "alb_change" {
+  count       = var.enable_alb_change_trigger ? 1 : 0
+  name        = "${local.full_function_name}-alb-change"
+  description = "Trigger the ${local.full_function_name} Lambda function when an ALB node is created."
+  event_pattern = jsonencode({
+    source      = ["aws.ec2"]
+    detail-type = ["AWS API Call via CloudTrail"]
+    detail = {
+      eventSource = ["ec2.amazonaws.com"]
+      eventName   = ["CreateNetworkInterface"]
+      requestParameters = {
+        description = [{ prefix = "ELB app/" }]
+      }
+    }
+  })
+  is_enabled = true
+  tags       = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "alb_change" {
+  count     = var.enable_alb_change_trigger ? 1 : 0
+  target_id = local.full_function_name
+  rule      = aws_cloudwatch_event_rule.alb_change[0].name
+  arn       = module.updater.lambda_arn
+}
+
 module "updater" {
   source                 = "trussworks/lambda/aws"
   version                = "2.5.0"
@@ -44,8 +101,8 @@ module "updater" {
 
   cloudwatch_logs_retention_days = var.log_retention_days
 
-  source_types = ["events"]
-  source_arns  = [aws_cloudwatch_event_rule.main.arn]
+  source_types = concat(["events"], [for rule in aws_cloudwatch_event_rule.alb_change : "events"])
+  source_arns  = concat([aws_cloudwatch_event_rule.main.arn], aws_cloudwatch_event_rule.alb_change[*].arn)
 
   env_vars = {
     ALB_DNS_NAME                      = var.alb_dns_name
@@ -54,27 +111,54 @@ module "updater" {
     NLB_TG_ARN                        = var.nlb_target_group_arn
     MAX_LOOKUP_PER_INVOCATION         = var.max_lookup_per_invocation
     INVOCATIONS_BEFORE_DEREGISTRATION = var.invocations_before_deregistration
+    DEREGISTRATION_DELAY              = var.deregistration_delay
+    DEREGISTRATION_CONFIDENCE         = var.deregistration_confidence
     CW_METRIC_FLAG_IP_COUNT           = var.enable_cloudwatch_metrics
+    CW_METRIC_FLAG_STEP_METRICS       = var.enable_step_metrics
+    TARGET_MAPPINGS                   = local.target_mappings_env
+    RECONCILE_LOOP_INTERVAL           = var.reconcile_loop_interval
+    RECONCILE_LOOP_DURATION           = var.reconcile_loop_duration
+    IP_ADDRESS_TYPE                   = var.ip_address_type
+    STATE_ENCODING                    = var.state_encoding
   }
 
   tags = var.tags
 }
 
 data "aws_iam_policy_document" "main" {
-  # Allow uploading and downloading of IP lists, which act as state for the Lambda function.
+  # Allow uploading and downloading of the state object, which holds the active and pending IP lists of the
+  # Lambda function.
   statement {
     effect = "Allow"
-    resources = [
-      "arn:${data.aws_partition.current.partition}:s3:::${var.status_s3_bucket}/${local.active_ip_key_full}",
-      "arn:${data.aws_partition.current.partition}:s3:::${var.status_s3_bucket}/${local.pending_ip_key_full}",
-    ]
+    resources = concat(
+      ["arn:${data.aws_partition.current.partition}:s3:::${var.status_s3_bucket}/${local.state_key_full}"],
+      [for key in local.target_mapping_state_keys_full : "arn:${data.aws_partition.current.partition}:s3:::${var.status_s3_bucket}/${key}"],
+    )
     actions = [
       "s3:GetObject",
       "s3:PutObject",
     ]
   }
 
-  # Allow the Lambda function to get information about target health.
+  # Allow downloading the legacy IP lists and the previous state objects of the additional mappings, which are
+  # read once to seed the state object.
+  statement {
+    effect = "Allow"
+    resources = concat(
+      [
+        "arn:${data.aws_partition.current.partition}:s3:::${var.status_s3_bucket}/${local.active_ip_key_full}",
+        "arn:${data.aws_partition.current.partition}:s3:::${var.status_s3_bucket}/${local.pending_ip_key_full}",
+      ],
+      [for key in local.target_mapping_previous_state_keys_full : "arn:${data.aws_partition.current.partition}:s3:::${var.status_s3_bucket}/${key}"],
+    )
+    actions = [
+      "s3:GetObject",
+    ]
+  }
+
+  # Allow the Lambda function to get information about target health and
+  # about the subnets of the ALBs, which tell the Availability Zone of every
+  # ALB node IP.
   statement {
     effect = "Allow"
     # From the AWS console: "This action does not support resource-level
@@ -82,13 +166,15 @@ data "aws_iam_policy_document" "main" {
     resources = ["*"]
     actions = [
       "elasticloadbalancing:DescribeTargetHealth",
+      "elasticloadbalancing:DescribeLoadBalancers",
+      "ec2:DescribeSubnets",
     ]
   }
 
   # Allow configuring the NLB target groups to point to the ALB IPs.
   statement {
     effect    = "Allow"
-    resources = [var.nlb_target_group_arn]
+    resources = concat([var.nlb_target_group_arn], var.target_mappings[*].nlb_target_group_arn, var.ipv6_target_mappings[*].nlb_target_group_arn)
     actions = [
       "elasticloadbalancing:RegisterTargets",
       "elasticloadbalancing:DeregisterTargets",
@@ -9,18 +9,58 @@ variable "alb_listener_port" {
   default     = 443
 }
 
+variable "deregistration_confidence" {
+  type        = number
+  description = "The confidence (between 0 and 1) that a missing IP address is still in the DNS below which it is deregistered. Lower values deregister later."
+  default     = 0.01
+}
+
+variable "deregistration_delay" {
+  type        = number
+  description = "The minimum number of seconds that a registered IP address has to be missing from the DNS for before it is deregistered. 0 derives it from invocations_before_deregistration for a one-minute schedule."
+  default     = 0
+}
+
+variable "enable_alb_change_trigger" {
+  type        = bool
+  description = "Also trigger the Lambda function when an ALB node is created. Requires a CloudTrail trail that records EC2 management events."
+  default     = false
+}
+
 variable "enable_cloudwatch_metrics" {
   type        = bool
-  description = "Enable CloudWatch metrics for IP address count."
+  description = "Publish the ALB IP count and the controller metrics (target group IP count per AZ, pending deregistration IP count, DNS lookup count and convergence time) to CloudWatch."
   default     = true
 }
 
+variable "enable_step_metrics" {
+  type        = bool
+  description = "Emit the duration of every reconcile step, DNS lookup counts and API retry counts as CloudWatch Embedded Metric Format log lines."
+  default     = false
+}
+
 variable "invocations_before_deregistration" {
   type        = number
-  description = "The number of required invocations before an IP address is deregistered."
+  description = "The number of invocations that miss an IP address before it is deregistered. Sets the default deregistration_delay for a one-minute schedule."
   default     = 3
 }
 
+variable "ip_address_type" {
+  type        = string
+  description = "The IP address type of the NLB's target group: ipv4, or ipv6 for a dualstack ALB."
+  default     = "ipv4"
+}
+
+variable "ipv6_target_mappings" {
+  type = list(object({
+    alb_dns_name         = string
+    alb_listener_port    = number
+    nlb_target_group_arn = string
+  }))
+  description = "Additional dualstack ALB to IPv6 NLB target group mappings that are reconciled by the same Lambda function."
+  default     = []
+}
+
 variable "lambda_job_identifier" {
   type        = string
   description = "A way to uniquely identify this Lambda function."
@@ -58,11 +98,45 @@ variable "nlb_target_group_arn" {
   description = "The ARN of the NLB's target group."
 }
 
+variable "reconcile_loop_duration" {
+  type        = number
+  description = "The maximum number of seconds that the loop mode runs for per invocation. Keep it below the schedule interval."
+  default     = 55
+}
+
+variable "reconcile_loop_interval" {
+  type        = number
+  description = "Loop mode: the number of seconds between reconcile passes within one invocation. 0 runs one pass per invocation."
+  default     = 0
+}
+
+variable "schedule_expression" {
+  type        = string
+  description = "The schedule on which the Lambda function runs. It can be relaxed when enable_alb_change_trigger is set."
+  default     = "rate(1 minute)"
+}
+
+variable "state_encoding" {
+  type        = string
+  description = "The encoding of the state objects: json, or binary for packed IP addresses. Objects of either encoding are read."
+  default     = "json"
+}
+
 variable "status_s3_bucket" {
   type        = string
   description = "The name of the S3 bucket that will store the pending and active IP information produced by the Lambda function."
 }
 
+variable "target_mappings" {
+  type = list(object({
+    alb_dns_name         = string
+    alb_listener_port    = number
+    nlb_target_group_arn = string
+  }))
+  description = "Additional ALB to NLB target group mappings that are reconciled by the same Lambda function."
+  default     = []
+}
+
 variable "tags" {
   type        = map(string)
   description = "Tags applied to each AWS resource."